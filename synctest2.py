@@ -1,20 +1,107 @@
 #!/usr/bin/env python3
 import argparse
+import array
 import collections
+import concurrent.futures
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import fnmatch
 import gzip
+import hashlib
+import heapq
+import io
+import itertools
+import json
 import logging
+import math
+import mmap
 import os
 import pathlib
+import posixpath
+import queue
+import random
+import re
+import select
+import shutil
+import socket
+import socketserver
+import stat
+import struct
 import sys
+import tarfile
+import tempfile
+import threading
+import time
+import urllib.parse
 import zlib
+import zipfile
 import utillib.simplewrap
 assert sys.version_info.major >= 3, 'Python 3 required'
 
-TSV_FIELDS = ('type', 'size', 'modified', 'crc', 'target')
+TSV_FIELDS = ('type', 'size', 'modified', 'crc', 'target', 'files', 'bytes')
+# The files and bytes columns are only added to lines for collapsed directories, so every other
+# line (and all output from older versions) only has these.
+TSV_BASE_FIELDS = TSV_FIELDS[:5]
+PLAN_FIELDS = ('type', 'size', 'modified', 'crc')
+PLAN_VERSION = '1'
 TSV_NULL_STR = '?'
+DIFF_TYPES = ('missing1', 'missing2', 'type', 'target', 'size', 'modified', 'crc')
 SURVEY_NULL_STR = '.'
 DEFAULT_CHUNK_SIZE = 1024**2
+DEFAULT_READAHEAD = 8*1024**2
+DEFAULT_PORT = 8537
+PIPELINE_BATCH = 512
+DEFAULT_BLOCK_SIZE = 4*1024**2
+GZIP_BLOCK_SIZE = 4*1024**2
+SURVEY_BATCH_LINES = 4096
+SPILL_CHUNK_SIZE = 65536
+STAT_CACHE_SIZE = 4096
+ARCHIVE_SUFFIXES = ('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz', '.zip')
+# The header id of the zip "extended timestamp" extra field.
+ZIP_EXTENDED_TIMESTAMP = 0x5455
+VERIFICATION_LEVELS = ('metadata', 'sample', 'incremental', 'full')
+DEFAULT_AUTO_SAMPLE = '1%'
+ESTIMATE_PROBES = 32
+ESTIMATE_DIR_SAMPLE = 16
+ESTIMATE_READ_FILES = 32
+ESTIMATE_READ_BYTES = 64*1024**2
+ESTIMATE_MIN_FIT_BYTES = 1024**2
+ESTIMATE_BUDGET_MARGIN = 1.5
+SURVEY_PREFETCH_LINES = 256*1024
+BLOCK_DIGEST_SIZE = 16
+# From linux/fs.h and linux/fiemap.h.
+FS_IOC_FIEMAP = 0xC020660B
+FIEMAP_HEADER = struct.Struct('=QQLLLL')
+FIEMAP_EXTENT = struct.Struct('=QQQQQLLLL')
+# From linux/inotify.h.
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+IN_DONT_FOLLOW = 0x2000000
+IN_ISDIR = 0x40000000
+INOTIFY_EVENT = struct.Struct('=iIII')
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+              IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW)
+WATCH_SETTLE = 0.5
 DESCRIPTION = """Check the differences between the contents of two directories."""
+SERVE_DESCRIPTION = """Serve metadata and checksums of a local directory to remote synctest2.py
+comparisons. Then give tcp://host:port/path as path1 or path2 on the other host, and the listing,
+stat, and hashing will all be done on this host, next to the data.
+Warning: There is no authentication or encryption. Only expose this on trusted networks."""
+APPLY_DESCRIPTION = """Execute a plan made with --plan, making dir2 match dir1. Files are copied in
+the kernel where possible (copy_file_range() or sendfile()), with their modified times preserved, and
+each copy is verified against the CRC-32 of the source."""
 
 
 def make_argparser():
@@ -22,13 +109,21 @@ def make_argparser():
   wrap = wrapper.wrap
   parser = argparse.ArgumentParser(description=DESCRIPTION,
                                    formatter_class=argparse.RawTextHelpFormatter)
-  parser.add_argument('path1', type=pathlib.Path,
+  parser.add_argument('path1', type=parse_path_arg,
     help=wrap('The first directory to compare. You can also give the path to a file of metadata '
       'produced by file-metadata.py, run on a directory or set of directories. In this case, '
       'though, either both surveys must have the same startpath or all the root paths must be '
-      'absolute.'))
-  parser.add_argument('path2', type=pathlib.Path, nargs='?',
-    help='The second directory to compare.')
+      'absolute. Or, give a directory on another host as tcp://host:port/path, where the host is '
+      'running "synctest2.py serve" (the path is relative to the root it\'s serving). Or, give a tar '
+      'or zip archive (.tar, .tar.gz, .tgz, .tar.bz2, .tar.xz, or .zip) to compare it to the '
+      'directory path2, without extracting it. The archive is read once, front to back. Each '
+      'member\'s path in path2 is stat\'ed as it\'s read, in the archive\'s order, which on a cold '
+      'cache can mean a seek per member. Then path2 is walked once more, to find what the archive '
+      'is missing.'))
+  parser.add_argument('path2', type=parse_path_arg, nargs='?',
+    help=wrap('The second directory to compare. If path1 is a survey, this can be a survey too, or '
+      'the live directory the survey was made of (its startpath). Then the directory is only '
+      'stat\'ed, and files are only read to verify the checksums in the survey (see --trust-mtime).'))
   parser.add_argument('-t', '--tsv', dest='format', action='store_const', const='tsv', default='human',
     help=wrap('Print in computer-readable tab-delimited format instead of human readable text. The '
          'output is one line per difference. The columns are:')+'\n'+
@@ -55,7 +150,52 @@ def make_argparser():
          '10. Same for dir2.\n'
          '11. Target of link in dir1.\n'
          '12. Same for dir2.', lspace=4, indent=-4)+'\n'+
+         wrap('When a directory that\'s missing from one side is reported as a single line instead '
+              'of listing its contents, that line has 4 more columns:')+'\n'+
+         wrap(
+         '13. Number of files in the directory in dir1.\n'
+         '14. Same for dir2.\n'
+         '15. Total size of those files in dir1.\n'
+         '16. Same for dir2.', lspace=4, indent=-4)+'\n'+
          wrap('For all columns, "?" means the value was not measured or is not applicable.'))
+  parser.add_argument('-P', '--plan', dest='format', action='store_const', const='plan',
+    help=wrap('Instead of listing the differences, print a plan of the actions needed to make dir2 '
+      'match dir1, which can be executed with "synctest2.py apply". The header lines give the '
+      'source and destination roots. Then each line is tab-delimited: the action ("delete", '
+      '"copy", "symlink", or "touch"), the relative path, and the type, size, modified time, and '
+      'crc32 of the path in dir1 (or in dir2, for "delete"). Copying a directory copies everything '
+      'in it.'))
+  parser.add_argument('-S', '--summary', dest='format', action='store_const', const='summary',
+    help=wrap('Instead of listing the differences, just count them. At the end, print the total, '
+      'the number of each type of difference, and the bytes involved in the differences under each '
+      'top-level directory (files directly in the root are counted under "."). When comparing '
+      'directories, the contents of a missing directory aren\'t read, so it counts as 0 bytes '
+      '(surveys do include them). The exit status is 2 if there were any differences, and 0 '
+      'otherwise.'))
+  parser.add_argument('-F', '--fail-fast', type=int, metavar='N',
+    help=wrap('Stop once N differences have been found. The exit status will be 2, as with '
+      '--summary.'))
+  parser.add_argument('-w', '--watch', action='store_true',
+    help=wrap('After comparing, keep watching both directories for changes (with inotify), and '
+      're-compare just the paths that change. Each difference is printed when it\'s found, and '
+      'again whenever it changes. When a difference goes away, it\'s printed again with the type '
+      '"equal". Runs until interrupted. Only for two local directories, on Linux.'))
+  parser.add_argument('--rescan-interval', type=parse_tolerance,
+    help=wrap('With --watch, also re-compare everything this often, in case changes were missed '
+      '(e.g. on network filesystems, or if there weren\'t enough inotify watches for every '
+      'directory). Everything is always re-compared if the inotify event queue overflows. Given '
+      'in the same format as --date-tolerance.'))
+  parser.add_argument('--trust-mtime', type=parse_tolerance, metavar='AGE',
+    help=wrap('When comparing a survey to a live directory, don\'t read files whose size and '
+      'modified time match the survey to verify their checksums, unless they were modified less '
+      'than AGE before the survey was made (by the survey file\'s modified time). Those are '
+      'ambiguous: they could have changed again after being surveyed, within the same second. '
+      'Given in the same format as --date-tolerance, e.g. "1h".'))
+  parser.add_argument('--strip-components', type=int, default=0, metavar='N',
+    help=wrap('When comparing an archive to a directory, remove the first N directories from the '
+      'paths in the archive, like tar\'s --strip-components. E.g. use 1 for an archive made with '
+      '"tar -czf backup.tgz data" to compare it to the directory "data". Members with N or fewer '
+      'directories in their paths are skipped.'))
   parser.add_argument('-d', '--ignore-dates', dest='date_tolerance', action='store_const',
     default=0, const=60*60*24*365*1000,  # 1000 years
     help=wrap('Ignore discrepancies between dates modified.'))
@@ -69,6 +209,54 @@ def make_argparser():
       'in bytes will still be checked, which will catch most changes in contents.'))
   parser.add_argument('-C', '--checksum-if-date-diff', dest='crc', action='store_const', const='date',
     help=wrap('Compare the checksums even if the date modifieds are different.'))
+  parser.add_argument('--time-budget', type=parse_tolerance,
+    help=wrap('Finish within this much time (given in the same format as --date-tolerance, e.g. '
+      '"4h"). All the metadata is compared first, without checksums. Then the rest of the time is '
+      'spent comparing the checksums of the files which are otherwise equal, in order of priority: '
+      'files never verified before (according to --verify-cache) first, then the ones verified '
+      'longest ago, and among those, the most recently modified (by day), then the largest. '
+      'Checksum differences are printed after all the others. Files which would be expected to '
+      'take longer than the time left are skipped. At the end, the files which weren\'t verified '
+      'are listed (see --unverified). Only for comparing directories.'))
+  parser.add_argument('--verify-cache', type=pathlib.Path,
+    help=wrap('With --time-budget, record when each pair of files was last verified to be equal in '
+      'this file, and use it to prioritize the files which have gone unverified the longest. It\'s '
+      'created if it doesn\'t exist. Entries only count while the files\' sizes and modified '
+      'times are unchanged.'))
+  parser.add_argument('--unverified', type=pathlib.Path,
+    help=wrap('With --time-budget, write the relative paths of the files which weren\'t verified to '
+      'this file, one per line, instead of logging each of them.'))
+  parser.add_argument('--verify-sample', type=parse_sample, metavar='P%|N',
+    help=wrap('Compare the metadata of every file, but only compare the checksums of a random '
+      'sample of the files which are otherwise equal: either a percentage of them (e.g. "1%%") or '
+      'a number of files (e.g. "1000"). The sample is stratified by size class (sizes within a '
+      'factor of 16) and top-level directory, so each is represented in proportion to its number '
+      'of files. At the end, the one-sided 95%% upper confidence bound on the fraction of the '
+      'files with differing contents is logged (the Clopper-Pearson bound). Only for comparing '
+      'directories.'))
+  parser.add_argument('--estimate', action='store_true',
+    help=wrap('Don\'t compare anything. Just estimate how long each strategy would take, and print '
+      'the estimates. The strategies are: "metadata" (--no-checksum), "sample" (--verify-sample, '
+      'with the size given, or 1%%), "cached" (--time-budget with --verify-cache, only if a '
+      '--verify-cache is given), "full" (the default), and "checksum-if-date-diff" (which also '
+      'hashes the files whose modified times differ). The estimate '
+      'comes from a quick sample of both directories: a few random paths from the root down to a '
+      'leaf directory, comparing some of the files in each directory, and then hashing some of '
+      'those files to measure the read rate of each side. Files already in the page cache will '
+      'make the read rate optimistic. Only for comparing directories.'))
+  parser.add_argument('--auto', action='store_true',
+    help=wrap('Estimate how long each strategy would take, as with --estimate, then compare using '
+      'the fastest one which meets the --verification-level. The choice is logged.'))
+  parser.add_argument('--verification-level', choices=VERIFICATION_LEVELS, default='full',
+    help=wrap('For --auto, how thoroughly the files must be verified. "metadata": only the sizes '
+      'and modified times. "sample": the checksums of at least a random sample of the files. '
+      '"incremental": the checksum of every file has been compared in this run or an earlier one '
+      '(according to the --verify-cache). "full": the checksum of every file is compared in this '
+      'run. Default: %(default)s'))
+  parser.add_argument('--seed',
+    help=wrap('The seed for choosing the --verify-sample. The same seed picks the same files, as '
+      'long as they\'re still candidates. By default, a random seed is used, and logged. Also seeds '
+      'the sampling for --estimate and --auto.'))
   parser.add_argument('-1', '-a', '--ignore-dir1', action='store_true',
     help=wrap('Ignore files and directories missing from the first directory. When items are '
       'found to be missing from the first directory (according to the order in the arguments), do '
@@ -81,11 +269,138 @@ def make_argparser():
     help=wrap('Follow symbolic links while traversing the filesystem. This will not affect how '
       'links are treated when comparing paths. They will always be considered on their own, as a '
       'special file type, without reference to their targets.'))
+  parser.add_argument('-e', '--exclude', action='append', default=[],
+    help=wrap('Skip paths matching this glob. Excluded directories are not descended into at all. '
+      'If the glob contains no "/", it is matched against the name of each path. Otherwise it is '
+      'matched against the whole path, relative to the root of the comparison. Can be given '
+      'multiple times. This also applies to comparisons of surveys.'))
+  parser.add_argument('-E', '--exclude-regex', action='append', default=[],
+    help=wrap('Skip paths where this regular expression matches anywhere in the path (relative to '
+      'the root of the comparison). Can be given multiple times.'))
+  parser.add_argument('--exclude-from', type=pathlib.Path, action='append', default=[],
+    help=wrap('Read --exclude globs from this file, one per line. Blank lines and lines starting '
+      'with "#" are ignored.'))
+  parser.add_argument('-i', '--include', action='append', default=[],
+    help=wrap('Never skip paths matching this glob, even if they match an --exclude or '
+      '--exclude-regex. Same matching rules as --exclude. Note that a path inside an excluded '
+      'directory is still skipped, since the directory is never read.'))
+  parser.add_argument('-I', '--include-regex', action='append', default=[],
+    help=wrap('Like --include, but with a regular expression, like --exclude-regex.'))
+  parser.add_argument('-m', '--max-depth', type=int,
+    help=wrap('Only descend this many levels below the root of the comparison (path1 and path2, '
+      'or the --subtree if given). 1 means only compare the entries directly inside the root.'))
+  parser.add_argument('-s', '--subtree',
+    help=wrap('Only compare this subdirectory (or file), given as a path relative to path1 and '
+      'path2 (or the startpath of the surveys). Paths are still reported relative to path1 and '
+      'path2. For uncompressed surveys, this uses an index of the survey (created on the first use, '
+      'in a file next to the survey named with an extra ".idx" extension) so that only the lines '
+      'for the subtree are read.'))
   parser.add_argument('-X', '--die-on-error', action='store_true',
     help=wrap("Don't ignore errors that prevent obtaining an accurate result. Normally, if there's "
       "an issue accessing a path (permission issue, misc I/O issue), a warning will be logged and "
       'it will move on. If this option is set, that will be treated as a fatal error and the '
       'program will die.'))
+  parser.add_argument('-O', '--io-order', choices=('name', 'inode', 'extent'), default='name',
+    help=wrap('The order to read files in, when computing checksums. "name" reads them in the '
+      'order they\'re compared (sorted by name). "inode" reads all the files in a directory that '
+      'need checksums sorted by inode number, which is usually close to their order on disk. '
+      '"extent" sorts them by the physical location of their first block, as reported by the '
+      'FIEMAP ioctl (falling back to the inode number where that isn\'t supported). Both reduce '
+      'seeking on spinning disks. The results are still output in the usual order. '
+      'Default: %(default)s'))
+  parser.add_argument('--read-size', type=parse_size, default=DEFAULT_CHUNK_SIZE,
+    help=wrap('How much of a file to read at a time when computing checksums. Default: 1M'))
+  parser.add_argument('--readahead', type=lambda size_str: parse_size(size_str, allow_zero=True),
+    default=DEFAULT_READAHEAD,
+    help=wrap('When computing checksums, ask the kernel to start reading this far ahead of the '
+      'current position in the file (with posix_fadvise()). Larger values help keep disks busy '
+      'reading sequentially. Give 0 to leave readahead to the kernel. Default: 8M'))
+  parser.add_argument('--keep-cache', action='store_true',
+    help=wrap('Normally, the data read to compute checksums is dropped from the page cache as soon '
+      'as it\'s been used, so that comparing a large tree doesn\'t evict everything else from the '
+      'cache. Use this to leave it in the cache, e.g. if you\'re going to read the files again '
+      'soon.'))
+  parser.add_argument('--direct-io', action='store_true',
+    help=wrap('Bypass the page cache entirely when computing checksums, by opening files with '
+      'O_DIRECT. This avoids both polluting the cache and the cost of copying through it. On '
+      'filesystems which don\'t support it, files are read normally.'))
+  parser.add_argument('--no-sparse', dest='sparse', action='store_false', default=True,
+    help=wrap('Read the holes in sparse files when computing checksums. Normally, the holes are '
+      'found with SEEK_DATA/SEEK_HOLE and skipped (the checksum is the same either way).'))
+  parser.add_argument('-j', '--jobs', type=int, default=1,
+    help=wrap('How many files to hash at once, on each device. Files are grouped by the device '
+      'they\'re on, and each device gets its own pool of this many workers, so a slow disk on one '
+      'side doesn\'t hold up a fast one on the other. Default: %(default)s'))
+  parser.add_argument('--device-jobs', type=parse_device_jobs, action='append', default=[],
+    metavar='MOUNT=N',
+    help=wrap('How many files to hash at once on the device containing MOUNT, overriding --jobs. '
+      'E.g. "--device-jobs /mnt/backup=1 --jobs 8" to hash one file at a time on a spinning disk, '
+      'and 8 at a time elsewhere. Can be given multiple times.'))
+  parser.add_argument('--spill-threshold', type=int,
+    help=wrap('Keep memory use bounded for huge directories: once a directory is found to have '
+      'more than this many files, their names are sorted in runs written to temporary files (in '
+      '$TMPDIR), which are merged as they\'re read back, and the two sides are compared a chunk at '
+      'a time. Subdirectory names are still kept in memory. Only affects local directories. '
+      'E.g. 1000000.'))
+  add_limit_args(parser, wrap)
+  parser.add_argument('-B', '--block-map', type=argparse.FileType('w', errors='surrogateescape'),
+    help=wrap('For large files that differ in size or checksum, hash both files block by block and '
+      'write a map of which byte ranges differ to this file. Each line is tab-delimited: the '
+      'relative path, the chunking method, the block size, the sizes of the file in dir1 and dir2, '
+      'and then the ranges of the file in dir1 which are not found in the file in dir2. The ranges '
+      'are comma-delimited, each given as start-end byte offsets (end exclusive). With --chunking '
+      'fixed, copying those ranges from dir1 into dir2 at the same offsets, then truncating to the '
+      'dir1 size, will make the files equal. With --chunking content, the rest of the dir1 file is '
+      'somewhere in the dir2 file, but not necessarily at the same offsets, so the ranges are only '
+      'the data which would have to be transferred. Only works for local directories.'))
+  parser.add_argument('--block-map-min', type=parse_size, default=parse_size('64M'),
+    help=wrap('Only make block maps for files at least this big. Default: 64M'))
+  parser.add_argument('--block-size', type=parse_size, default=DEFAULT_BLOCK_SIZE,
+    help=wrap('Block size for --block-map. For --chunking content, this is the average chunk size. '
+      'Sizes can be given with units like "4M" or "512k". Default: 4M'))
+  parser.add_argument('--chunking', choices=('fixed', 'content'), default='fixed',
+    help=wrap('How to divide files into blocks for --block-map. "fixed" uses fixed-size blocks at '
+      'the same offsets in both files. "content" uses content-defined chunks, with boundaries '
+      'chosen by a rolling hash, so that data which was only shifted by an insertion or deletion '
+      'is still found. It is slower to compute. Default: %(default)s'))
+  parser.add_argument('--block-cache', type=pathlib.Path,
+    help=wrap('Cache the block hashes for --block-map in this directory, so repeated runs on the '
+      'same (unchanged) files don\'t have to read them again.'))
+  parser.add_argument('-k', '--checkpoint', type=pathlib.Path,
+    help=wrap('Record the progress of the comparison in this file, so that if it gets interrupted, '
+      'it can be continued with --resume. It records which directories have been finished, which '
+      'differences have been printed, and the checksums computed for the directory in progress. '
+      'The file is deleted when the comparison finishes. Only for comparing directories.'))
+  parser.add_argument('-r', '--resume', action='store_true',
+    help=wrap('Continue the comparison recorded in the --checkpoint file, skipping all the work '
+      'already done. Only differences which haven\'t already been printed will be printed, so the '
+      'output can be appended to the output of the interrupted run (e.g. with ">>"). If stdout is '
+      'a regular file, any output from the interrupted run after the last recorded difference is '
+      'truncated first, so nothing is duplicated. Otherwise, up to one line may be.'))
+  parser.add_argument('--checkpoint-interval', type=parse_tolerance, default=60,
+    help=wrap('How often to compact the --checkpoint file and sync it to disk. Given in the same '
+      'format as --date-tolerance. Default: 60s'))
+  parser.add_argument('--duplicates', type=pathlib.Path, metavar='FILE',
+    help=wrap('While comparing, also find the files with the same contents, within and across the '
+      'two directories, and write them to this file at the end. Only files which share a size with '
+      'another are hashed, and checksums from the comparison are reused. A file which is equal in '
+      'both directories counts as one. The header lines give the number of groups of duplicates '
+      'and the total bytes which could be reclaimed by keeping only one copy in each directory. '
+      'Then each line is tab-delimited: the group number, the size and crc32 of the files, whether '
+      'the group was confirmed ("yes" or "no"), which directory the file is in ("1", "2", or '
+      '"both"), and its relative path. Files with the same crc32 are confirmed to be duplicates '
+      'by reading them again and comparing a stronger hash (BLAKE2b). Files on a remote host '
+      'can\'t be, so groups with those are only candidates, and their bytes are counted separately '
+      'in the header. Groups with the most to reclaim come first. Empty files are ignored. Only '
+      'for comparing directories, and not the contents of missing directories.'))
+  parser.add_argument('--metrics-file', type=pathlib.Path,
+    help=wrap('Write statistics about the run to this file, in the Prometheus text format (e.g. '
+      'for node_exporter\'s textfile collector): the differences by type, the files and bytes '
+      'compared and hashed, how long each phase took, the hashing throughput, and the number of '
+      'errors logged. The file is replaced atomically at the end of the run.'))
+  parser.add_argument('--metrics-interval', type=parse_tolerance,
+    help=wrap('Also update the --metrics-file this often during the run. Given in the same format '
+      'as --date-tolerance.'))
   #TODO:
   # parser.add_argument('-p', '--print-all', action='store_true', default=False,
   #   help='Print all the files in the directory to stdout, including the full path, size, date '
@@ -108,8 +423,106 @@ def make_argparser():
   return parser
 
 
+def make_apply_argparser():
+  parser = argparse.ArgumentParser(prog='synctest2.py apply', description=APPLY_DESCRIPTION)
+  parser.add_argument('plan', type=pathlib.Path,
+    help="The plan file output by --plan. Give '-' to read from stdin.")
+  parser.add_argument('--src', type=pathlib.Path,
+    help='Use this as the source directory instead of the one in the plan.')
+  parser.add_argument('--dst', type=pathlib.Path,
+    help='Use this as the destination directory instead of the one in the plan.')
+  parser.add_argument('-j', '--jobs', type=int, default=4,
+    help='How many files to copy at once. Default: %(default)s')
+  parser.add_argument('-V', '--no-verify', dest='verify', action='store_false', default=True,
+    help="Don't verify the CRC-32 of each copy.")
+  parser.add_argument('-n', '--dry-run', action='store_true',
+    help='Just print the actions that would be taken.')
+  parser.add_argument('-l', '--log', type=argparse.FileType('w'), default=sys.stderr,
+    help='Print log messages to this file instead of to stderr.')
+  volume = parser.add_mutually_exclusive_group()
+  volume.add_argument('-q', '--quiet', dest='volume', action='store_const', const=logging.CRITICAL,
+    default=logging.WARNING)
+  volume.add_argument('-v', '--verbose', dest='volume', action='store_const', const=logging.INFO)
+  volume.add_argument('--debug', dest='volume', action='store_const', const=logging.DEBUG)
+  return parser
+
+
+def make_serve_argparser():
+  parser = argparse.ArgumentParser(prog='synctest2.py serve', description=SERVE_DESCRIPTION)
+  parser.add_argument('root', type=pathlib.Path,
+    help='The directory to serve. Clients can access any path under it.')
+  parser.add_argument('-H', '--host', default='127.0.0.1',
+    help='The address to listen on. Default: %(default)s')
+  parser.add_argument('-p', '--port', type=int, default=DEFAULT_PORT,
+    help='The port to listen on. Default: %(default)s')
+  add_limit_args(parser)
+  parser.add_argument('-l', '--log', type=argparse.FileType('w'), default=sys.stderr,
+    help='Print log messages to this file instead of to stderr.')
+  volume = parser.add_mutually_exclusive_group()
+  volume.add_argument('-q', '--quiet', dest='volume', action='store_const', const=logging.CRITICAL,
+    default=logging.WARNING)
+  volume.add_argument('-v', '--verbose', dest='volume', action='store_const', const=logging.INFO)
+  volume.add_argument('--debug', dest='volume', action='store_const', const=logging.DEBUG)
+  return parser
+
+
+def add_limit_args(parser, wrap=str):
+  """Add the options for limiting the load on the storage. `wrap` formats the help text."""
+  parser.add_argument('--max-read-rate', type=float,
+    help=wrap('Read at most this many MB (1024**2 bytes) per second when computing checksums, in '
+      'total. Useful for running on storage that\'s in use.'))
+  parser.add_argument('--max-stat-rate', type=float,
+    help=wrap('Do at most this many stats (and directory listings) per second.'))
+  parser.add_argument('--target-latency', type=float,
+    help=wrap('Adapt the read rate to the load on the storage: when reads take longer than this '
+      'many milliseconds on average, halve the rate, and otherwise increase it gradually, up to '
+      '--max-read-rate. Requires --max-read-rate.'))
+
+
+def make_local_tree(args):
+  read_policy, stat_limiter = make_limits(args)
+  return LocalTree(io_order=args.io_order, read_size=args.read_size, read_policy=read_policy,
+                   stat_limiter=stat_limiter, jobs=args.jobs,
+                   device_jobs=get_device_jobs(args.device_jobs),
+                   spill_threshold=args.spill_threshold)
+
+
+def make_limits(args):
+  """Make the `ReadPolicy` and stat `TokenBucket` for the options from `add_limit_args()` (and for
+  the main command, the read options)."""
+  read_limiter = stat_limiter = None
+  if args.target_latency is not None and args.max_read_rate is None:
+    fail('Error: --target-latency requires --max-read-rate.')
+  for rate in args.max_read_rate, args.max_stat_rate:
+    if rate is not None and rate <= 0:
+      fail(f'Error: Rate limits must be positive (got {rate}).')
+  if args.max_read_rate is not None:
+    target_latency = None
+    if args.target_latency is not None:
+      target_latency = args.target_latency/1000
+    read_limiter = TokenBucket(args.max_read_rate*1024**2, target_latency=target_latency)
+  if args.max_stat_rate is not None:
+    stat_limiter = TokenBucket(args.max_stat_rate)
+  read_policy = ReadPolicy(
+    readahead=getattr(args, 'readahead', DEFAULT_READAHEAD),
+    keep_cache=getattr(args, 'keep_cache', False), direct=getattr(args, 'direct_io', False),
+    limiter=read_limiter, sparse=getattr(args, 'sparse', True)
+  )
+  return read_policy, stat_limiter
+
+
 def main(argv):
 
+  # Filenames that aren't valid in the filesystem encoding are decoded with surrogate escapes. Write
+  # them out as the original bytes instead of crashing.
+  if hasattr(sys.stdout, 'reconfigure'):
+    sys.stdout.reconfigure(errors='surrogateescape')
+
+  if len(argv) > 1 and argv[1] == 'serve':
+    return serve_main(argv[2:])
+  elif len(argv) > 1 and argv[1] == 'apply':
+    return apply_main(argv[2:])
+
   parser = make_argparser()
   args = parser.parse_args(argv[1:])
 
@@ -119,6 +532,15 @@ def main(argv):
     fail('Error: Two positional arguments are required (path1 and path2).')
   if args.convert_tsv and args.format != 'human':
     fail('Error: --convert-tsv only works with human-readable output format.')
+  if args.format == 'plan' and not all(isinstance(path, pathlib.Path) and path.is_dir()
+                                       for path in (args.path1, args.path2)):
+    fail('Error: --plan only works when comparing two local directories.')
+  if args.max_depth is not None and args.max_depth < 1:
+    fail('Error: --max-depth must be at least 1.')
+  if args.resume and not args.checkpoint:
+    fail('Error: --resume requires --checkpoint.')
+  if args.subtree is not None:
+    args.subtree = normalize_subtree(args.subtree)
 
   if args.convert_tsv:
     for line in convert_tsv(args.path1):
@@ -127,35 +549,298 @@ def main(argv):
 
   path_type = check_path_args(args.path1, args.path2)
 
+  if args.jobs < 1:
+    fail('Error: --jobs must be at least 1.')
+  if args.spill_threshold is not None and args.spill_threshold < 1:
+    fail('Error: --spill-threshold must be at least 1.')
+
+  if args.fail_fast is not None and args.fail_fast < 1:
+    fail('Error: --fail-fast must be at least 1.')
+  if args.trust_mtime is not None and path_type != 'mixed':
+    fail('Error: --trust-mtime only works when comparing a survey to a directory.')
+  if args.strip_components and path_type != 'archive':
+    fail('Error: --strip-components only works when comparing an archive to a directory.')
+  if args.strip_components < 0:
+    fail('Error: --strip-components can\'t be negative.')
+  if args.metrics_interval is not None and not args.metrics_file:
+    fail('Error: --metrics-interval requires --metrics-file.')
+  if args.estimate or args.auto:
+    if path_type != 'dir' or args.watch:
+      fail('Error: --estimate and --auto only work when comparing directories (without --watch).')
+    if args.auto:
+      for option, value in (('--no-checksum or --checksum-if-date-diff', args.crc != 'last' or None),
+                            ('--time-budget', args.time_budget), ('--checkpoint', args.checkpoint),
+                            ('--estimate', args.estimate or None)):
+        if value is not None:
+          fail(f'Error: --auto can\'t be used with {option}.')
+  elif args.verification_level != 'full':
+    fail('Error: --verification-level requires --auto.')
+  if args.watch:
+    if path_type != 'dir' or isinstance(args.path1, RemoteURL) or isinstance(args.path2, RemoteURL):
+      fail('Error: --watch only works when comparing two local directories.')
+    if args.format not in ('human', 'tsv'):
+      fail('Error: --watch only works with the human-readable or tsv output formats.')
+    for option, value in (('--checkpoint', args.checkpoint), ('--subtree', args.subtree),
+                          ('--max-depth', args.max_depth), ('--time-budget', args.time_budget),
+                          ('--verify-sample', args.verify_sample)):
+      if value is not None:
+        fail(f'Error: --watch can\'t be used with {option}.')
+    # Differences have to come out as they're found, not when the buffer fills.
+    sys.stdout.reconfigure(line_buffering=True)
+  elif args.rescan_interval is not None:
+    fail('Error: --rescan-interval requires --watch.')
+  if args.duplicates:
+    if path_type != 'dir':
+      fail('Error: --duplicates only works when comparing directories.')
+    for option, value in (('--watch', args.watch or None), ('--checkpoint', args.checkpoint),
+                          ('--time-budget', args.time_budget),
+                          ('--verify-sample', args.verify_sample)):
+      if value is not None:
+        fail(f'Error: --duplicates can\'t be used with {option}.')
+
+  path_filter = make_path_filter(args)
+
+  if args.estimate or args.auto:
+    estimate, predictions = plan_strategy(args, path_filter)
+    if args.estimate:
+      for line in format_estimate(estimate, predictions):
+        print(line)
+      return 0
+    apply_strategy(args, predictions)
+
+  deadline = None
+  if args.time_budget is not None:
+    deadline = time.monotonic() + args.time_budget
+  elif args.verify_cache or args.unverified:
+    fail('Error: --verify-cache and --unverified only work with --time-budget.')
+  deferred_hashing = args.time_budget is not None or args.verify_sample is not None
+  if deferred_hashing:
+    if path_type != 'dir':
+      fail('Error: --time-budget and --verify-sample only work when comparing directories.')
+    if args.crc != 'last':
+      fail('Error: --time-budget and --verify-sample can\'t be used with --no-checksum or '
+           '--checksum-if-date-diff.')
+    if args.checkpoint:
+      fail('Error: --time-budget and --verify-sample can\'t be used with --checkpoint.')
+
+  metrics = None
+  if args.metrics_file:
+    metrics = Metrics(args.metrics_file, format_path_arg(args.path1), format_path_arg(args.path2),
+                      interval=args.metrics_interval)
+    metrics.count_errors()
+
+  duplicates = None
+  checkpoint = None
+  if args.checkpoint:
+    if path_type != 'dir':
+      fail('Error: --checkpoint only works when comparing directories.')
+    checkpoint = Checkpoint(args.checkpoint, resume=args.resume, interval=args.checkpoint_interval,
+                            output=sys.stdout)
+
   if path_type == 'file':
-    survey1, meta1 = read_survey(args.path1)
-    diff_generator = compare_surveys(survey1, args.path2, meta1)
+    survey2_lines = read_survey_lines(args.path2, subtree=args.subtree)
+    if get_cpu_count() > 1:
+      # Read ahead survey2's raw lines in the background while survey1 is loaded. This only overlaps
+      # the reading (and decompression): the lines are still parsed on this thread, in
+      # `compare_surveys()`, since parsing them in another thread would just contend for the GIL.
+      survey2_lines = BackgroundIterator(
+        survey2_lines, batch_size=SURVEY_BATCH_LINES,
+        max_batches=SURVEY_PREFETCH_LINES//SURVEY_BATCH_LINES, name='survey2'
+      )
+    survey1, meta1 = read_survey(
+      args.path1, path_filter=path_filter, max_depth=args.max_depth, subtree=args.subtree
+    )
+    diff_generator = compare_surveys(
+      survey1, survey2_lines, meta1, path_filter=path_filter, max_depth=args.max_depth,
+      subtree=args.subtree
+    )
+    if metrics:
+      diff_generator = metrics.time_phase('compare', diff_generator)
     root1 = root2 = meta1['startpath']
-  elif path_type == 'dir':
-    diff_generator = recursive_compare(
-      args.path1, args.path2, args.ignore_dir1, args.ignore_dir2, crc=args.crc,
-      date_tolerance=args.date_tolerance, follow_links=args.follow_links,
-      die_on_error=args.die_on_error
+  elif path_type == 'mixed':
+    survey1, meta1 = read_survey(
+      args.path1, path_filter=path_filter, max_depth=args.max_depth, subtree=args.subtree
+    )
+    root1 = meta1['startpath']
+    tree2, root2 = open_tree(args.path2, make_local_tree(args))
+    check_tree_root(tree2, root2)
+    if metrics:
+      tree2 = MeteredTree(tree2, metrics)
+    trust_before = None
+    if args.trust_mtime is not None:
+      trust_before = args.path1.stat().st_mtime - args.trust_mtime
+    diff_generator = compare_survey_to_tree(
+      survey1, meta1, root2, tree2, args.ignore_dir1, args.ignore_dir2, crc=args.crc,
+      date_tolerance=args.date_tolerance, trust_before=trust_before, follow_links=args.follow_links,
+      die_on_error=args.die_on_error, path_filter=path_filter, max_depth=args.max_depth,
+      subtree=args.subtree
     )
+    if metrics:
+      diff_generator = metrics.time_phase('compare', diff_generator)
+  elif path_type == 'archive':
     root1 = args.path1
-    root2 = args.path2
+    tree2, root2 = open_tree(args.path2, make_local_tree(args))
+    check_tree_root(tree2, root2)
+    if metrics:
+      tree2 = MeteredTree(tree2, metrics)
+    diff_generator = compare_archive_to_tree(
+      args.path1, root2, tree2, args.ignore_dir1, args.ignore_dir2, crc=args.crc,
+      date_tolerance=args.date_tolerance, strip_components=args.strip_components,
+      follow_links=args.follow_links, die_on_error=args.die_on_error, path_filter=path_filter,
+      max_depth=args.max_depth, subtree=args.subtree
+    )
+    if metrics:
+      diff_generator = metrics.time_phase('compare', diff_generator)
+  elif path_type == 'dir':
+    local_tree = make_local_tree(args)
+    tree1, root1 = open_tree(args.path1, local_tree)
+    tree2, root2 = open_tree(args.path2, local_tree)
+    for tree, root in (tree1, root1), (tree2, root2):
+      check_tree_root(tree, root)
+    if args.subtree is not None and all(get_root_type(tree, root/args.subtree) == 'nonexistent'
+                                        for tree, root in ((tree1, root1), (tree2, root2))):
+      fail(f'Error: --subtree path exists on neither side ({str(root1/args.subtree)!r} or '
+           f'{str(root2/args.subtree)!r}).')
+    if metrics:
+      # Keep a shared tree shared, so its files can still be hashed in one batch.
+      metered1 = MeteredTree(tree1, metrics)
+      tree2 = metered1 if tree2 is tree1 else MeteredTree(tree2, metrics)
+      tree1 = metered1
+    if checkpoint:
+      tree1 = CheckpointedTree(tree1, checkpoint)
+      tree2 = CheckpointedTree(tree2, checkpoint)
+    if args.watch:
+      diff_generator = watch_compare(
+        root1, root2, args.ignore_dir1, args.ignore_dir2, crc=args.crc,
+        date_tolerance=args.date_tolerance, follow_links=args.follow_links,
+        die_on_error=args.die_on_error, path_filter=path_filter, tree1=tree1, tree2=tree2,
+        metrics=metrics, rescan_interval=args.rescan_interval
+      )
+      if metrics:
+        diff_generator = metrics.time_phase('compare', diff_generator)
+    elif not deferred_hashing:
+      if args.duplicates:
+        names = (format_path_arg(args.path1), format_path_arg(args.path2))
+        duplicates = DuplicateIndex(root1, root2, tree1, tree2, names=names)
+      diff_generator = recursive_compare(
+        root1, root2, args.ignore_dir1, args.ignore_dir2, crc=args.crc,
+        date_tolerance=args.date_tolerance, follow_links=args.follow_links,
+        die_on_error=args.die_on_error, path_filter=path_filter, max_depth=args.max_depth,
+        subtree=args.subtree, tree1=tree1, tree2=tree2, checkpoint=checkpoint, metrics=metrics,
+        duplicates=duplicates
+      )
+      if metrics:
+        diff_generator = metrics.time_phase('compare', diff_generator)
+    else:
+      # Compare the metadata of everything first, then hash the candidates it finds.
+      candidates = CandidateFiles(root1, root2)
+      verify_cache = None
+      if args.verify_cache:
+        verify_cache = VerifyCache(args.verify_cache)
+      hash_args = dict(
+        deadline=deadline, cache=verify_cache, unverified_path=args.unverified,
+        batch_size=2*args.jobs, die_on_error=args.die_on_error
+      )
+      if args.verify_sample is None:
+        hasher = hash_candidates(candidates, tree1, tree2, **hash_args)
+      else:
+        hasher = verify_sample(candidates, tree1, tree2, args.verify_sample, args.seed,
+                               **hash_args)
+      comparer = recursive_compare(
+        root1, root2, args.ignore_dir1, args.ignore_dir2, crc='none',
+        date_tolerance=args.date_tolerance, follow_links=args.follow_links,
+        die_on_error=args.die_on_error, path_filter=path_filter, max_depth=args.max_depth,
+        subtree=args.subtree, tree1=tree1, tree2=tree2, candidates=candidates, metrics=metrics
+      )
+      if metrics:
+        comparer = metrics.time_phase('compare', comparer)
+        hasher = metrics.time_phase('hash', hasher)
+      # A generator, not `itertools.chain()`, so that --fail-fast can close it.
+      diff_generator = (diff for part in (comparer, hasher) for diff in part)
+
+  block_mapper = None
+  if args.block_map:
+    if path_type == 'dir' and tree1.is_local and tree2.is_local:
+      block_mapper = BlockMapper(args.block_size, args.chunking, args.block_cache,
+                                 read_policy=local_tree.read_policy)
+    else:
+      logging.warning('Warning: --block-map only works with two local directories. Ignoring.')
+
+  if args.format == 'plan':
+    print(format_plan_header(root1, root2))
+
+  summary = None
+  if args.format == 'summary':
+    summary = DiffSummary(root1, root2)
 
   total_diffs = 0
-  for diff_type, path_type, diff1, diff2 in diff_generator:
-    total_diffs += 1
-    if args.format == 'tsv':
-      print(format_tsv(root1, root2, diff_type, path_type, diff1, diff2))
-    elif args.format == 'human':
-      print(format_human(diff_type, path_type, diff1, diff2))
+  if checkpoint:
+    total_diffs = checkpoint.total_diffs
+  stopped = False
+  finished = False
+  try:
+    for diff in diff_generator:
+      total_diffs += 1
+      if metrics:
+        metrics.add_diff(diff)
+      if summary:
+        summary.add(diff)
+      elif args.format == 'tsv':
+        print(format_tsv(root1, root2, diff))
+      elif args.format == 'human':
+        print(format_human(diff))
+      elif args.format == 'plan':
+        for line in format_plan(root1, root2, diff):
+          print(line)
+      if (block_mapper and diff.diff_type in ('size', 'crc') and diff.path_type == 'file' and
+          max(diff.diff1.size, diff.diff2.size) >= args.block_map_min):
+        try:
+          ranges = block_mapper.map(diff.diff1.path, diff.diff2.path)
+        except OSError as error:
+          if args.die_on_error:
+            raise
+          logging.error(f'Error: {error}')
+        else:
+          rel_path = remove_root(root1, diff.diff1.path)
+          print(rel_path, args.chunking, args.block_size, diff.diff1.size, diff.diff2.size,
+                format_ranges(ranges), sep='\t', file=args.block_map)
+      if args.fail_fast is not None and total_diffs >= args.fail_fast:
+        stopped = True
+        diff_generator.close()
+        break
+    if duplicates is not None:
+      if stopped:
+        logging.warning('Warning: Stopped early, so not writing --duplicates.')
+      else:
+        duplicates.write(args.duplicates, die_on_error=args.die_on_error)
+    finished = True
+  finally:
+    # Still write the metrics if the run died, with it marked unfinished.
+    if metrics:
+      metrics.write(finished=finished, stopped=stopped)
 
   if args.format == 'human' and total_diffs == 0:
     print('They\'re equal!')
+  elif summary:
+    for line in summary.format(stopped):
+      print(line)
+
+  # If it stopped early, leave the checkpoint so the comparison can be resumed.
+  if checkpoint and not stopped:
+    checkpoint.finish()
+
+  if total_diffs and (summary or args.fail_fast is not None):
+    return 2
 
 
 def check_path_args(*paths):
   failed = False
   path_types = []
   for path in paths:
+    if isinstance(path, RemoteURL):
+      # Whether it exists will be found out once we connect.
+      path_types.append('dir')
+      continue
     path_type = get_path_type(path, followlinks=True)
     # A fifo could be a process substitution argument that we can read like a file.
     # Proceed like it's a regular file until proven otherwise.
@@ -171,16 +856,48 @@ def check_path_args(*paths):
       failed = True
   if failed:
     fail()
+  if path_types == ['file', 'dir']:
+    # A survey or archive, and the live directory to compare it to.
+    if is_archive_path(paths[0]):
+      return 'archive'
+    return 'mixed'
+  if path_types == ['file', 'file'] and any(is_archive_path(path) for path in paths):
+    fail('Error: Archives can only be compared to a directory (given as path2).')
   if path_types[0] != path_types[1]:
-    fail('Error: Both arguments must be directories, or both must be files.\n'
+    fail('Error: Both arguments must be directories, or both must be files (surveys), or path1 '
+         'must be a survey or archive and path2 a directory.\n'
          'Found a {} and {} instead.'.format(path_types[0], path_types[1]))
   return path_types[0]
 
 
 def recursive_compare(root1, root2, ignore1, ignore2, crc='last', date_tolerance=0,
-                      follow_links=False, die_on_error=False):
-  walker1 = os.walk(root1, followlinks=follow_links, onerror=log_error)
-  walker2 = os.walk(root2, followlinks=follow_links, onerror=log_error)
+                      follow_links=False, die_on_error=False, path_filter=None, max_depth=None,
+                      subtree=None, tree1=None, tree2=None, checkpoint=None, candidates=None,
+                      metrics=None, duplicates=None):
+  """Walk two directory trees in parallel and yield the differences between them.
+  `tree1` and `tree2` are the objects used to access each tree (`LOCAL_TREE` by default, or a
+  `RemoteTree`). If a `Checkpoint` is given, progress is recorded in it, and any work it says was
+  already done is skipped. If `candidates` (a `CandidateFiles`) is given, the files which were found
+  equal are added to it (useful with `crc='none'`, to hash them later). Each pair of paths compared
+  is counted in the `Metrics`, if given, and the files are added to the `DuplicateIndex`, if given.
+  Internally, paths are plain strings built from each directory's prefix. They're only converted to
+  `pathlib.Path`s in the `Diff`s that are yielded."""
+  tree1 = tree1 or LOCAL_TREE
+  tree2 = tree2 or LOCAL_TREE
+  start1 = root1
+  start2 = root2
+  if subtree is not None:
+    start1 = root1/subtree
+    start2 = root2/subtree
+    # If the subtree isn't a directory on both sides, there's nothing to walk.
+    if get_root_type(tree1, start1) != 'dir' or get_root_type(tree2, start2) != 'dir':
+      yield from compare_subtree_roots(start1, start2, ignore1, ignore2, crc=crc,
+                                       date_tolerance=date_tolerance, tree1=tree1, tree2=tree2,
+                                       candidates=candidates)
+      return
+  walker1 = tree1.walk(start1, followlinks=follow_links, onerror=log_error)
+  walker2 = tree2.walk(start2, followlinks=follow_links, onerror=log_error)
+  prefetch = crc != 'none' and (tree1.batched or tree2.batched)
   first_loop = True
   while True:
     # Iterate the walkers.
@@ -204,31 +921,90 @@ def recursive_compare(root1, root2, ignore1, ignore2, crc='last', date_tolerance
     # the walkers so they're equal. This affects the walkers' traversal to keep them in sync.
     dir1 = walker_paths1[0]
     dir2 = walker_paths2[0]
-    paths1, paths2, missing1, missing2 = sync_up_walker_paths(walker_paths1, walker_paths2)
+    prefix1 = get_dir_prefix(dir1)
+    prefix2 = get_dir_prefix(dir2)
+    # Prune excluded paths before the walkers see the dirnames, so they never descend into them.
+    if path_filter is not None or max_depth is not None or checkpoint is not None:
+      rel_dir = get_rel_dir(root1, dir1)
+    if path_filter is not None:
+      filter_walker_paths(path_filter, rel_dir, walker_paths1)
+      filter_walker_paths(path_filter, rel_dir, walker_paths2)
+    # Directories with too many files to hold in memory have their filenames in `SpilledNames`.
+    spilled = (isinstance(walker_paths1[2], SpilledNames) or
+               isinstance(walker_paths2[2], SpilledNames))
+    if spilled:
+      path_chunks, missing1, missing2 = sync_up_spilled_walker_paths(walker_paths1, walker_paths2)
+    else:
+      names1, names2, missing1, missing2 = sync_up_walker_paths(walker_paths1, walker_paths2)
+      path_chunks = ((names1, names2),)
+    # At the maximum depth, still compare the directories here, but don't let the walkers descend.
+    if max_depth is not None and get_rel_depth(rel_dir) - get_rel_depth(subtree) + 1 >= max_depth:
+      walker_paths1[1].clear()
+      walker_paths2[1].clear()
+    # When resuming, skip subtrees and directories that were already finished.
+    if checkpoint is not None:
+      rel_parts = tuple(rel_dir.split('/')) if rel_dir else ()
+      for dirnames in walker_paths1[1], walker_paths2[1]:
+        dirnames[:] = [dirname for dirname in dirnames
+                       if not checkpoint.is_subtree_done(rel_parts+(dirname,))]
+      if checkpoint.is_done(rel_parts):
+        continue
     # Check for missing files/directories.
-    for diff in get_missings(missing1, missing2, ignore1, ignore2):
-      yield diff
-    # Compare each path.
-    for path1, path2 in zip(paths1, paths2):
-      try:
-        result = compare_paths(dir1/path1, dir2/path2, date_tolerance=date_tolerance, crc=crc)
-        if result[0] != 'equal':
-          yield result
-      except IOError as error:
-        if die_on_error:
-          raise
-        else:
-          logging.error('Error: {}'.format(error))
+    for i, diff in enumerate(get_missings(missing1, missing2, ignore1, ignore2, tree1=tree1,
+                                          tree2=tree2)):
+      if duplicates is not None:
+        duplicates.add(diff)
+      if checkpoint is None:
+        yield pathize(diff)
+      else:
+        yield from checkpoint.emit(pathize(diff))
+      if spilled and i % SPILL_CHUNK_SIZE == SPILL_CHUNK_SIZE-1:
+        forget_cached(tree1, tree2)
+    # Spilled directories are compared a chunk at a time.
+    for names1, names2 in path_chunks:
+      # Let trees that work better in batches (remote ones) hash everything they'll need at once.
+      if prefetch:
+        prefetch_crcs(prefix1, prefix2, names1, names2, tree1, tree2, crc=crc,
+                      date_tolerance=date_tolerance)
+      # Compare each path.
+      for name1, name2 in zip(names1, names2):
+        try:
+          result = compare_paths(prefix1+name1, prefix2+name2, date_tolerance=date_tolerance,
+                                 crc=crc, tree1=tree1, tree2=tree2)
+          if metrics is not None:
+            metrics.add_compared(result)
+          if duplicates is not None:
+            duplicates.add(result)
+          if result.diff_type != 'equal':
+            if checkpoint is None:
+              yield pathize(result)
+            else:
+              yield from checkpoint.emit(pathize(result))
+          elif candidates is not None and result.path_type == 'file':
+            candidates.append(result)
+        except IOError as error:
+          if die_on_error:
+            raise
+          else:
+            logging.error('Error: {}'.format(error))
+      if spilled:
+        forget_cached(tree1, tree2)
+    if spilled:
+      for names in walker_paths1[2], walker_paths2[2]:
+        if isinstance(names, SpilledNames):
+          names.close()
+    if checkpoint is not None:
+      checkpoint.record_done(rel_parts)
 
 
 def step_walkers(walker1, walker2, first_loop):
   try:
-    dir1, dirnames1, filenames1 = pathize(next(walker1))
+    dir1, dirnames1, filenames1 = next(walker1)
     done1 = False
   except StopIteration:
     done1 = True
   try:
-    dir2, dirnames2, filenames2 = pathize(next(walker2))
+    dir2, dirnames2, filenames2 = next(walker2)
     done2 = False
   except StopIteration:
     done2 = True
@@ -241,9 +1017,9 @@ def step_walkers(walker1, walker2, first_loop):
   # Check if the walkers have gotten out of sync.
   #TODO: This only checks the last element of the paths, so it can false negative if there are
   #      directories with the same name in different parent directories.
-  if dir1.name != dir2.name and not first_loop:
+  if posixpath.basename(dir1) != posixpath.basename(dir2) and not first_loop:
     raise SyncError('Comparison got unsynced. Directories are different:\n  {!r}\n  {!r}.'
-                    .format(str(dir1), str(dir2)))
+                    .format(dir1, dir2))
   return (dir1, dirnames1, filenames1), (dir2, dirnames2, filenames2)
 
 
@@ -256,103 +1032,551 @@ def sync_up_walker_paths(walker_paths1, walker_paths2):
   filenames1.sort()
   filenames2.sort()
   missing_files1, missing_files2 = matchup(filenames1, filenames2)
-  missing1 = [dir1/missing for missing in missing_dirs1 + missing_files1]
-  missing2 = [dir2/missing for missing in missing_dirs2 + missing_files2]
-  paths1 = dirnames1 + filenames1
-  paths2 = dirnames2 + filenames2
-  return paths1, paths2, missing1, missing2
-
-
-def pathize(args):
-  """Convert the string output of `os.walk()` to  `pathlib.Path`s.
-  This alters the list arguments."""
-  dirstr, dirnames, filenames = args
-  dirpath = pathlib.Path(dirstr)
-  for i, dirname in enumerate(dirnames):
-    dirnames[i] = pathlib.Path(dirname)
-  for i, filename in enumerate(filenames):
-    filenames[i] = pathlib.Path(filename)
-  return dirpath, dirnames, filenames
-
-
-def get_missings(missing1, missing2, ignore1, ignore2):
+  prefix1 = get_dir_prefix(dir1)
+  prefix2 = get_dir_prefix(dir2)
+  missing1 = [prefix1+missing for missing in missing_dirs1 + missing_files1]
+  missing2 = [prefix2+missing for missing in missing_dirs2 + missing_files2]
+  names1 = dirnames1 + filenames1
+  names2 = dirnames2 + filenames2
+  return names1, names2, missing1, missing2
+
+
+def sync_up_spilled_walker_paths(walker_paths1, walker_paths2, chunk_size=None):
+  """Like `sync_up_walker_paths()`, for when either side's filenames are `SpilledNames`.
+  Instead of lists of names to compare, this returns an iterator of (names1, names2) chunks of up to
+  `chunk_size` paths (the dirnames first). The files are merge-joined from the sorted names, and the
+  missing ones are only found as `missing1` and `missing2` are iterated, so nothing but the
+  dirnames and one chunk need to be in memory."""
+  if chunk_size is None:
+    chunk_size = SPILL_CHUNK_SIZE
+  dir1, dirnames1, filenames1 = walker_paths1
+  dir2, dirnames2, filenames2 = walker_paths2
+  dirnames1.sort()
+  dirnames2.sort()
+  missing_dirs1, missing_dirs2 = matchup(dirnames1, dirnames2)
+  names1 = get_sorted_names(filenames1)
+  names2 = get_sorted_names(filenames2)
+  prefix1 = get_dir_prefix(dir1)
+  prefix2 = get_dir_prefix(dir2)
+  missing1 = itertools.chain(
+    (prefix1+missing for missing in missing_dirs1),
+    (prefix1+name1 for name1, name2 in merge_join(names1, names2) if name2 is None)
+  )
+  missing2 = itertools.chain(
+    (prefix2+missing for missing in missing_dirs2),
+    (prefix2+name2 for name1, name2 in merge_join(names1, names2) if name1 is None)
+  )
+  return get_spilled_path_chunks(dirnames1, dirnames2, names1, names2, chunk_size), missing1, missing2
+
+
+def get_spilled_path_chunks(dirnames1, dirnames2, names1, names2, chunk_size):
+  yield dirnames1, dirnames2
+  chunk1 = []
+  chunk2 = []
+  for name1, name2 in merge_join(names1, names2):
+    if name1 is None or name2 is None:
+      continue
+    chunk1.append(name1)
+    chunk2.append(name2)
+    if len(chunk1) >= chunk_size:
+      yield chunk1, chunk2
+      chunk1 = []
+      chunk2 = []
+  if chunk1:
+    yield chunk1, chunk2
+
+
+def get_sorted_names(filenames):
+  """Get the names in a walker's filenames (`SpilledNames`, or a list) as a sorted iterable."""
+  if isinstance(filenames, SpilledNames):
+    return filenames
+  return sorted(filenames)
+
+
+def merge_join(names1, names2):
+  """Go through two sorted iterables of names together, yielding a (name1, name2) pair for each
+  name, with None on the side it's missing from."""
+  iter1 = iter(names1)
+  iter2 = iter(names2)
+  name1 = next(iter1, None)
+  name2 = next(iter2, None)
+  while name1 is not None or name2 is not None:
+    if name2 is None or (name1 is not None and name1 < name2):
+      yield name1, None
+      name1 = next(iter1, None)
+    elif name1 is None or name2 < name1:
+      yield None, name2
+      name2 = next(iter2, None)
+    else:
+      yield name1, name2
+      name1 = next(iter1, None)
+      name2 = next(iter2, None)
+
+
+def forget_cached(tree1, tree2):
+  """Have the trees drop what they've cached about the paths compared so far in this directory."""
+  tree1.forget()
+  if tree2 is not tree1:
+    tree2.forget()
+
+
+def compare_subtree_roots(path1, path2, ignore1, ignore2, crc='last', date_tolerance=0, tree1=None,
+                          tree2=None, candidates=None):
+  """Compare the starting paths of a --subtree comparison, when they aren't both directories."""
+  tree1 = tree1 or LOCAL_TREE
+  tree2 = tree2 or LOCAL_TREE
+  exists1 = get_root_type(tree1, path1) != 'nonexistent'
+  exists2 = get_root_type(tree2, path2) != 'nonexistent'
+  # If it's on neither side (like a path --watch saw deleted), there's no difference.
+  if exists1 and exists2:
+    result = compare_paths(path1, path2, date_tolerance=date_tolerance, crc=crc, tree1=tree1,
+                           tree2=tree2)
+    if result.diff_type != 'equal':
+      yield pathize(result)
+    elif candidates is not None and result.path_type == 'file':
+      candidates.append(result)
+  else:
+    missing1 = [path1] if exists1 else []
+    missing2 = [path2] if exists2 else []
+    for diff in get_missings(missing1, missing2, ignore1, ignore2, tree1=tree1, tree2=tree2):
+      yield pathize(diff)
+
+
+def normalize_subtree(subtree_str):
+  """Clean up a --subtree argument into a '/'-delimited relative path ('.' and '' are None)."""
+  parts = [part for part in subtree_str.split('/') if part and part != '.']
+  if '..' in parts:
+    fail(f'Error: --subtree must be inside the compared directories (got {subtree_str!r}).')
+  if parts:
+    return '/'.join(parts)
+  else:
+    return None
+
+
+def get_rel_depth(rel_path):
+  """How many levels below the root is this relative path? The root ('' or None) is 0."""
+  if rel_path:
+    return rel_path.count('/') + 1
+  else:
+    return 0
+
+
+def get_rel_dir(root, dirpath):
+  """Get the path of a directory yielded by a walker, relative to the root of the walk, as a
+  '/'-delimited string ('' for the root itself)."""
+  root = os.fspath(root)
+  if dirpath == root:
+    return ''
+  return dirpath[len(get_dir_prefix(root)):]
+
+
+def filter_walker_paths(path_filter, rel_dir, walker_paths):
+  """Remove excluded names from the dirnames and filenames lists of a walker's output.
+  This alters the lists in-place, so that the walker will not descend into excluded directories."""
+  dirpath, dirnames, filenames = walker_paths
+  for names in dirnames, filenames:
+    if isinstance(names, SpilledNames):
+      names.add_filter(lambda name: not path_filter.excludes(join_rel(rel_dir, name)))
+    else:
+      names[:] = [name for name in names if not path_filter.excludes(join_rel(rel_dir, name))]
+
+
+def join_rel(rel_dir, name):
+  if rel_dir:
+    return rel_dir+'/'+name
+  else:
+    return name
+
+
+def get_dir_prefix(dirpath):
+  """Get the string to prepend to the names in a directory to make their paths."""
+  if dirpath.endswith('/'):
+    return dirpath
+  else:
+    return dirpath+'/'
+
+
+def pathize(diff):
+  """Convert the string paths in a `Diff` to `pathlib.Path`s, for the callers of the comparison
+  functions. This alters the `Diff`."""
+  for path_info in diff.diff1, diff.diff2:
+    if isinstance(path_info.path, str):
+      path_info.path = pathlib.Path(path_info.path)
+  return diff
+
+
+def get_missings(missing1, missing2, ignore1, ignore2, tree1=None, tree2=None):
+  tree1 = tree1 or LOCAL_TREE
+  tree2 = tree2 or LOCAL_TREE
   if not ignore2:
     for missing in missing1:
-      yield 'missing2', get_path_type(missing), {'path':missing}, {'path':None}
+      yield Diff('missing2', tree1.get_type(missing), PathInfo(missing), PathInfo())
   if not ignore1:
     for missing in missing2:
-      yield 'missing1', get_path_type(missing), {'path':None}, {'path':missing}
+      yield Diff('missing1', tree2.get_type(missing), PathInfo(), PathInfo(missing))
+
+
+def prefetch_crcs(prefix1, prefix2, names1, names2, tree1, tree2, crc='last', date_tolerance=0):
+  """Find the pairs of files whose checksums `compare_paths()` is going to need, and tell the trees
+  to compute them all in one batch. The paths are the names with the directory `prefix`es added."""
+  needed1 = []
+  needed2 = []
+  for name1, name2 in zip(names1, names2):
+    path1 = prefix1+name1
+    path2 = prefix2+name2
+    try:
+      if tree1.get_type(path1) != 'file' or tree2.get_type(path2) != 'file':
+        continue
+      if tree1.get_size(path1) != tree2.get_size(path2):
+        continue
+      date_diff = abs(tree1.get_modified(path1) - tree2.get_modified(path2))
+      if crc != 'date' and date_diff > date_tolerance:
+        continue
+    except OSError:
+      # Leave it to `compare_paths()` to deal with the error.
+      continue
+    needed1.append(path1)
+    needed2.append(path2)
+  if tree1 is tree2:
+    # One batch, so files on both sides can be hashed at the same time (if they're on different
+    # devices, with their own worker pools).
+    tree1.prefetch_crc32(needed1+needed2)
+  else:
+    tree1.prefetch_crc32(needed1)
+    tree2.prefetch_crc32(needed2)
 
 #TODO: Use metadata.py for more efficient interface to file metadata.
 
-def compare_paths(path1, path2, date_tolerance=0, crc='last'):
+def compare_paths(path1, path2, date_tolerance=0, crc='last', tree1=None, tree2=None):
+  tree1 = tree1 or LOCAL_TREE
+  tree2 = tree2 or LOCAL_TREE
   # Start creating the diff data to pass back.
-  diff1 = {'path':path1}
-  diff2 = {'path':path2}
+  diff1 = PathInfo(path1)
+  diff2 = PathInfo(path2)
   # Are they both files/directories/links?
-  path_type1 = get_path_type(path1)
-  path_type2 = get_path_type(path2)
-  diff1['type'] = path_type1
-  diff2['type'] = path_type2
+  path_type1 = tree1.get_type(path1)
+  path_type2 = tree2.get_type(path2)
+  diff1.type = path_type1
+  diff2.type = path_type2
   if path_type1 != path_type2:
-    return 'type', 'mixed', diff1, diff2
+    return Diff('type', 'mixed', diff1, diff2)
   if path_type1 == 'link':
     # If they're links, check that they point to the same thing.
-    target1 = os.readlink(path1)
-    target2 = os.readlink(path2)
-    diff1['target'] = target1
-    diff2['target'] = target2
+    target1 = tree1.readlink(path1)
+    target2 = tree2.readlink(path2)
+    diff1.target = target1
+    diff2.target = target2
     if target1 == target2:
-      return 'equal', path_type1, diff1, diff2
+      return Diff('equal', path_type1, diff1, diff2)
     else:
-      return 'target', path_type1, diff1, diff2
+      return Diff('target', path_type1, diff1, diff2)
   elif path_type1 != 'file':
     # If it's not a file, there's no more checks that are implemented for the other types.
     # Consider them equal.
-    return 'equal', path_type1, diff1, diff2
+    return Diff('equal', path_type1, diff1, diff2)
   # Now, check that the files are equal.
   # We always want to get the size and date modified.
-  diff1['size'] = os.path.getsize(path1)
-  diff2['size'] = os.path.getsize(path2)
-  diff1['modified'] = int(os.path.getmtime(path1))
-  diff2['modified'] = int(os.path.getmtime(path2))
+  diff1.size = tree1.get_size(path1)
+  diff2.size = tree2.get_size(path2)
+  diff1.modified = tree1.get_modified(path1)
+  diff2.modified = tree2.get_modified(path2)
   # Different sizes?
-  if diff1['size'] != diff2['size']:
-    return 'size', path_type1, diff1, diff2
+  if diff1.size != diff2.size:
+    return Diff('size', path_type1, diff1, diff2)
   if crc == 'date':
-    diff1['crc'] = get_crc32(path1)
-    diff2['crc'] = get_crc32(path2)
+    diff1.crc = tree1.get_crc32(path1)
+    diff2.crc = tree2.get_crc32(path2)
   # Different dates modified?
-  if abs(diff1['modified'] - diff2['modified']) > date_tolerance:
-    return 'modified', path_type1, diff1, diff2
+  if abs(diff1.modified - diff2.modified) > date_tolerance:
+    return Diff('modified', path_type1, diff1, diff2)
   # Different checksums?
   if crc != 'none':
-    if 'crc' not in diff1 or 'crc' not in diff2:
-      diff1['crc'] = get_crc32(path1)
-      diff2['crc'] = get_crc32(path2)
-    if diff1['crc'] != diff2['crc']:
-      return 'crc', path_type1, diff1, diff2
-  return 'equal', path_type1, diff1, diff2
+    if diff1.crc is None or diff2.crc is None:
+      diff1.crc = tree1.get_crc32(path1)
+      diff2.crc = tree2.get_crc32(path2)
+    if diff1.crc != diff2.crc:
+      return Diff('crc', path_type1, diff1, diff2)
+  return Diff('equal', path_type1, diff1, diff2)
 
 
-def get_crc32(path, chunk_size=DEFAULT_CHUNK_SIZE):
+def get_crc32(path, chunk_size=DEFAULT_CHUNK_SIZE, policy=None, dir_fd=None):
   """Read a file and compute its CRC-32. Only reads chunk_size bytes into memory at a time.
+  Holes in sparse files aren't read: the CRC-32 is just extended over that many zeros.
+  With a `dir_fd`, the `path` is relative to that directory.
   This may raise an IOError if there's a problem reading the file."""
   crc = 0
   try:
-    with path.open('rb') as file:
-      chunk = file.read(chunk_size)
-      while chunk:
-        # Note: A change in Python 3.0 means the crc returned by this is incompatible with those from
-        # earlier versions.
-        crc = zlib.crc32(chunk, crc)
-        chunk = file.read(chunk_size)
+    for chunk in read_chunks(path, chunk_size, policy, holes=True, dir_fd=dir_fd):
+      if isinstance(chunk, int):
+        crc = crc32_zeros(chunk, crc)
+        continue
+      # Note: A change in Python 3.0 means the crc returned by this is incompatible with those from
+      # earlier versions.
+      crc = zlib.crc32(chunk, crc)
   except KeyboardInterrupt:
     logging.warning('Interrupted while getting crc32 of {}'.format(path))
     raise
   return crc
 
 
+def crc32_zeros(length, crc=0):
+  """Compute `zlib.crc32(bytes(length), crc)` without the bytes, in time proportional to log(length).
+  Feeding zeros through the CRC register is a linear operation over GF(2), so it's a 32x32 bit
+  matrix. Its powers for 2**n bytes are precomputed, and applied for each bit set in `length` (this
+  is the same method as zlib's crc32_combine())."""
+  register = crc ^ 0xFFFFFFFF
+  power = 0
+  while length:
+    if length & 1:
+      register = gf2_matrix_times(get_crc32_zeros_operator(power), register)
+    length >>= 1
+    power += 1
+  return register ^ 0xFFFFFFFF
+
+
+def get_crc32_zeros_operator(power):
+  """Get the matrix which feeds 2**power zero bytes through the CRC-32 register."""
+  while len(CRC32_ZEROS_OPERATORS) <= power:
+    if CRC32_ZEROS_OPERATORS:
+      operator = CRC32_ZEROS_OPERATORS[-1]
+    else:
+      # The operator for one zero bit: shift right, and xor in the (reflected) polynomial if the
+      # bit shifted out was set. Square it three times to get one byte.
+      operator = [0xEDB88320] + [1 << row for row in range(31)]
+      for i in range(2):
+        operator = gf2_matrix_square(operator)
+    CRC32_ZEROS_OPERATORS.append(gf2_matrix_square(operator))
+  return CRC32_ZEROS_OPERATORS[power]
+
+CRC32_ZEROS_OPERATORS = []
+
+
+def gf2_matrix_times(matrix, vector):
+  """Multiply a vector by a matrix over GF(2). The vector is an int of bits, and the matrix is a
+  list of the ints each bit of the vector maps to."""
+  result = 0
+  row = 0
+  while vector:
+    if vector & 1:
+      result ^= matrix[row]
+    vector >>= 1
+    row += 1
+  return result
+
+
+def gf2_matrix_square(matrix):
+  return [gf2_matrix_times(matrix, column) for column in matrix]
+
+
+class ReadPolicy:
+  """How to read files which are only being read once, to hash them.
+  By default, the kernel is told the file will be read sequentially, `readahead` bytes ahead of the
+  current position are requested in advance, and each chunk is dropped from the page cache once it's
+  been used (unless `keep_cache`), so that hashing a huge tree doesn't evict everything else from the
+  cache. With `direct`, the page cache is bypassed entirely with O_DIRECT, where supported.
+  If there's a `limiter` (a `TokenBucket`), each read takes as many tokens as bytes it returned.
+  Unless `sparse` is False, holes in sparse files are skipped by callers which can handle that."""
+
+  def __init__(self, readahead=DEFAULT_READAHEAD, keep_cache=False, direct=False, limiter=None,
+               sparse=True):
+    self.readahead = readahead
+    self.keep_cache = keep_cache
+    self.direct = direct
+    self.limiter = limiter
+    self.sparse = sparse
+
+DEFAULT_READ_POLICY = ReadPolicy()
+
+
+def read_chunks(path, chunk_size=DEFAULT_CHUNK_SIZE, policy=None, holes=False, dir_fd=None):
+  """Yield the contents of a file, chunk_size bytes at a time, reading it according to `policy`.
+  If `holes` (and the `policy` allows it), holes in sparse files aren't read. Instead, the number of
+  zero bytes in each is yielded, as an int. With a `dir_fd`, the `path` is relative to it."""
+  if policy is None:
+    policy = DEFAULT_READ_POLICY
+  fd = None
+  direct = False
+  if policy.direct and hasattr(os, 'O_DIRECT'):
+    try:
+      fd = os.open(path, os.O_RDONLY | os.O_DIRECT, dir_fd=dir_fd)
+      direct = True
+    except OSError as error:
+      # Some filesystems (tmpfs, some FUSE) refuse O_DIRECT.
+      if error.errno != errno.EINVAL:
+        raise
+  if fd is None:
+    fd = os.open(path, os.O_RDONLY, dir_fd=dir_fd)
+  buffer = None
+  try:
+    if direct:
+      # Reads have to be into an aligned buffer, at aligned offsets, and of a multiple of the
+      # device's block size. So the buffer is an anonymous mmap (which is page-aligned), sized to a
+      # multiple of the page size.
+      alignment = mmap.PAGESIZE
+      buffer = mmap.mmap(-1, max(-(-chunk_size // alignment), 1) * alignment)
+    else:
+      alignment = 1
+      advise(fd, 0, 0, 'POSIX_FADV_SEQUENTIAL')
+    if holes and policy.sparse:
+      regions = get_data_regions(fd, alignment)
+    else:
+      regions = ((0, None, True),)
+    for start, end, is_data in regions:
+      if not is_data:
+        yield end - start
+        continue
+      if direct:
+        complete = yield from read_region_direct(fd, start, end, buffer, policy.limiter)
+      else:
+        complete = yield from read_region(fd, start, end, chunk_size, policy)
+      if not complete:
+        # The file ended early (it must have been truncated since the regions were found).
+        break
+  finally:
+    os.close(fd)
+    if buffer is not None:
+      buffer.close()
+
+
+def read_region(fd, start, end, chunk_size, policy):
+  """Read from `start` to `end` (or the end of the file, if `end` is None), yielding chunks.
+  Returns whether it got to `end`."""
+  os.lseek(fd, start, os.SEEK_SET)
+  offset = advised = start
+  while end is None or offset < end:
+    size = chunk_size if end is None else min(chunk_size, end - offset)
+    if policy.readahead and offset + size > advised:
+      advised = max(advised, offset)
+      advise(fd, advised, policy.readahead, 'POSIX_FADV_WILLNEED')
+      advised += policy.readahead
+    read_start = time.monotonic()
+    chunk = os.read(fd, size)
+    if policy.limiter:
+      policy.limiter.take(len(chunk), latency=time.monotonic()-read_start)
+    if not chunk:
+      return end is None
+    yield chunk
+    if not policy.keep_cache:
+      advise(fd, offset, len(chunk), 'POSIX_FADV_DONTNEED')
+    offset += len(chunk)
+  return True
+
+
+def read_region_direct(fd, start, end, buffer, limiter=None):
+  """Like `read_region()`, but for a file opened with O_DIRECT, reading into the aligned `buffer`.
+  `start` must be aligned, and so must `end`, unless it's the end of the file."""
+  os.lseek(fd, start, os.SEEK_SET)
+  offset = start
+  while end is None or offset < end:
+    size = len(buffer)
+    if end is not None:
+      size = min(size, -(-(end - offset) // mmap.PAGESIZE) * mmap.PAGESIZE)
+    read_start = time.monotonic()
+    with memoryview(buffer) as view, view[:size] as target:
+      read = os.readv(fd, (target,))
+    if limiter:
+      limiter.take(read, latency=time.monotonic()-read_start)
+    if read:
+      # Copy it, so nothing refers to the buffer after it's closed.
+      yield buffer[:read]
+    if read < size:
+      # A short read means the end of the file. Another read would be from an unaligned offset.
+      return end is None or offset + read >= end
+    offset += read
+  return True
+
+
+def get_data_regions(fd, alignment=1):
+  """Yield (start, end, is_data) for the regions of a file, using SEEK_DATA and SEEK_HOLE to find the
+  holes in sparse files. The boundaries of data regions are rounded outward to multiples of
+  `alignment` (holes are just zeros, so reading part of one does no harm).
+  Where those seeks aren't supported, the whole file is one data region, with an `end` of None."""
+  size = os.fstat(fd).st_size
+  if not hasattr(os, 'SEEK_DATA'):
+    yield 0, None, True
+    return
+  position = 0
+  while position < size:
+    try:
+      data = os.lseek(fd, position, os.SEEK_DATA)
+    except OSError as error:
+      if error.errno == errno.ENXIO:
+        # There's no data after `position`.
+        data = size
+      elif position == 0 and error.errno in (errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP):
+        yield 0, None, True
+        return
+      else:
+        raise
+    if data >= size:
+      yield position, size, False
+      return
+    hole = os.lseek(fd, data, os.SEEK_HOLE)
+    start = data // alignment * alignment
+    if start > position:
+      yield position, start, False
+    end = min(-(-hole // alignment) * alignment, size)
+    yield start, end, True
+    position = end
+
+
+def advise(fd, offset, length, advice):
+  """Call `os.posix_fadvise()` if it's available. The advice is only a hint, so errors are ignored."""
+  if not hasattr(os, 'posix_fadvise'):
+    return
+  try:
+    os.posix_fadvise(fd, offset, length, getattr(os, advice))
+  except OSError:
+    pass
+
+
+class TokenBucket:
+  """Limit the rate of some operation (bytes read, files stat'ed) to `rate` per second, across all
+  the threads sharing the bucket. Tokens accumulate up to one second's worth, so short bursts are
+  allowed. `take()` reserves its tokens immediately and then sleeps off any debt outside the lock, so
+  a single big request (more than the bucket holds) still works, it just waits longer.
+  If a `target_latency` (in seconds) is given, the rate adapts to the latency reported for each
+  operation: once a second, it's halved if the average latency was above the target, and otherwise
+  raised by a tenth of the original `rate`, which is the ceiling (additive increase, multiplicative
+  decrease). That backs off automatically when the storage is busy with other work."""
+
+  def __init__(self, rate, target_latency=None):
+    self.max_rate = self.rate = rate
+    self.target_latency = target_latency
+    self._tokens = rate
+    self._last = self._adjusted = time.monotonic()
+    self._latency_total = 0
+    self._latency_count = 0
+    self._lock = threading.Lock()
+
+  def take(self, amount=1, latency=None):
+    with self._lock:
+      now = time.monotonic()
+      if latency is not None and self.target_latency is not None:
+        self._adapt(now, latency)
+      self._tokens = min(self._tokens + (now - self._last) * self.rate, self.rate)
+      self._last = now
+      self._tokens -= amount
+      wait = -self._tokens / self.rate
+    if wait > 0:
+      time.sleep(wait)
+
+  def _adapt(self, now, latency):
+    self._latency_total += latency
+    self._latency_count += 1
+    if now - self._adjusted < 1:
+      return
+    average = self._latency_total / self._latency_count
+    if average > self.target_latency:
+      self.rate = max(self.rate / 2, self.max_rate / 100)
+    else:
+      self.rate = min(self.rate + self.max_rate / 10, self.max_rate)
+    logging.debug(f'Average read latency {average*1000:0.1f}ms: rate now {self.rate:0.0f}/s')
+    self._adjusted = now
+    self._latency_total = 0
+    self._latency_count = 0
+
+
 def get_path_type(path, followlinks=False):
   """Check what type the file is and return a string of the type.
   If the file doesn't exist, this returns 'nonexistent'.
@@ -380,6 +1604,80 @@ def get_path_type(path, followlinks=False):
     return 'nonexistent'
 
 
+def get_mode_type(mode):
+  """Like `get_path_type()`, but from the `st_mode` of an `os.lstat()` result."""
+  if stat.S_ISLNK(mode):
+    return 'link'
+  elif stat.S_ISREG(mode):
+    return 'file'
+  elif stat.S_ISDIR(mode):
+    return 'dir'
+  elif stat.S_ISSOCK(mode):
+    return 'socket'
+  elif stat.S_ISFIFO(mode):
+    return 'fifo'
+  elif stat.S_ISBLK(mode):
+    return 'block'
+  elif stat.S_ISCHR(mode):
+    return 'char'
+  else:
+    return 'special'
+
+
+def parse_size(size_str, allow_zero=False):
+  """Returns size converted to bytes. Units are powers of 1024 ("k", "M", "G", "T")."""
+  units = {'k':1024, 'm':1024**2, 'g':1024**3, 't':1024**4}
+  try:
+    if size_str[-1:].lower() in units:
+      size = int(size_str[:-1]) * units[size_str[-1].lower()]
+    else:
+      size = int(size_str)
+  except ValueError:
+    raise argparse.ArgumentTypeError(f'Invalid size {size_str!r}.')
+  if size < 0 or (size == 0 and not allow_zero):
+    raise argparse.ArgumentTypeError(f'Size must be positive (got {size_str!r}).')
+  return size
+
+
+def parse_sample(sample_str):
+  """Parse a --verify-sample argument: "P%" gives ('percent', P), and "N" gives ('count', N)."""
+  try:
+    if sample_str.endswith('%'):
+      value = float(sample_str[:-1])
+      if 0 < value <= 100:
+        return 'percent', value
+    else:
+      value = int(sample_str)
+      if value > 0:
+        return 'count', value
+  except ValueError:
+    pass
+  raise argparse.ArgumentTypeError(f'Invalid sample {sample_str!r} (should be like "5%" or "1000").')
+
+
+def parse_device_jobs(arg):
+  """Parse a --device-jobs "MOUNT=N" argument into a (path, jobs) tuple."""
+  mount, sep, jobs_str = arg.rpartition('=')
+  try:
+    jobs = int(jobs_str)
+  except ValueError:
+    jobs = None
+  if not (sep and mount) or jobs is None or jobs < 1:
+    raise argparse.ArgumentTypeError(f'Invalid device jobs {arg!r} (should be like "/mnt/hdd=1").')
+  return pathlib.Path(mount), jobs
+
+
+def get_device_jobs(device_jobs_args):
+  """Convert the (path, jobs) tuples from --device-jobs into a dict mapping st_dev numbers to jobs."""
+  device_jobs = {}
+  for mount, jobs in device_jobs_args:
+    try:
+      device_jobs[os.stat(mount).st_dev] = jobs
+    except OSError as error:
+      fail(f'Error: Could not find the device of {str(mount)!r}: {error}')
+  return device_jobs
+
+
 def parse_tolerance(tolerance_str):
   """Returns tolerance converted to seconds."""
   try:
@@ -404,21 +1702,28 @@ def parse_tolerance(tolerance_str):
       fail('Error: --date-tolerance string {!r} invalid.'.format(tolerance_str))
 
 
-def format_human(diff_type, path_type, diff1, diff2):
-  output = f'Difference: {diff_type}\n'
-  if diff1['path'] == diff2['path'] and diff1['path'] is not None:
-    output += f'path: {diff1["path"]}\n'
+def format_human(diff):
+  diff1 = diff.diff1
+  diff2 = diff.diff2
+  output = f'Difference: {diff.diff_type}\n'
+  if diff1.path == diff2.path and diff1.path is not None:
+    output += f'path: {diff1.path}\n'
   else:
-    if diff1['path'] is not None:
-      output += f'path1: {diff1["path"]}\n'
-    if diff2['path'] is not None:
-      output += f'path2: {diff2["path"]}\n'
+    if diff1.path is not None:
+      output += f'path1: {diff1.path}\n'
+    if diff2.path is not None:
+      output += f'path2: {diff2.path}\n'
+  for path_info in diff1, diff2:
+    if path_info.files is not None:
+      output += f'contents: {path_info.files} files, {path_info.bytes} bytes\n'
   return output
 
 
-def format_tsv(root1, root2, diff_type, path_type, diff1, diff2):
-  rel_path1 = remove_root(root1, diff1['path'])
-  rel_path2 = remove_root(root2, diff2['path'])
+def format_tsv(root1, root2, diff):
+  diff1 = diff.diff1
+  diff2 = diff.diff2
+  rel_path1 = remove_root(root1, diff1.path)
+  rel_path2 = remove_root(root2, diff2.path)
   if rel_path1 is None:
     rel_path = rel_path2
   elif rel_path2 is None:
@@ -426,13 +1731,115 @@ def format_tsv(root1, root2, diff_type, path_type, diff1, diff2):
   else:
     assert rel_path1 == rel_path2, (rel_path1, rel_path2)
     rel_path = rel_path1
-  fields = [rel_path, diff_type]
-  for field_name in TSV_FIELDS:
-    fields.append(str(diff1.get(field_name, TSV_NULL_STR)))
-    fields.append(str(diff2.get(field_name, TSV_NULL_STR)))
+  fields = [rel_path, diff.diff_type]
+  if all(getattr(path_info, field_name) is None for path_info in (diff1, diff2)
+         for field_name in TSV_FIELDS[len(TSV_BASE_FIELDS):]):
+    field_names = TSV_BASE_FIELDS
+  else:
+    field_names = TSV_FIELDS
+  for field_name in field_names:
+    for path_info in diff1, diff2:
+      value = getattr(path_info, field_name)
+      if value is None and field_name not in path_info.recorded:
+        fields.append(TSV_NULL_STR)
+      else:
+        fields.append(str(value))
   return '\t'.join(fields)
 
 
+class DiffSummary:
+  """Running totals of the differences, for --summary."""
+
+  def __init__(self, root1, root2):
+    self.root1 = root1
+    self.root2 = root2
+    self.total = 0
+    self.by_type = collections.Counter()
+    self.bytes_by_top = collections.Counter()
+
+  def add(self, diff):
+    self.total += 1
+    self.by_type[diff.diff_type] += 1
+    if diff.diff1.path is not None:
+      rel_path = remove_root(self.root1, diff.diff1.path)
+    else:
+      rel_path = remove_root(self.root2, diff.diff2.path)
+    top, sep, rest = rel_path.partition('/')
+    if not sep and diff.path_type != 'dir':
+      top = '.'
+    self.bytes_by_top[top] += get_diff_bytes(diff)
+
+  def format(self, stopped=False):
+    if stopped:
+      yield f'Stopped after {self.total} differences.'
+    yield f'Differences: {self.total}'
+    for diff_type, count in sorted(self.by_type.items()):
+      yield f'  {diff_type}: {count}'
+    if self.bytes_by_top:
+      yield 'Bytes by top-level directory:'
+      for top, total_bytes in sorted(self.bytes_by_top.items()):
+        yield f'  {top}: {total_bytes}'
+
+
+def get_diff_bytes(diff):
+  """How many bytes a difference involves: the size of the file, or the total size of the files in a
+  missing directory (the larger of the two sides, if they're both present)."""
+  total_bytes = 0
+  for path_info in diff.diff1, diff.diff2:
+    if path_info.bytes is not None:
+      total_bytes = max(total_bytes, path_info.bytes)
+    elif path_info.type == 'file' and path_info.size is not None:
+      total_bytes = max(total_bytes, path_info.size)
+  return total_bytes
+
+
+def format_plan_header(root1, root2):
+  return (f'##plan={PLAN_VERSION}\n'
+          f'##src={os.path.abspath(root1)}\n'
+          f'##dst={os.path.abspath(root2)}\n'
+          f'##hash=crc32\n'
+          '#'+'\t'.join(('action', 'path')+PLAN_FIELDS))
+
+
+def format_plan(root1, root2, diff):
+  """Turn a diff into the plan lines for the action(s) needed to make path2 match path1."""
+  diff_type = diff.diff_type
+  diff1 = diff.diff1
+  diff2 = diff.diff2
+  if diff1.path is None:
+    rel_path = remove_root(root2, diff2.path)
+  else:
+    rel_path = remove_root(root1, diff1.path)
+  if diff_type == 'missing1':
+    actions = (('delete', diff2),)
+  elif diff_type == 'missing2':
+    actions = ((get_plan_copy_action(diff.path_type), diff1),)
+  elif diff_type == 'type':
+    actions = (('delete', diff2), (get_plan_copy_action(diff1.type), diff1))
+  elif diff_type == 'target':
+    actions = (('symlink', diff1),)
+  elif diff_type == 'modified' and diff1.crc is not None and diff1.crc == diff2.crc:
+    actions = (('touch', diff1),)
+  else:
+    actions = (('copy', diff1),)
+  for action, path_info in actions:
+    fields = [action, rel_path]
+    for field_name in PLAN_FIELDS:
+      value = getattr(path_info, field_name)
+      fields.append(TSV_NULL_STR if value is None else str(value))
+    # Missing paths only get their type looked up by the comparison.
+    if fields[2] == TSV_NULL_STR:
+      fields[2] = diff.path_type
+    yield '\t'.join(fields)
+
+
+def get_plan_copy_action(path_type):
+  if path_type == 'link':
+    return 'symlink'
+  else:
+    return 'copy'
+
+
 def remove_root(root_path, full_path):
   if full_path is None:
     return None
@@ -448,50 +1855,94 @@ def remove_root(root_path, full_path):
 
 
 def parse_tsv_line(line_raw):
-  diff1 = {}
-  diff2 = {}
+  diff1 = PathInfo()
+  diff2 = PathInfo()
   fields = line_raw.rstrip('\r\n').split('\t')
-  assert len(fields) == 2 + 2*len(TSV_FIELDS)
+  assert len(fields) in (2 + 2*len(TSV_FIELDS), 2 + 2*len(TSV_BASE_FIELDS))
   rel_path = fields[0]
   diff_type = fields[1]
-  diff1['path'] = diff2['path'] = rel_path
+  diff1.path = diff2.path = rel_path
   if diff_type == 'missing1':
-    diff1['path'] = None
+    diff1.path = None
   elif diff_type == 'missing2':
-    diff2['path'] = None
+    diff2.path = None
   for i, value_str in enumerate(fields[2:]):
     field_name = TSV_FIELDS[i//2]
     if i % 2 == 0:
-      diff = diff1
+      path_info = diff1
     else:
-      diff = diff2
+      path_info = diff2
     if value_str == TSV_NULL_STR or (value_str == 'None' and field_name != 'target'):
-      diff[field_name] = None
+      value = None
+    elif field_name in ('size', 'modified', 'files', 'bytes'):
+      value = int(value_str)
     else:
-      if field_name in ('size', 'modified'):
-        value = int(value_str)
-      else:
-        value = value_str
-      diff[field_name] = value
-  if diff1['type'] == diff2['type']:
-    path_type = diff1['type']
-  elif diff1['type'] is None:
-    path_type = diff2['type']
-  elif diff2['type'] is None:
-    path_type = diff1['type']
+      value = value_str
+    setattr(path_info, field_name, value)
+  if diff1.type == diff2.type:
+    path_type = diff1.type
+  elif diff1.type is None:
+    path_type = diff2.type
+  elif diff2.type is None:
+    path_type = diff1.type
   else:
     path_type = 'mixed'
-  return diff_type, path_type, diff1, diff2
+  return Diff(diff_type, path_type, diff1, diff2)
 
 
 def convert_tsv(tsv_path):
   if str(tsv_path) == '-':
     tsv_file = sys.stdin
   else:
-    tsv_file = tsv_path.open('rt')
+    tsv_file = tsv_path.open('rt', errors='surrogateescape')
   for line_raw in tsv_file:
-    diff_type, path_type, diff1, diff2 = parse_tsv_line(line_raw)
-    yield format_human(diff_type, path_type, diff1, diff2)
+    yield format_human(parse_tsv_line(line_raw))
+
+
+def parse_path_arg(path_str):
+  """Parse a path1/path2 argument into a `pathlib.Path`, or a `RemoteURL` for tcp:// urls."""
+  if not path_str.startswith('tcp://'):
+    return pathlib.Path(path_str)
+  url = urllib.parse.urlsplit(path_str)
+  try:
+    port = url.port or DEFAULT_PORT
+  except ValueError:
+    raise argparse.ArgumentTypeError(f'Invalid port in {path_str!r}.')
+  if not url.hostname:
+    raise argparse.ArgumentTypeError(f'No host in {path_str!r}.')
+  return RemoteURL(url.hostname, port, url.path or '/')
+
+
+def format_path_arg(path_arg):
+  """Turn a parsed path1/path2 argument back into a string."""
+  if isinstance(path_arg, RemoteURL):
+    return f'tcp://{path_arg.host}:{path_arg.port}{path_arg.path}'
+  else:
+    return str(path_arg)
+
+
+def open_tree(path_arg, local_tree=None):
+  """Get the tree object to use for a path1/path2 argument, and the root path in that tree.
+  Local paths use `local_tree` (or `LOCAL_TREE`)."""
+  if isinstance(path_arg, RemoteURL):
+    return RemoteTree(path_arg.host, path_arg.port), pathlib.Path(path_arg.path)
+  else:
+    return local_tree or LOCAL_TREE, path_arg
+
+
+def get_root_type(tree, root):
+  """Get the type of the starting path of a comparison, or exit with an error if it can't be read
+  (like a remote path that leads outside the served root)."""
+  try:
+    return tree.get_type(root)
+  except OSError as error:
+    fail(f'Error: Could not access path {str(root)!r}: {error.strerror}')
+
+
+def check_tree_root(tree, root):
+  """Make sure the root of a comparison is a directory, or exit with an error."""
+  if get_root_type(tree, root) != 'dir':
+    fail(f'Error: Remote path is not a directory: {str(root)!r}')
 
 
 def log_error(error):
@@ -601,6 +2052,201 @@ def matchup(files1, files2):
   return missing1, missing2
 
 
+class SpilledNames:
+  """A sorted collection of names, kept in temporary files instead of memory, for huge directories.
+  Names are added with `add()`. Every `run_size` of them are sorted and written to a temporary file,
+  as a run. Iterating merges the runs (with `heapq.merge()`), reading them back a block at a time, so
+  only `run_size` names plus a block of each run are in memory. It can be iterated any number of
+  times, even at once.
+  Names are stored null-terminated, since that's the only character a name can't contain."""
+
+  def __init__(self, names=(), run_size=None):
+    if run_size is None:
+      run_size = SPILL_CHUNK_SIZE
+    self.run_size = run_size
+    self._buffer = []
+    self._runs = []
+    self._filters = []
+    for name in names:
+      self.add(name)
+
+  def add(self, name):
+    self._buffer.append(name)
+    if len(self._buffer) >= self.run_size:
+      self._spill()
+
+  def _spill(self):
+    self._buffer.sort()
+    run = tempfile.TemporaryFile(prefix='synctest-names-')
+    run.writelines(name.encode('utf-8', 'surrogateescape')+b'\0' for name in self._buffer)
+    run.flush()
+    self._runs.append(run)
+    self._buffer = []
+
+  def add_filter(self, keep):
+    """Only yield the names for which `keep(name)` is true."""
+    self._filters.append(keep)
+
+  def __iter__(self):
+    if self._buffer:
+      self._spill()
+    names = heapq.merge(*[self._read_run(run) for run in self._runs])
+    for keep in self._filters:
+      names = filter(keep, names)
+    return names
+
+  @staticmethod
+  def _read_run(run, block_size=65536):
+    # Read with pread() instead of seeking, so several iterations can read the same run at once.
+    offset = 0
+    remainder = b''
+    while True:
+      block = os.pread(run.fileno(), block_size, offset)
+      if not block:
+        return
+      offset += len(block)
+      names = (remainder + block).split(b'\0')
+      remainder = names.pop()
+      for name in names:
+        yield name.decode('utf-8', 'surrogateescape')
+
+  def close(self):
+    for run in self._runs:
+      run.close()
+    self._runs = []
+
+
+class PathFilter:
+  """Decide which paths to skip, according to exclude and include globs and regexes.
+  All the patterns of each kind are compiled into a single regex up front, so checking a path is at
+  most a few `re` calls, no matter how many patterns were given.
+  Paths are checked as '/'-delimited strings, relative to the root of the comparison."""
+
+  def __init__(self, excludes=(), includes=(), exclude_regexes=(), include_regexes=()):
+    self._exclude_name, self._exclude_path = self._compile(excludes, exclude_regexes)
+    self._include_name, self._include_path = self._compile(includes, include_regexes)
+    self._dir_cache = {}
+
+  def __bool__(self):
+    return self._exclude_name is not None or self._exclude_path is not None
+
+  @staticmethod
+  def _compile(globs, regexes):
+    """Combine the patterns into one regex matched against names and one matched against paths.
+    Globs with no slash apply to names, the rest are anchored to the start of the relative path."""
+    name_patterns = []
+    path_patterns = []
+    for glob in globs:
+      if '/' in glob:
+        path_patterns.append(r'\A(?:'+fnmatch.translate(glob.lstrip('/'))+')')
+      else:
+        name_patterns.append(fnmatch.translate(glob))
+    for regex in regexes:
+      try:
+        re.compile(regex)
+      except re.error as error:
+        fail(f'Error: Invalid regular expression {regex!r}: {error}')
+      path_patterns.append('(?:'+regex+')')
+    name_regex = path_regex = None
+    if name_patterns:
+      name_regex = re.compile('|'.join(name_patterns))
+    if path_patterns:
+      path_regex = re.compile('|'.join(path_patterns))
+    return name_regex, path_regex
+
+  @staticmethod
+  def _matches(name_regex, path_regex, rel_path):
+    if name_regex is not None:
+      name = rel_path.rpartition('/')[2]
+      if name_regex.match(name):
+        return True
+    if path_regex is not None and path_regex.search(rel_path):
+      return True
+    return False
+
+  def excludes(self, rel_path):
+    """Should this path be skipped? This only checks the path itself, not its parents."""
+    if not self._matches(self._exclude_name, self._exclude_path, rel_path):
+      return False
+    return not self._matches(self._include_name, self._include_path, rel_path)
+
+  def excludes_tree(self, rel_path):
+    """Like `excludes()`, but also true if any parent directory of the path is excluded.
+    For when the paths come from a flat list instead of a walk (like a survey)."""
+    parent = rel_path.rpartition('/')[0]
+    if parent:
+      try:
+        parent_excluded = self._dir_cache[parent]
+      except KeyError:
+        parent_excluded = self._dir_cache[parent] = self.excludes_tree(parent)
+      if parent_excluded:
+        return True
+    return self.excludes(rel_path)
+
+
+def make_path_filter(args):
+  excludes = list(args.exclude)
+  for exclude_path in args.exclude_from:
+    with exclude_path.open('rt') as exclude_file:
+      for line_raw in exclude_file:
+        line = line_raw.rstrip('\r\n')
+        if line and not line.startswith('#'):
+          excludes.append(line)
+  path_filter = PathFilter(excludes, args.include, args.exclude_regex, args.include_regex)
+  if path_filter:
+    return path_filter
+  else:
+    return None
+
+
+class PathInfo:
+  """What was found out about a path on one side of a comparison. Anything not measured, or not
+  applicable to the path, is None. `files` and `bytes` are the totals of the contents of a missing
+  directory, when known."""
+  __slots__ = ('path', 'type', 'size', 'modified', 'crc', 'target', 'files', 'bytes')
+  # Fields whose value was read from a record even when it's None (see `SurveyPathInfo`).
+  recorded = ()
+
+  def __init__(self, path=None, type=None, size=None, modified=None, crc=None, target=None):
+    self.path = path
+    self.type = type
+    self.size = size
+    self.modified = modified
+    self.crc = crc
+    self.target = target
+    self.files = None
+    self.bytes = None
+
+  def __repr__(self):
+    fields = ', '.join(f'{name}={getattr(self, name)!r}' for name in self.__slots__
+                       if getattr(self, name) is not None)
+    return f'{type(self).__name__}({fields})'
+
+
+class SurveyPathInfo(PathInfo):
+  """A `PathInfo` read from a survey. The survey records its fields even when their values are
+  unknown, so in the TSV output those are "None" rather than "?" (not measured)."""
+  __slots__ = ()
+  recorded = ('type', 'size', 'modified', 'crc')
+
+
+class Diff:
+  """A difference found between two paths: the kind of difference ("missing1", "size", etc, or
+  "equal"), the type of the path ("file", "dir", etc, or "mixed"), and the `PathInfo` for
+  each side (with a path of None for the side it's missing from)."""
+  __slots__ = ('diff_type', 'path_type', 'diff1', 'diff2')
+
+  def __init__(self, diff_type, path_type, diff1, diff2):
+    self.diff_type = diff_type
+    self.path_type = path_type
+    self.diff1 = diff1
+    self.diff2 = diff2
+
+  def __repr__(self):
+    return (f'{type(self).__name__}({self.diff_type!r}, {self.path_type!r}, {self.diff1!r}, '
+            f'{self.diff2!r})')
+
+
 class SyncError(Exception):
   def __init__(self, message):
     self.message = message
@@ -609,29 +2255,2902 @@ class SyncError(Exception):
     return '{}: {}'.format(type(self).__name__, self.message)
 
 
-########## "Static analysis" ##########
+########## Trees ##########
 
-Metadata = collections.namedtuple('Metadata', ('modified', 'size', 'crc', 'type', 'error'))
+class LocalTree:
+  """Access to paths on the local filesystem.
+  `recursive_compare()` and `compare_paths()` get at the paths they're comparing through one of these
+  tree objects, so that a `RemoteTree` can stand in for either side.
+  With an `io_order` other than "name", `prefetch_crc32()` hashes each directory's files in that
+  order, and the stats of all the paths in the directory are cached so they're only done once.
+  Otherwise, only the last `STAT_CACHE_SIZE` are.
+  While the caller is comparing a directory from `walk()`, it's held open, and the stats, reads, and
+  readlinks of the (string) paths in it are done relative to its fd, instead of by full path.
+  Files are hashed `read_size` bytes at a time, according to the `read_policy` (a `ReadPolicy`).
+  If there's a `stat_limiter` (a `TokenBucket`), each stat and directory listing takes a token.
+  With more than one job, `prefetch_crc32()` hashes files in a pool of worker threads for each
+  device (`st_dev`), so that each device can be given its own concurrency. `device_jobs` maps
+  st_dev numbers to how many files to hash at once on that device, and other devices get `jobs`.
+  With a `spill_threshold`, once a directory has more files than that, `walk()` puts them in
+  `SpilledNames` instead of a list."""
 
-def read_survey(survey_path):
-  survey_metadata = {}
-  survey = {}
-  with open_path(survey_path) as survey_file:
-    try:
-      for line_raw in survey_file:
-        if line_raw.startswith('#'):
-          if line_raw.startswith('##'):
-            parse_survey_metaline(line_raw, survey_metadata)
-        else:
-          path_str, metadata = parse_survey_line(line_raw)
-          survey[path_str] = metadata
-    except EOFError:
-      pass
-  return survey, survey_metadata
+  is_local = True
 
+  def __init__(self, io_order='name', read_size=DEFAULT_CHUNK_SIZE, read_policy=None,
+               stat_limiter=None, jobs=1, device_jobs=None, spill_threshold=None):
+    self.io_order = io_order
+    self.spill_threshold = spill_threshold
+    self.read_size = read_size
+    self.read_policy = read_policy
+    self.stat_limiter = stat_limiter
+    self.jobs = jobs
+    self.device_jobs = device_jobs or {}
+    # Whether `prefetch_crc32()` is worth calling.
+    self.batched = io_order != 'name' or jobs > 1 or bool(self.device_jobs)
+    self._pools = {}
+    self._stats = {}
+    self._crcs = {}
+    self._dir_fds = {}
 
-def parse_survey_metaline(line_raw, metadata):
-  fields = line_raw[2:].rstrip('\r\n').split('=')
+  def walk(self, top, followlinks=False, onerror=None):
+    for dirpath, dirnames, filenames, dir_fd in self._walk(top, followlinks, onerror):
+      self._limit_stats()
+      # The caches only hold the directory being compared.
+      self.forget()
+      self._dir_fds[dirpath] = dir_fd
+      try:
+        yield dirpath, dirnames, filenames
+      finally:
+        self._dir_fds.pop(dirpath, None)
+
+  def _walk(self, top, followlinks=False, onerror=None):
+    """Like `os.walk()` (top-down), but also yielding an fd of each directory, which is open until
+    the next one is requested. Filenames are spilled to disk when there's a `spill_threshold`."""
+    stack = [os.fspath(top)]
+    while stack:
+      dirpath = stack.pop()
+      dirnames = []
+      filenames = []
+      links = set()
+      try:
+        dir_fd = os.open(dirpath, os.O_RDONLY | os.O_DIRECTORY)
+      except OSError as error:
+        if onerror is not None:
+          onerror(error)
+        continue
+      try:
+        try:
+          with os.scandir(dir_fd) as entries:
+            for entry in entries:
+              try:
+                is_dir = entry.is_dir()
+              except OSError:
+                is_dir = False
+              if is_dir:
+                dirnames.append(entry.name)
+                if entry.is_symlink():
+                  links.add(entry.name)
+              elif isinstance(filenames, SpilledNames):
+                filenames.add(entry.name)
+              else:
+                filenames.append(entry.name)
+                if self.spill_threshold is not None and len(filenames) > self.spill_threshold:
+                  filenames = SpilledNames(filenames, run_size=self.spill_threshold)
+        except OSError as error:
+          error.filename = dirpath
+          if onerror is not None:
+            onerror(error)
+          continue
+        yield dirpath, dirnames, filenames, dir_fd
+      finally:
+        os.close(dir_fd)
+      # The caller may have edited dirnames.
+      prefix = get_dir_prefix(dirpath)
+      for dirname in reversed(dirnames):
+        if followlinks or dirname not in links:
+          stack.append(prefix+dirname)
+
+  def forget(self):
+    """Clear the caches of stats and checksums."""
+    self._stats.clear()
+    self._crcs.clear()
+
+  def _limit_stats(self):
+    if self.stat_limiter:
+      self.stat_limiter.take()
+
+  def _split(self, path):
+    """Get the fd of the directory `path` is in and its name there, if the directory is one being
+    compared. Otherwise, the fd is None, and the whole path is returned."""
+    if isinstance(path, str):
+      dirpath, _, name = path.rpartition('/')
+      dir_fd = self._dir_fds.get(dirpath)
+      if dir_fd is not None:
+        return dir_fd, name
+    return None, path
+
+  def _lstat(self, path):
+    try:
+      return self._stats[path]
+    except KeyError:
+      pass
+    self._limit_stats()
+    if not self.batched and len(self._stats) >= STAT_CACHE_SIZE:
+      self._stats.clear()
+    dir_fd, name = self._split(path)
+    try:
+      stats = self._stats[path] = os.lstat(name, dir_fd=dir_fd)
+    except OSError as error:
+      raise with_filename(error, path)
+    return stats
+
+  def get_type(self, path):
+    try:
+      return get_mode_type(self._lstat(path).st_mode)
+    except (FileNotFoundError, NotADirectoryError):
+      return 'nonexistent'
+
+  def readlink(self, path):
+    dir_fd, name = self._split(path)
+    try:
+      return os.readlink(name, dir_fd=dir_fd)
+    except OSError as error:
+      raise with_filename(error, path)
+
+  def get_size(self, path):
+    return self._lstat(path).st_size
+
+  def get_modified(self, path):
+    return int(self._lstat(path).st_mtime)
+
+  def get_crc32(self, path):
+    try:
+      result = self._crcs.pop(path)
+    except KeyError:
+      dir_fd, name = self._split(path)
+      try:
+        return get_crc32(name, self.read_size, self.read_policy, dir_fd=dir_fd)
+      except OSError as error:
+        raise with_filename(error, path)
+    if isinstance(result, Exception):
+      raise result
+    return result
+
+  def prefetch_crc32(self, paths):
+    """Hash these files in `io_order`, and save the results for `get_crc32()`."""
+    if not self.batched:
+      return
+    if self.io_order != 'name':
+      paths = sorted(paths, key=self._get_io_position)
+    if self.jobs == 1 and not self.device_jobs:
+      for path in paths:
+        dir_fd, name = self._split(path)
+        try:
+          self._crcs[path] = get_crc32(name, self.read_size, self.read_policy, dir_fd=dir_fd)
+        except OSError as error:
+          self._crcs[path] = with_filename(error, path)
+      return
+    # Each pool works through its queue in the order the files were submitted, so with one job per
+    # device, the `io_order` is kept.
+    futures = {}
+    for path in paths:
+      try:
+        device = self._lstat(path).st_dev
+      except OSError as error:
+        self._crcs[path] = error
+        continue
+      dir_fd, name = self._split(path)
+      futures[path] = self._get_pool(device).submit(
+        get_crc32, name, self.read_size, self.read_policy, dir_fd=dir_fd
+      )
+    for path, future in futures.items():
+      try:
+        self._crcs[path] = future.result()
+      except OSError as error:
+        self._crcs[path] = with_filename(error, path)
+
+  def _get_pool(self, device):
+    try:
+      return self._pools[device]
+    except KeyError:
+      jobs = self.device_jobs.get(device, self.jobs)
+      logging.info(f'Hashing files on device {os.major(device)}:{os.minor(device)} with {jobs} jobs.')
+      pool = self._pools[device] = concurrent.futures.ThreadPoolExecutor(
+        max_workers=jobs, thread_name_prefix=f'hash-{device}'
+      )
+      return pool
+
+  def _get_io_position(self, path):
+    try:
+      stats = self._lstat(path)
+    except OSError:
+      # Hashing it will fail too, and the error is reported then.
+      return 0, 0, 0
+    if self.io_order == 'extent':
+      physical = get_physical_offset(path)
+      if physical is not None:
+        return stats.st_dev, physical, stats.st_ino
+    return stats.st_dev, 0, stats.st_ino
+
+
+def with_filename(error, path):
+  """Put the full path in an error from an operation relative to a directory fd, for the message."""
+  if error.filename is not None:
+    error.filename = os.fspath(path)
+  return error
+
+
+def get_physical_offset(path):
+  """Get the physical offset on the device of the first extent of a file, using the FIEMAP ioctl.
+  Returns None if that's not possible (unsupported filesystem, empty file, etc)."""
+  request = bytearray(FIEMAP_HEADER.size + FIEMAP_EXTENT.size)
+  FIEMAP_HEADER.pack_into(request, 0, 0, 2**64-1, 0, 0, 1, 0)
+  try:
+    fd = os.open(path, os.O_RDONLY)
+  except OSError:
+    return None
+  try:
+    fcntl.ioctl(fd, FS_IOC_FIEMAP, request)
+  except OSError:
+    return None
+  finally:
+    os.close(fd)
+  mapped_extents = FIEMAP_HEADER.unpack_from(request, 0)[3]
+  if mapped_extents < 1:
+    return None
+  return FIEMAP_EXTENT.unpack_from(request, FIEMAP_HEADER.size)[1]
+
+
+LOCAL_TREE = LocalTree()
+
+RemoteURL = collections.namedtuple('RemoteURL', ('host', 'port', 'path'))
+
+
+class RemoteTree:
+  """Access to paths on another host, through a `synctest2.py serve` agent.
+  The protocol is one JSON object per line in each direction: each request is an object with an
+  "op" ("list", "stat", "readlink", or "hash") and a "path", and each response is either
+  {"ok": result} or {"error": [errno, message]}. Responses come back in the order of the requests,
+  so any number of requests can be sent before reading the responses.
+  Metadata for the entries of the directory most recently listed by `walk()` is cached, so comparing
+  them takes no extra round trips."""
+
+  is_local = False
+  batched = True
+
+  def __init__(self, host, port):
+    self.host = host
+    self.port = port
+    try:
+      self._socket = socket.create_connection((host, port))
+    except OSError as error:
+      fail(f'Error: Could not connect to {host}:{port}: {error}')
+    self._reader = self._socket.makefile('rb')
+    self._writer = self._socket.makefile('wb')
+    self._metadata = {}
+    self._crcs = {}
+
+  def _request_all(self, op, paths):
+    """Send a request for each path, pipelined in batches, and return the raw responses."""
+    responses = []
+    for start in range(0, len(paths), PIPELINE_BATCH):
+      batch = paths[start:start+PIPELINE_BATCH]
+      for path in batch:
+        request = {'op':op, 'path':str(path)}
+        self._writer.write(json.dumps(request).encode()+b'\n')
+      self._writer.flush()
+      for path in batch:
+        line = self._reader.readline()
+        if not line:
+          raise ConnectionError(f'Connection to {self.host}:{self.port} closed unexpectedly.')
+        responses.append(json.loads(line))
+    return responses
+
+  def _request(self, op, path):
+    return self._unpack(self._request_all(op, [path])[0], path)
+
+  @staticmethod
+  def _unpack(response, path):
+    try:
+      return response['ok']
+    except KeyError:
+      errno, message = response['error']
+      raise OSError(errno, message, str(path))
+
+  def walk(self, top, followlinks=False, onerror=None):
+    """Like `os.walk()` (top-down), on the remote tree."""
+    stack = [str(top)]
+    while stack:
+      dirpath = stack.pop()
+      try:
+        entries = self._request('list', dirpath)
+      except OSError as error:
+        if onerror is not None:
+          onerror(error)
+        continue
+      self._metadata = {}
+      dirnames = []
+      filenames = []
+      links = set()
+      for name, path_type, is_dir, size, modified, target in entries:
+        self._metadata[posixpath.join(dirpath, name)] = (path_type, size, modified, target)
+        if is_dir:
+          dirnames.append(name)
+          if path_type == 'link':
+            links.add(name)
+        else:
+          filenames.append(name)
+      yield dirpath, dirnames, filenames
+      # The caller may have edited dirnames.
+      for dirname in reversed(dirnames):
+        if followlinks or str(dirname) not in links:
+          stack.append(posixpath.join(dirpath, str(dirname)))
+
+  def forget(self):
+    # The metadata from the listing is still needed for the rest of the directory.
+    self._crcs.clear()
+
+  def _get_metadata(self, path):
+    try:
+      return self._metadata[str(path)]
+    except KeyError:
+      return self._request('stat', path)
+
+  def get_type(self, path):
+    return self._get_metadata(path)[0]
+
+  def readlink(self, path):
+    target = self._get_metadata(path)[3]
+    if target is None:
+      return self._request('readlink', path)
+    return target
+
+  def get_size(self, path):
+    return self._get_metadata(path)[1]
+
+  def get_modified(self, path):
+    return self._get_metadata(path)[2]
+
+  def get_crc32(self, path):
+    try:
+      response = self._crcs.pop(str(path))
+    except KeyError:
+      return self._request('hash', path)
+    return self._unpack(response, path)
+
+  def prefetch_crc32(self, paths):
+    paths = [path for path in paths if str(path) not in self._crcs]
+    for path, response in zip(paths, self._request_all('hash', paths)):
+      self._crcs[str(path)] = response
+
+
+########## Checkpoints ##########
+
+class Checkpoint:
+  """Record the progress of a `recursive_compare()`, so that an interrupted run can be resumed.
+  The walk visits directories in sorted depth-first order, which is the same as the order of their
+  paths as tuples of names. So the finished directories can be recorded as just the last one (the
+  "frontier"): every directory that sorts before it is finished too.
+  The file is a journal of JSON objects, one per line:
+    {"done": [names], "diffs": n, "offset": o}  A directory was finished, with n total diffs
+                                                 emitted so far.
+    {"diff": [type, path1, path2], "offset": o}  A diff in the directory in progress was emitted.
+    {"crc": [path, size, modified, crc]}  A checksum computed in the directory in progress.
+  "offset" is the size of the output file after the diff was written, if it's a regular file (else
+  null). Records are appended as they happen, and every `interval` seconds the file is rewritten with
+  only the records since the last "done" and synced to disk."""
+
+  def __init__(self, path, resume=False, interval=60, output=None):
+    self.path = path
+    self.interval = interval
+    self.output = output
+    self.frontier = None
+    self.total_diffs = 0
+    self.output_offset = None
+    self._emitted = set()
+    self._crcs = {}
+    if resume:
+      if path.exists():
+        self._load()
+        logging.info(f'Resuming from checkpoint {str(path)!r}.')
+        self._truncate_output()
+      else:
+        logging.warning(f'Warning: Checkpoint {str(path)!r} not found. Starting from the beginning.')
+    self._file = None
+    self._compact()
+
+  def _load(self):
+    with self.path.open('rt') as journal:
+      for line in journal:
+        try:
+          record = json.loads(line)
+        except ValueError:
+          # The last line can be cut off if we were killed in the middle of writing it.
+          break
+        if 'done' in record:
+          self.frontier = tuple(record['done'])
+          self.total_diffs = record['diffs']
+          self.output_offset = record['offset']
+          self._emitted.clear()
+          self._crcs.clear()
+        elif 'diff' in record:
+          self._emitted.add(tuple(record['diff']))
+          self.total_diffs += 1
+          self.output_offset = record['offset']
+        elif 'crc' in record:
+          path_str, size, modified, crc = record['crc']
+          self._crcs[path_str] = (size, modified, crc)
+
+  def _get_output_offset(self):
+    if self.output is None:
+      return None
+    try:
+      stats = os.fstat(self.output.fileno())
+    except (OSError, ValueError, AttributeError):
+      return None
+    if stat.S_ISREG(stats.st_mode):
+      return stats.st_size
+    return None
+
+  def _truncate_output(self):
+    """Remove anything the interrupted run wrote after the last diff it recorded."""
+    size = self._get_output_offset()
+    if size is not None and self.output_offset is not None and size > self.output_offset:
+      logging.info(f'Truncating {size - self.output_offset} bytes of unrecorded output.')
+      self.output.flush()
+      os.ftruncate(self.output.fileno(), self.output_offset)
+
+  def _compact(self):
+    """Rewrite the journal with only the records that still matter, and sync it to disk."""
+    if self._file is not None:
+      self._file.close()
+    tmp_path = self.path.with_name(self.path.name+'.tmp')
+    with tmp_path.open('wt') as journal:
+      # The diffs are counted again when loading the diff records.
+      total_done_diffs = self.total_diffs - len(self._emitted)
+      if self.frontier is not None:
+        self._write({'done':self.frontier, 'diffs':total_done_diffs, 'offset':self.output_offset},
+                    journal)
+      for key in self._emitted:
+        self._write({'diff':key, 'offset':self.output_offset}, journal)
+      for path_str, (size, modified, crc) in self._crcs.items():
+        self._write({'crc':(path_str, size, modified, crc)}, journal)
+      journal.flush()
+      os.fsync(journal.fileno())
+    os.replace(tmp_path, self.path)
+    self._file = self.path.open('at')
+    self._last_compacted = time.monotonic()
+
+  @staticmethod
+  def _write(record, journal):
+    journal.write(json.dumps(record)+'\n')
+
+  def is_done(self, rel_parts):
+    """Was this directory finished (not counting its subdirectories)?"""
+    return self.frontier is not None and rel_parts <= self.frontier
+
+  def is_subtree_done(self, rel_parts):
+    """Was this directory finished, along with everything under it?"""
+    return (self.frontier is not None and rel_parts < self.frontier
+            and self.frontier[:len(rel_parts)] != rel_parts)
+
+  def emit(self, diff):
+    """Yield the diff, unless it was already emitted, then record it.
+    Use as `yield from checkpoint.emit(diff)`, so it's only recorded once the caller has output it."""
+    key = (diff.diff_type, str(diff.diff1.path), str(diff.diff2.path))
+    if key in self._emitted:
+      return
+    yield diff
+    # The diff has to actually be written out before it's recorded as emitted.
+    if self.output is not None:
+      self.output.flush()
+    self.output_offset = self._get_output_offset()
+    self._emitted.add(key)
+    self.total_diffs += 1
+    self._write({'diff':key, 'offset':self.output_offset}, self._file)
+    self._file.flush()
+
+  def get_crc(self, path, size, modified):
+    try:
+      cached_size, cached_modified, crc = self._crcs[str(path)]
+    except KeyError:
+      return None
+    if (cached_size, cached_modified) == (size, modified):
+      return crc
+    return None
+
+  def record_crc(self, path, size, modified, crc):
+    self._crcs[str(path)] = (size, modified, crc)
+    self._write({'crc':(str(path), size, modified, crc)}, self._file)
+
+  def record_done(self, rel_parts):
+    self.frontier = rel_parts
+    self._emitted.clear()
+    self._crcs.clear()
+    if time.monotonic() - self._last_compacted >= self.interval:
+      self._compact()
+    else:
+      self._write({'done':rel_parts, 'diffs':self.total_diffs, 'offset':self.output_offset},
+                  self._file)
+      self._file.flush()
+
+  def finish(self):
+    """The comparison is complete, so the checkpoint is no longer needed."""
+    self._file.close()
+    self.path.unlink()
+
+
+class CheckpointedTree:
+  """Wrap a tree so that it saves the checksums it computes to a `Checkpoint`, and reuses ones that
+  were saved before (if the file's size and modified time haven't changed)."""
+
+  def __init__(self, tree, checkpoint):
+    self._tree = tree
+    self._checkpoint = checkpoint
+
+  def __getattr__(self, name):
+    return getattr(self._tree, name)
+
+  def get_crc32(self, path):
+    size = self._tree.get_size(path)
+    modified = self._tree.get_modified(path)
+    crc = self._checkpoint.get_crc(path, size, modified)
+    if crc is None:
+      crc = self._tree.get_crc32(path)
+      self._checkpoint.record_crc(path, size, modified, crc)
+    return crc
+
+
+########## Metrics ##########
+
+class Metrics:
+  """Statistics about a run, for --metrics-file.
+  The file is written in the Prometheus text exposition format, with the paths being compared as
+  labels, so several runs can write their own files to the same textfile collector directory. It's
+  replaced atomically, so a collector never reads a partial one. With an `interval`, `update()`
+  rewrites it whenever that many seconds have passed since it was last written."""
+
+  def __init__(self, path, path1, path2, interval=None):
+    self.path = path
+    self.labels = {'path1':path1, 'path2':path2}
+    self.interval = interval
+    self.start = time.monotonic()
+    self.last_written = self.start
+    self.diffs = collections.Counter()
+    self.files_scanned = 0
+    self.bytes_scanned = 0
+    self.files_hashed = 0
+    self.bytes_hashed = 0
+    self.hash_seconds = 0
+    self.phase_seconds = collections.Counter()
+    self.error_counter = ErrorCounter()
+
+  def count_errors(self):
+    """Start counting the errors logged (by `log_error()` or otherwise), even if the log level is
+    too high for them to be printed."""
+    root_logger = logging.getLogger()
+    for handler in root_logger.handlers:
+      handler.setLevel(max(handler.level, root_logger.level))
+    root_logger.setLevel(min(root_logger.level, logging.ERROR))
+    root_logger.addHandler(self.error_counter)
+
+  def add_diff(self, diff):
+    self.diffs[diff.diff_type] += 1
+    self.update()
+
+  def add_compared(self, diff):
+    """Count a pair of paths compared by `compare_paths()` (whatever the result)."""
+    if diff.path_type == 'file':
+      self.files_scanned += 1
+      if diff.diff1.size is not None:
+        self.bytes_scanned += diff.diff1.size
+
+  def add_hashed(self, size, seconds):
+    self.files_hashed += 1
+    self.bytes_hashed += size
+    self.hash_seconds += seconds
+    self.update()
+
+  def time_phase(self, phase, diffs):
+    """Yield from the `diffs` generator, adding the time spent in it to the total for the `phase`.
+    The time the caller spends on each diff isn't counted."""
+    try:
+      while True:
+        start = time.monotonic()
+        try:
+          diff = next(diffs)
+        finally:
+          self.phase_seconds[phase] += time.monotonic() - start
+        yield diff
+    except StopIteration:
+      return
+    finally:
+      diffs.close()
+
+  def update(self):
+    if self.interval is not None and time.monotonic() - self.last_written >= self.interval:
+      self.write()
+
+  def write(self, finished=False, stopped=False):
+    tmp_path = self.path.with_name(self.path.name+'.tmp')
+    with tmp_path.open('wt') as metrics_file:
+      for line in self.format(finished, stopped):
+        print(line, file=metrics_file)
+    os.replace(tmp_path, self.path)
+    self.last_written = time.monotonic()
+
+  def format(self, finished=False, stopped=False):
+    elapsed = time.monotonic() - self.start
+    hash_rate = self.bytes_hashed / self.hash_seconds if self.hash_seconds else 0
+    scan_rate = self.files_scanned / elapsed if elapsed else 0
+    diff_types = list(DIFF_TYPES) + sorted(set(self.diffs) - set(DIFF_TYPES))
+    metrics = (
+      ('diffs_total', 'counter', 'Differences found, by type.',
+        [({'type':diff_type}, self.diffs[diff_type]) for diff_type in diff_types]),
+      ('files_scanned_total', 'counter', 'Pairs of files whose metadata was compared.',
+        self.files_scanned),
+      ('bytes_scanned_total', 'counter', 'Total size of the files compared (in path1).',
+        self.bytes_scanned),
+      ('files_hashed_total', 'counter', 'Files read to compute checksums (on either side).',
+        self.files_hashed),
+      ('bytes_hashed_total', 'counter', 'Total size of the files read for checksums.',
+        self.bytes_hashed),
+      ('errors_total', 'counter', 'Errors logged.', self.error_counter.count),
+      ('phase_duration_seconds', 'gauge', 'Time spent in each phase of the comparison.',
+        [({'phase':phase}, seconds) for phase, seconds in sorted(self.phase_seconds.items())]),
+      ('hash_duration_seconds', 'gauge', 'Time spent computing checksums.', self.hash_seconds),
+      ('duration_seconds', 'gauge', 'Time since the run started.', elapsed),
+      ('hash_throughput_bytes_per_second', 'gauge', 'Bytes hashed per second spent hashing.',
+        hash_rate),
+      ('scan_throughput_files_per_second', 'gauge', 'Files compared per second of the run.',
+        scan_rate),
+      ('run_finished', 'gauge', 'Whether the run finished (0 while it\'s in progress, or if it died).',
+        int(finished)),
+      ('run_stopped_early', 'gauge', 'Whether the run was stopped early by --fail-fast.',
+        int(stopped)),
+      ('last_update_timestamp_seconds', 'gauge', 'When this file was written.', time.time()),
+    )
+    for name, metric_type, help_text, values in metrics:
+      yield f'# HELP synctest_{name} {help_text}'
+      yield f'# TYPE synctest_{name} {metric_type}'
+      if not isinstance(values, list):
+        values = [({}, values)]
+      for extra_labels, value in values:
+        labels = ','.join(f'{key}="{escape_label_value(label_value)}"'
+                          for key, label_value in {**self.labels, **extra_labels}.items())
+        if isinstance(value, float):
+          value = round(value, 6)
+        yield f'synctest_{name}{{{labels}}} {value}'
+
+
+def escape_label_value(value):
+  """Escape a string for a Prometheus label value. Undecodable bytes in filenames (surrogate
+  escapes) are written as backslash escapes, since the format has to be valid UTF-8."""
+  value = value.encode('utf-8', 'surrogateescape').decode('utf-8', 'backslashreplace')
+  return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class ErrorCounter(logging.Handler):
+  """A logging handler that just counts the errors."""
+
+  def __init__(self):
+    super().__init__(level=logging.ERROR)
+    self.count = 0
+
+  def emit(self, record):
+    self.count += 1
+
+
+class MeteredTree:
+  """Wrap a tree so that the checksums it computes are counted in a `Metrics`, along with the time
+  they take. It also gives the `Metrics` a chance to update its file for each directory walked."""
+
+  def __init__(self, tree, metrics):
+    self._tree = tree
+    self._metrics = metrics
+
+  def __getattr__(self, name):
+    return getattr(self._tree, name)
+
+  def walk(self, top, followlinks=False, onerror=None):
+    for result in self._tree.walk(top, followlinks=followlinks, onerror=onerror):
+      self._metrics.update()
+      yield result
+
+  def get_crc32(self, path):
+    start = time.monotonic()
+    crc = self._tree.get_crc32(path)
+    self._metrics.add_hashed(self._tree.get_size(path), time.monotonic() - start)
+    return crc
+
+  def prefetch_crc32(self, paths):
+    start = time.monotonic()
+    self._tree.prefetch_crc32(paths)
+    self._metrics.hash_seconds += time.monotonic() - start
+
+
+########## Watching ##########
+
+def watch_compare(root1, root2, ignore1, ignore2, rescan_interval=None, path_filter=None,
+                  follow_links=False, tree1=None, tree2=None, **compare_args):
+  """Compare two local directories with `recursive_compare()`, then keep watching them with inotify
+  (see `TreeWatcher`) and re-compare the paths that change, forever.
+  Each difference is yielded when it's first found, and again whenever it changes. When one goes
+  away, an 'equal' `Diff` for the path is yielded. If the inotify event queue overflows, or every
+  `rescan_interval` seconds, everything is compared again.
+  Other keyword arguments are passed on to `recursive_compare()`. Stops on a KeyboardInterrupt."""
+  tree1 = tree1 or LOCAL_TREE
+  tree2 = tree2 or LOCAL_TREE
+  compare_args.update(path_filter=path_filter, follow_links=follow_links, tree1=tree1, tree2=tree2)
+  # Start watching before the first comparison, so nothing that changes during it is missed.
+  watcher = TreeWatcher(root1, root2, follow_links=follow_links, path_filter=path_filter)
+  if watcher.incomplete and rescan_interval is None:
+    logging.warning('Warning: Changes in some directories won\'t be noticed. Consider using '
+                    '--rescan-interval.')
+  # The current differences, by relative path.
+  diffs = {}
+  try:
+    yield from update_diffs(
+      diffs, None, recursive_compare(root1, root2, ignore1, ignore2, **compare_args), root1, root2
+    )
+    last_scan = time.monotonic()
+    while True:
+      timeout = None
+      if rescan_interval is not None:
+        timeout = max(last_scan + rescan_interval - time.monotonic(), 0)
+      changed = watcher.get_changes(timeout)
+      # Cached stats are out of date now, including the ones for finding the changed subtrees.
+      forget_cached(tree1, tree2)
+      if '' in changed or (rescan_interval is not None and
+                           time.monotonic() - last_scan >= rescan_interval):
+        logging.info('Re-comparing everything.')
+        subtrees = [None]
+        last_scan = time.monotonic()
+      else:
+        subtrees = get_changed_subtrees(changed, root1, root2, tree1, tree2, path_filter)
+      for subtree in subtrees:
+        logging.debug(f'Re-comparing {subtree!r}.')
+        new_diffs = recursive_compare(root1, root2, ignore1, ignore2, subtree=subtree,
+                                      **compare_args)
+        yield from update_diffs(diffs, subtree, new_diffs, root1, root2)
+  except KeyboardInterrupt:
+    return
+  finally:
+    watcher.close()
+
+
+def update_diffs(diffs, subtree, new_diffs, root1, root2):
+  """Replace the `diffs` (a dict of relative paths to `Diff`s) at and under the `subtree` (None for
+  everything) with the `new_diffs`. Yield each one that's new or changed, and an 'equal' `Diff` for
+  each old one that's gone."""
+  old_diffs = {rel_path: diff for rel_path, diff in diffs.items()
+               if subtree is None or rel_path == subtree or rel_path.startswith(subtree+'/')}
+  for diff in new_diffs:
+    rel_path = get_diff_rel_path(root1, root2, diff)
+    old_diff = old_diffs.pop(rel_path, None)
+    diffs[rel_path] = diff
+    if old_diff is None or format_tsv(root1, root2, old_diff) != format_tsv(root1, root2, diff):
+      yield diff
+  for rel_path, old_diff in old_diffs.items():
+    del diffs[rel_path]
+    yield Diff('equal', old_diff.path_type, PathInfo(root1/rel_path), PathInfo(root2/rel_path))
+
+
+def get_diff_rel_path(root1, root2, diff):
+  if diff.diff1.path is not None:
+    return remove_root(root1, diff.diff1.path)
+  else:
+    return remove_root(root2, diff.diff2.path)
+
+
+def get_changed_subtrees(changed, root1, root2, tree1, tree2, path_filter=None):
+  """Decide which subtrees to re-compare, given the relative paths that changed.
+  Paths inside a directory that's missing on one side are only compared as part of that directory,
+  and paths inside other changed paths don't need comparing on their own."""
+  subtrees = set()
+  for rel_path in changed:
+    # Go up to the first directory that's on both sides.
+    parent = posixpath.dirname(rel_path)
+    while parent and not (tree1.get_type(root1/parent) == 'dir' and
+                          tree2.get_type(root2/parent) == 'dir'):
+      rel_path = parent
+      parent = posixpath.dirname(rel_path)
+    if path_filter is not None and path_filter.excludes(rel_path):
+      continue
+    subtrees.add(rel_path)
+  for rel_path in sorted(subtrees, key=get_rel_depth):
+    parent = posixpath.dirname(rel_path)
+    while parent and parent not in subtrees:
+      parent = posixpath.dirname(parent)
+    if parent:
+      subtrees.discard(rel_path)
+  return sorted(subtrees)
+
+
+class TreeWatcher:
+  """Watch every directory in two local trees with inotify, to find the paths that change.
+  Paths are relative to the roots, so a change on either side means comparing the path on both. If
+  there aren't enough inotify watches for every directory, `incomplete` is set."""
+
+  def __init__(self, root1, root2, follow_links=False, path_filter=None):
+    self.roots = (root1, root2)
+    self.follow_links = follow_links
+    self.path_filter = path_filter
+    self.inotify = Inotify()
+    self.incomplete = False
+    # Watch descriptors to (side, relative path) tuples.
+    self.watches = {}
+    for side in range(2):
+      self.watch_tree(side, '')
+
+  def watch_tree(self, side, rel_dir):
+    """Watch a directory on one side, and all the ones under it."""
+    root = self.roots[side]
+    top = root/rel_dir if rel_dir else root
+    for dirpath, dirnames, filenames in os.walk(top, followlinks=self.follow_links,
+                                                onerror=log_error):
+      rel_path = get_rel_dir(root, dirpath)
+      if self.path_filter is not None:
+        dirnames[:] = [name for name in dirnames
+                       if not self.path_filter.excludes(join_rel(rel_path, name))]
+      try:
+        wd = self.inotify.add_watch(dirpath, WATCH_MASK)
+      except OSError as error:
+        if error.errno != errno.ENOSPC:
+          log_error(error)
+        elif not self.incomplete:
+          logging.warning('Warning: Ran out of inotify watches (see '
+                          '/proc/sys/fs/inotify/max_user_watches).')
+        self.incomplete = True
+        continue
+      self.watches[wd] = (side, rel_path)
+
+  def unwatch_tree(self, side, rel_dir):
+    """Stop watching a directory on one side (because it moved), and all the ones under it."""
+    for wd, (watch_side, rel_path) in list(self.watches.items()):
+      if watch_side == side and (rel_path == rel_dir or rel_path.startswith(rel_dir+'/')):
+        self.inotify.rm_watch(wd)
+        del self.watches[wd]
+
+  def get_changes(self, timeout=None):
+    """Wait up to `timeout` seconds (forever, if None) for something to change. Then keep collecting
+    changes until there have been none for `WATCH_SETTLE` seconds. Returns the set of relative paths
+    that changed. It includes '' if everything has to be compared again."""
+    changed = set()
+    events = self.inotify.read(timeout)
+    while events:
+      for wd, mask, name in events:
+        if mask & IN_Q_OVERFLOW:
+          logging.warning('Warning: Too many changes at once (the inotify queue overflowed).')
+          changed.add('')
+          continue
+        try:
+          side, rel_dir = self.watches[wd]
+        except KeyError:
+          continue
+        if mask & IN_IGNORED:
+          del self.watches[wd]
+          continue
+        if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+          # The parent directory gets its own event, unless this is the root.
+          if not rel_dir:
+            changed.add('')
+          continue
+        rel_path = join_rel(rel_dir, name)
+        if mask & IN_ISDIR and mask & IN_MOVED_FROM:
+          self.unwatch_tree(side, rel_path)
+        if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+          self.watch_tree(side, rel_path)
+        changed.add(rel_path)
+      events = self.inotify.read(WATCH_SETTLE)
+    return changed
+
+  def close(self):
+    self.inotify.close()
+
+
+class Inotify:
+  """A minimal interface to Linux's inotify, through ctypes."""
+
+  def __init__(self):
+    self._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    self.fd = self._libc.inotify_init1(os.O_CLOEXEC)
+    if self.fd < 0:
+      self._raise()
+
+  def _raise(self, path=None):
+    error_num = ctypes.get_errno()
+    raise OSError(error_num, os.strerror(error_num), path)
+
+  def add_watch(self, path, mask):
+    wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+    if wd < 0:
+      self._raise(os.fspath(path))
+    return wd
+
+  def rm_watch(self, wd):
+    # Failing just means it was already removed.
+    self._libc.inotify_rm_watch(self.fd, wd)
+
+  def read(self, timeout=None):
+    """Wait up to `timeout` seconds (forever, if None) for events, and return a list of them, as
+    (watch descriptor, mask, name) tuples."""
+    ready, _, _ = select.select([self.fd], [], [], timeout)
+    if not ready:
+      return []
+    data = os.read(self.fd, 1024*1024)
+    events = []
+    offset = 0
+    while offset < len(data):
+      wd, mask, cookie, length = INOTIFY_EVENT.unpack_from(data, offset)
+      offset += INOTIFY_EVENT.size
+      name = data[offset:offset+length].rstrip(b'\0')
+      offset += length
+      events.append((wd, mask, os.fsdecode(name)))
+    return events
+
+  def close(self):
+    os.close(self.fd)
+
+
+########## Time budgets ##########
+
+class CandidateFiles:
+  """The pairs of files whose metadata was equal, found by `recursive_compare()` for
+  `hash_candidates()` to check later. That can be nearly every file in the tree, so instead of a
+  `Diff` for each, only the name is kept, with a row number for its directory (each directory is
+  stored once) and the size and modified times in flat arrays, like `SurveyRecords`. The `Diff`s are
+  created again on access, by index."""
+
+  def __init__(self, root1, root2):
+    self.root1 = root1
+    self.root2 = root2
+    self._dirs = []
+    self._dir_rows = {}
+    self._dir_row = array.array('q')
+    self._names = []
+    self._size = array.array('q')
+    self._modified1 = array.array('q')
+    self._modified2 = array.array('q')
+
+  def append(self, diff):
+    rel_dir, sep, name = remove_root(self.root1, diff.diff1.path).rpartition('/')
+    dir_row = self._dir_rows.get(rel_dir)
+    if dir_row is None:
+      dir_row = self._dir_rows[rel_dir] = len(self._dirs)
+      self._dirs.append(rel_dir)
+    self._dir_row.append(dir_row)
+    self._names.append(name)
+    self._size.append(diff.diff1.size)
+    self._modified1.append(diff.diff1.modified)
+    self._modified2.append(diff.diff2.modified)
+
+  def __len__(self):
+    return len(self._names)
+
+  def get_rel_path(self, index):
+    rel_dir = self._dirs[self._dir_row[index]]
+    if rel_dir:
+      return rel_dir+'/'+self._names[index]
+    else:
+      return self._names[index]
+
+  def get_size(self, index):
+    return self._size[index]
+
+  def __getitem__(self, index):
+    rel_path = self.get_rel_path(index)
+    size = self._size[index]
+    diff1 = PathInfo(posixpath.join(str(self.root1), rel_path), type='file', size=size,
+                     modified=self._modified1[index])
+    diff2 = PathInfo(posixpath.join(str(self.root2), rel_path), type='file', size=size,
+                     modified=self._modified2[index])
+    return Diff('equal', 'file', diff1, diff2)
+
+
+def hash_candidates(candidates, tree1, tree2, indices=None, deadline=None, cache=None,
+                    unverified_path=None, batch_size=1, die_on_error=False):
+  """Compare the checksums of the `candidates` (a `CandidateFiles`), or just the ones at `indices`,
+  in order of priority, until the `deadline` (a `time.monotonic()` time), and yield a `Diff` for each
+  pair whose checksums differ. Files are hashed `batch_size` pairs at a time, so trees can prefetch.
+  The pairs verified to be equal are recorded in the `VerifyCache`, if there is one. The ones there
+  wasn't time for are written to `unverified_path`, or logged.
+  Returns the number of pairs whose checksums were compared, and how many of them differed."""
+  root1 = candidates.root1
+  if indices is None:
+    indices = range(len(candidates))
+  order = array.array('q', sorted(
+    indices, key=lambda index: get_hash_priority(candidates[index], root1, cache)
+  ))
+  unverified = array.array('q')
+  compared = differing = 0
+  hashed_bytes = 0
+  hashing_time = 0
+  i = 0
+  try:
+    while i < len(order):
+      remaining = float('inf')
+      if deadline is not None:
+        remaining = deadline - time.monotonic()
+      if remaining <= 0:
+        break
+      batch = []
+      while i < len(order) and len(batch) < batch_size:
+        index = order[i]
+        i += 1
+        # Skip files the hashing rate so far says there isn't time for. Smaller ones might fit.
+        if hashed_bytes and 2*candidates.get_size(index)*hashing_time/hashed_bytes > remaining:
+          unverified.append(index)
+        else:
+          batch.append(candidates[index])
+      start = time.monotonic()
+      paths1 = [diff.diff1.path for diff in batch]
+      paths2 = [diff.diff2.path for diff in batch]
+      if tree1 is tree2:
+        tree1.prefetch_crc32(paths1+paths2)
+      else:
+        tree1.prefetch_crc32(paths1)
+        tree2.prefetch_crc32(paths2)
+      for diff in batch:
+        try:
+          diff.diff1.crc = tree1.get_crc32(diff.diff1.path)
+          diff.diff2.crc = tree2.get_crc32(diff.diff2.path)
+        except OSError as error:
+          if die_on_error:
+            raise
+          logging.error('Error: {}'.format(error))
+          continue
+        compared += 1
+        hashed_bytes += 2*diff.diff1.size
+        if diff.diff1.crc != diff.diff2.crc:
+          if cache is not None:
+            cache.forget(remove_root(root1, diff.diff1.path))
+          differing += 1
+          diff.diff_type = 'crc'
+          yield pathize(diff)
+        elif cache is not None:
+          cache.record(remove_root(root1, diff.diff1.path), diff)
+      hashing_time += time.monotonic() - start
+      # Batched trees keep the stats and checksums of every path they've seen, which would add up to
+      # the whole tree by the end.
+      forget_cached(tree1, tree2)
+  finally:
+    if cache is not None:
+      cache.save()
+  unverified.extend(order[i:])
+  report_unverified(candidates, unverified, unverified_path)
+  return compared, differing
+
+
+def verify_sample(candidates, tree1, tree2, sample_arg, seed=None, **hash_args):
+  """Compare the checksums of a sample of the `candidates` (see `choose_sample()`) with
+  `hash_candidates()`, then log the upper bound on the fraction of them with different contents.
+  `sample_arg` is a ('percent', value) or ('count', value) tuple from `parse_sample()`."""
+  if seed is None:
+    seed = str(int.from_bytes(os.urandom(4), 'big'))
+  sample_type, value = sample_arg
+  if sample_type == 'percent':
+    sample_size = math.ceil(len(candidates) * value / 100)
+  else:
+    sample_size = value
+  sample = choose_sample(candidates, sample_size, seed)
+  logging.info(f'Verifying a sample of {len(sample)} of {len(candidates)} files (seed {seed}).')
+  compared, differing = yield from hash_candidates(candidates, tree1, tree2, indices=sample,
+                                                   **hash_args)
+  if compared == 0:
+    logging.warning(f'Sample: No files compared (seed {seed}).')
+    return
+  bound = get_binomial_upper_bound(differing, compared)
+  logging.warning(
+    f'Sample: {differing} of {compared} files had different contents (out of {len(candidates)} '
+    f'candidates, seed {seed}). With 95% confidence, at most {100*bound:0.4g}% of the files '
+    f'(~{math.ceil(bound*len(candidates))}) have different contents.'
+  )
+
+
+def choose_sample(candidates, sample_size, seed):
+  """Choose a stratified random sample of `sample_size` of the `candidates` (a `CandidateFiles`), and
+  return their indices.
+  The strata are the combinations of size class (powers of 16 bytes) and top-level directory, and each
+  gets a share of the sample proportional to its number of files (largest remainders get the spare
+  places). Within a stratum, files are chosen by a hash of the seed and their path, so the same seed
+  always picks the same files. The strata are counted first, so that only each one's share of the
+  files with the lowest hashes needs to be kept while looking for them."""
+  if sample_size >= len(candidates):
+    return list(range(len(candidates)))
+  counts = collections.Counter(get_sample_stratum(candidates, index)
+                               for index in range(len(candidates)))
+  shares = {}
+  remainders = []
+  for stratum, count in counts.items():
+    exact = sample_size * count / len(candidates)
+    shares[stratum] = int(exact)
+    remainders.append((exact - int(exact), stratum))
+  spare = sample_size - sum(shares.values())
+  for remainder, stratum in sorted(remainders, reverse=True)[:spare]:
+    shares[stratum] += 1
+  # A max-heap (by negated hash) of the lowest hashes so far in each stratum.
+  chosen = collections.defaultdict(list)
+  for index in range(len(candidates)):
+    stratum = get_sample_stratum(candidates, index)
+    share = shares[stratum]
+    if not share:
+      continue
+    rel_path = candidates.get_rel_path(index)
+    key = hashlib.blake2b(f'{seed}\t{rel_path}'.encode(), digest_size=8).digest()
+    member = (-int.from_bytes(key, 'big'), index)
+    heap = chosen[stratum]
+    if len(heap) < share:
+      heapq.heappush(heap, member)
+    elif member > heap[0]:
+      heapq.heapreplace(heap, member)
+  return sorted(index for heap in chosen.values() for key, index in heap)
+
+
+def get_sample_stratum(candidates, index):
+  top, sep, rest = candidates.get_rel_path(index).partition('/')
+  if not sep:
+    top = '.'
+  return (candidates.get_size(index).bit_length() // 4, top)
+
+
+def get_binomial_upper_bound(failures, trials, confidence=0.95):
+  """The one-sided Clopper-Pearson upper confidence bound on the failure rate, after seeing
+  `failures` in `trials`: the rate at which seeing this few failures has a probability of only
+  1-`confidence`. With no failures, that's 1-(1-confidence)**(1/trials) (about 3/trials for 95%)."""
+  alpha = 1 - confidence
+  if failures >= trials:
+    return 1.0
+  if failures == 0:
+    return 1 - alpha ** (1/trials)
+  low = failures / trials
+  high = 1.0
+  for i in range(64):
+    middle = (low + high) / 2
+    if get_binomial_cdf(failures, trials, middle) > alpha:
+      low = middle
+    else:
+      high = middle
+  return high
+
+
+def get_binomial_cdf(k, n, p):
+  """The probability of at most `k` successes in `n` trials with probability `p`."""
+  log_p = math.log(p)
+  log_q = math.log1p(-p)
+  total = 0
+  for i in range(k+1):
+    log_comb = math.lgamma(n+1) - math.lgamma(i+1) - math.lgamma(n-i+1)
+    total += math.exp(log_comb + i*log_p + (n-i)*log_q)
+  return min(total, 1.0)
+
+
+def get_hash_priority(diff, root1, cache=None):
+  """Sort key for `hash_candidates()`: never-verified files first, then the ones verified longest
+  ago, then the most recently modified (by day), then the largest."""
+  verified = None
+  if cache is not None:
+    verified = cache.get_verified(remove_root(root1, diff.diff1.path), diff)
+  modified = max(diff.diff1.modified, diff.diff2.modified)
+  return (verified is not None, verified or 0, -(modified // (60*60*24)), -diff.diff1.size)
+
+
+def report_unverified(candidates, unverified, unverified_path=None):
+  """Report the `candidates` at the `unverified` indices."""
+  if not unverified:
+    return
+  total_bytes = sum(candidates.get_size(index) for index in unverified)
+  logging.warning(f'Warning: Ran out of time before verifying {len(unverified)} files '
+                  f'({total_bytes} bytes).')
+  rel_paths = sorted(candidates.get_rel_path(index) for index in unverified)
+  if unverified_path is None:
+    for rel_path in rel_paths:
+      logging.warning(f'Unverified: {rel_path}')
+  else:
+    with unverified_path.open('wt', errors='surrogateescape') as unverified_file:
+      for rel_path in rel_paths:
+        print(rel_path, file=unverified_file)
+
+
+class VerifyCache:
+  """When each pair of files was last verified to have equal checksums, for --time-budget.
+  Saved as tab-delimited lines of: relative path, size, the modified times of both files, the crc32,
+  and the unix time of the verification. An entry is only valid while the size and modified times
+  are the same."""
+
+  def __init__(self, path):
+    self.path = path
+    self.entries = {}
+    try:
+      with path.open('rt', errors='surrogateescape') as cache_file:
+        for line in cache_file:
+          fields = line.rstrip('\r\n').split('\t')
+          try:
+            rel_path = fields[0]
+            size, modified1, modified2, crc, verified = [int(field) for field in fields[1:]]
+          except ValueError:
+            logging.warning(f'Warning: Invalid line in {str(path)!r}: {line!r}')
+            continue
+          self.entries[rel_path] = (size, modified1, modified2, crc, verified)
+    except FileNotFoundError:
+      pass
+
+  def get_verified(self, rel_path, diff):
+    """Get the time this pair was last verified, or None if it never was (with the same metadata)."""
+    try:
+      size, modified1, modified2, crc, verified = self.entries[rel_path]
+    except KeyError:
+      return None
+    if (size, modified1, modified2) != (diff.diff1.size, diff.diff1.modified, diff.diff2.modified):
+      return None
+    return verified
+
+  def record(self, rel_path, diff, verified=None):
+    if verified is None:
+      verified = int(time.time())
+    self.entries[rel_path] = (
+      diff.diff1.size, diff.diff1.modified, diff.diff2.modified, diff.diff1.crc, verified
+    )
+
+  def forget(self, rel_path):
+    self.entries.pop(rel_path, None)
+
+  def save(self):
+    tmp_path = self.path.with_name(self.path.name+'.tmp')
+    with tmp_path.open('wt', errors='surrogateescape') as cache_file:
+      for rel_path, entry in sorted(self.entries.items()):
+        print(rel_path, *entry, sep='\t', file=cache_file)
+    os.replace(tmp_path, self.path)
+
+
+########## Estimates ##########
+
+class ComparisonEstimate:
+  """The size of a directory comparison and the costs of its operations, estimated from a sample of
+  it by `estimate_comparison()`."""
+
+  def __init__(self):
+    self.probes = 0
+    self.dirs_sampled = 0
+    # Estimated totals for the whole comparison:
+    # The paths listed, in both trees.
+    self.entries = 0
+    # The paths in both trees, which get compared.
+    self.pairs = 0
+    # The files in both trees which get hashed (the ones with the same sizes and modified times), and
+    # the total of their sizes.
+    self.files = 0
+    self.bytes = 0
+    # The files with the same sizes but different modified times, which only get hashed with
+    # --checksum-if-date-diff, and the total of their sizes.
+    self.date_diff_files = 0
+    self.date_diff_bytes = 0
+    # The bytes of the files which get hashed that have valid entries in the --verify-cache.
+    self.cached_bytes = 0
+    # Measured costs, in seconds per path listed and per pair compared (just their metadata).
+    self.list_seconds = 0
+    self.compare_seconds = 0
+    # The (seconds per file, seconds per byte) to hash a file, in each tree.
+    self.read_costs = [None, None]
+
+  def get_metadata_seconds(self):
+    return self.entries*self.list_seconds + self.pairs*self.compare_seconds
+
+  def get_hash_seconds(self, date_diff=False):
+    """How long hashing the files in both trees would take, or None if it couldn't be measured.
+    With `date_diff`, that includes the ones with different modified times."""
+    files = self.files
+    total_bytes = self.bytes
+    if date_diff:
+      files += self.date_diff_files
+      total_bytes += self.date_diff_bytes
+    total = 0
+    for read_cost in self.read_costs:
+      if read_cost is None:
+        # Without anything to read, there's nothing to hash (empty files are just opened).
+        if total_bytes:
+          return None
+        continue
+      seconds_per_file, seconds_per_byte = read_cost
+      total += files*seconds_per_file + total_bytes*seconds_per_byte
+    return total
+
+
+def estimate_comparison(root1, root2, tree1, tree2, follow_links=False, path_filter=None,
+                        max_depth=None, subtree=None, date_tolerance=0, verify_cache=None, seed=None,
+                        probes=ESTIMATE_PROBES):
+  """Estimate the size of a comparison of two directories, and the cost of listing, comparing, and
+  hashing their paths, by sampling it. Each probe descends from the root to a leaf directory,
+  choosing a random subdirectory (present in both trees) at each level, and the counts seen are
+  weighted by the product of the numbers of subdirectories chosen from along the way (Knuth's
+  estimator for the size of a tree). Each directory is sampled by a `DirectorySampler` the first
+  time a probe reaches it. At the end, some of the files it compared are hashed to measure the read
+  rate of each tree. The fraction of the files with valid entries in the `VerifyCache` (if given) is
+  estimated from the sampled files too."""
+  rng = random.Random(seed)
+  sampler = DirectorySampler(root1, root2, tree1, tree2, rng, follow_links=follow_links,
+                             path_filter=path_filter, date_tolerance=date_tolerance,
+                             verify_cache=verify_cache)
+  estimate = ComparisonEstimate()
+  estimate.probes = probes
+  samples = {}
+  totals = [0]*7
+  for probe in range(probes):
+    weight = 1
+    rel_dir = subtree or ''
+    while True:
+      try:
+        sample = samples[rel_dir]
+      except KeyError:
+        sample = samples[rel_dir] = sampler.sample(rel_dir)
+      if sample is None:
+        break
+      counts, subdirs = sample
+      for i, count in enumerate(counts):
+        totals[i] += weight*count
+      # Stop where the walk would: at leaves, and at the maximum depth.
+      if not subdirs:
+        break
+      if max_depth is not None and get_rel_depth(rel_dir) - get_rel_depth(subtree) + 1 >= max_depth:
+        break
+      weight *= len(subdirs)
+      rel_dir = join_rel(rel_dir, rng.choice(subdirs))
+  estimate.dirs_sampled = len(samples)
+  (estimate.entries, estimate.pairs, estimate.files, estimate.bytes, estimate.date_diff_files,
+   estimate.date_diff_bytes, estimate.cached_bytes) = [total/probes for total in totals]
+  if sampler.listed:
+    estimate.list_seconds = sampler.list_time/sampler.listed
+  if sampler.compared:
+    estimate.compare_seconds = sampler.compare_time/sampler.compared
+  estimate.read_costs = sampler.measure_reads()
+  return estimate
+
+
+class DirectorySampler:
+  """Sample directories of a comparison for `estimate_comparison()`, timing the listings and the
+  comparisons of a sample of the files in each, and keeping a random sample of the files in both
+  trees, to hash at the end."""
+
+  def __init__(self, root1, root2, tree1, tree2, rng, follow_links=False, path_filter=None,
+               date_tolerance=0, verify_cache=None):
+    self.roots = (root1, root2)
+    self.trees = (tree1, tree2)
+    self.rng = rng
+    self.follow_links = follow_links
+    self.path_filter = path_filter
+    self.date_tolerance = date_tolerance
+    self.verify_cache = verify_cache
+    self.list_time = self.listed = 0
+    self.compare_time = self.compared = 0
+    # A reservoir sample of the files found in both trees: (path1, path2, size)
+    self.to_read = []
+    self.files_seen = 0
+
+  def sample(self, rel_dir):
+    """Sample one directory. Returns the estimated counts of what the comparison would find in it
+    (see `get_counts()`), and the names of the subdirectories the walk would descend into. Returns
+    None if it can't be listed."""
+    tree1, tree2 = self.trees
+    dirpath1, dirpath2 = [os.fspath(root/rel_dir if rel_dir else root) for root in self.roots]
+    start = time.monotonic()
+    walker1 = tree1.walk(dirpath1, followlinks=self.follow_links, onerror=log_error)
+    walker2 = tree2.walk(dirpath2, followlinks=self.follow_links, onerror=log_error)
+    try:
+      walker_paths1 = next(walker1, None)
+      walker_paths2 = next(walker2, None)
+      if walker_paths1 is None or walker_paths2 is None:
+        return None
+      if self.path_filter is not None:
+        filter_walker_paths(self.path_filter, rel_dir, walker_paths1)
+        filter_walker_paths(self.path_filter, rel_dir, walker_paths2)
+      dir1, dirnames1, filenames1 = walker_paths1
+      dir2, dirnames2, filenames2 = walker_paths2
+      num_files1, names = sample_names(filenames1, ESTIMATE_DIR_SAMPLE, self.rng)
+      num_files2 = sum(1 for name in filenames2)
+      self.list_time += time.monotonic() - start
+      entries = len(dirnames1) + num_files1 + len(dirnames2) + num_files2
+      self.listed += entries
+      prefix1 = get_dir_prefix(dir1)
+      prefix2 = get_dir_prefix(dir2)
+      diffs = []
+      for name in names:
+        start = time.monotonic()
+        try:
+          diff = compare_paths(prefix1+name, prefix2+name, date_tolerance=self.date_tolerance,
+                               crc='none', tree1=tree1, tree2=tree2)
+        except OSError:
+          continue
+        if diff.diff2.type == 'nonexistent':
+          continue
+        self.compare_time += time.monotonic() - start
+        self.compared += 1
+        diffs.append((join_rel(rel_dir, name), diff))
+        if diff.path_type == 'file' and diff.diff1.size:
+          self.files_seen += 1
+          add_to_reservoir(self.to_read, ESTIMATE_READ_FILES, self.files_seen,
+                           (prefix1+name, prefix2+name, diff.diff1.size), self.rng)
+      dirnames2_set = set(dirnames2)
+      subdirs = [name for name in dirnames1 if name in dirnames2_set]
+      # Extrapolate from the sample to all the files in the directory.
+      scale = num_files1/len(names) if names else 0
+      pairs, *file_counts = self.get_counts(diffs)
+      counts = (entries, len(subdirs) + pairs*scale) + tuple(count*scale for count in file_counts)
+      if not self.follow_links:
+        subdirs = [name for name in subdirs if tree1.get_type(prefix1+name) == 'dir']
+      return counts, subdirs
+    finally:
+      walker1.close()
+      walker2.close()
+
+  def get_counts(self, diffs):
+    """Count the sampled `(rel_path, diff)` pairs compared in a directory: the pairs, then the
+    files (and their bytes) with the same size and modified time, which get hashed, the ones with
+    only the same size, which only get hashed with --checksum-if-date-diff, and the bytes of the
+    ones hashed which the `VerifyCache` has a valid entry for."""
+    pairs = files = size_total = date_diff_files = date_diff_bytes = cached_bytes = 0
+    for rel_path, diff in diffs:
+      pairs += 1
+      if diff.path_type != 'file':
+        continue
+      if diff.diff_type == 'equal':
+        files += 1
+        size_total += diff.diff1.size
+        cache = self.verify_cache
+        if cache is not None and cache.get_verified(rel_path, diff) is not None:
+          cached_bytes += diff.diff1.size
+      elif diff.diff_type == 'modified':
+        date_diff_files += 1
+        date_diff_bytes += diff.diff1.size
+    return pairs, files, size_total, date_diff_files, date_diff_bytes, cached_bytes
+
+  def measure_reads(self):
+    """Hash the sampled files in each tree (up to `ESTIMATE_READ_BYTES` of them), and fit the costs
+    with `fit_read_cost()`. Returns the `(seconds_per_file, seconds_per_byte)` for each tree."""
+    read_costs = []
+    for side, tree in enumerate(self.trees):
+      samples = []
+      total_bytes = 0
+      for paths_and_size in self.to_read:
+        size = paths_and_size[2]
+        if total_bytes + size > ESTIMATE_READ_BYTES:
+          continue
+        start = time.monotonic()
+        try:
+          tree.get_crc32(paths_and_size[side])
+        except OSError:
+          continue
+        samples.append((size, time.monotonic() - start))
+        total_bytes += size
+      read_costs.append(fit_read_cost(samples))
+    return read_costs
+
+
+def sample_names(names, sample_size, rng):
+  """Count the names (a list, or `SpilledNames`), and choose a random sample of them.
+  Returns the count and the sample."""
+  sample = []
+  count = 0
+  for name in names:
+    count += 1
+    add_to_reservoir(sample, sample_size, count, name, rng)
+  return count, sample
+
+
+def add_to_reservoir(reservoir, size, count, item, rng):
+  """Reservoir sampling: keep a uniform random sample of `size` of the `count` items seen so far."""
+  if len(reservoir) < size:
+    reservoir.append(item)
+  else:
+    i = rng.randrange(count)
+    if i < size:
+      reservoir[i] = item
+
+
+def fit_read_cost(samples):
+  """Fit `seconds = seconds_per_file + size*seconds_per_byte` to the `(size, seconds)` it took to
+  hash each sampled file, by least squares. Returns `(seconds_per_file, seconds_per_byte)`, or None
+  if there are no samples."""
+  if not samples:
+    return None
+  mean_size = sum(size for size, seconds in samples)/len(samples)
+  mean_seconds = sum(seconds for size, seconds in samples)/len(samples)
+  if mean_size*len(samples) < ESTIMATE_MIN_FIT_BYTES:
+    # Reading this little, the time is all overhead, and the rate is just noise.
+    return mean_seconds, 0
+  variance = sum((size-mean_size)**2 for size, seconds in samples)
+  seconds_per_byte = 0
+  if variance > 0:
+    covariance = sum((size-mean_size)*(seconds-mean_seconds) for size, seconds in samples)
+    seconds_per_byte = covariance/variance
+  if seconds_per_byte <= 0:
+    # The sizes are too similar (or the timings too noisy) to tell the two costs apart.
+    return 0, mean_seconds/mean_size
+  return max(mean_seconds - mean_size*seconds_per_byte, 0), seconds_per_byte
+
+
+def predict_strategies(estimate, sample_arg, verify_cache=None):
+  """Predict how long each way of running the comparison would take. Returns a list of
+  `(strategy, level, options, seconds)`, where `level` is from `VERIFICATION_LEVELS`, `options` are
+  the command line options which select the strategy, and `seconds` is None if it couldn't be
+  estimated. The "cached" strategy is only included if there's a `VerifyCache`."""
+  metadata_seconds = estimate.get_metadata_seconds()
+  hash_seconds = estimate.get_hash_seconds()
+
+  def with_hashing(fraction):
+    if hash_seconds is None:
+      return None
+    return metadata_seconds + fraction*hash_seconds
+
+  sample_type, value = sample_arg
+  if sample_type == 'percent':
+    sample_fraction = value/100
+    sample_option = f'--verify-sample {value:g}%'
+  else:
+    sample_fraction = min(value/estimate.files, 1) if estimate.files else 1
+    sample_option = f'--verify-sample {value}'
+  predictions = [
+    ('metadata', 'metadata', '--no-checksum', metadata_seconds),
+    ('sample', 'sample', sample_option, with_hashing(sample_fraction)),
+  ]
+  if verify_cache is not None:
+    unverified_fraction = 1
+    if estimate.bytes:
+      unverified_fraction = max(1 - estimate.cached_bytes/estimate.bytes, 0)
+    seconds = with_hashing(unverified_fraction)
+    budget = '?' if seconds is None else get_auto_time_budget(seconds)
+    predictions.append(('cached', 'incremental',
+                        f'--time-budget {budget} --verify-cache {verify_cache.path}', seconds))
+  predictions.append(('full', 'full', 'the default', with_hashing(1)))
+  # With --checksum-if-date-diff, the files with different modified times are hashed too.
+  date_diff_seconds = estimate.get_hash_seconds(date_diff=True)
+  if date_diff_seconds is not None:
+    date_diff_seconds += metadata_seconds
+  predictions.append(('checksum-if-date-diff', 'full', '--checksum-if-date-diff', date_diff_seconds))
+  return predictions
+
+
+def get_auto_time_budget(seconds):
+  """The --time-budget to give the "cached" strategy, with some room for error in the estimate."""
+  return max(math.ceil(seconds*ESTIMATE_BUDGET_MARGIN), 1)
+
+
+def choose_strategy(predictions, level):
+  """Choose the fastest of the `predict_strategies()` which verifies at least `level`.
+  Returns None if none of those could be estimated."""
+  minimum = VERIFICATION_LEVELS.index(level)
+  candidates = [prediction for prediction in predictions
+                if VERIFICATION_LEVELS.index(prediction[1]) >= minimum and prediction[3] is not None]
+  if not candidates:
+    return None
+  return min(candidates, key=lambda prediction: prediction[3])
+
+
+def format_estimate(estimate, predictions):
+  yield (f'Sampled {estimate.dirs_sampled} directories in {estimate.probes} random descents from '
+         'the root.')
+  yield f'Paths to compare: ~{round(estimate.pairs)}'
+  yield f'Files to hash: ~{round(estimate.files)} ({round(estimate.bytes)} bytes each side)'
+  yield (f'Files with different modified times (hashed with --checksum-if-date-diff): '
+         f'~{round(estimate.date_diff_files)} ({round(estimate.date_diff_bytes)} bytes each side)')
+  yield (f'Listing: {estimate.list_seconds*1e6:.1f} microseconds per path. Comparing metadata: '
+         f'{estimate.compare_seconds*1e6:.1f} microseconds per pair.')
+  for side, read_cost in enumerate(estimate.read_costs, 1):
+    if read_cost is None:
+      yield f'Hashing in dir{side}: not measured (no files of a sampleable size).'
+    else:
+      seconds_per_file, seconds_per_byte = read_cost
+      rate = '?' if seconds_per_byte == 0 else f'{1/seconds_per_byte/1024**2:.1f}'
+      yield f'Hashing in dir{side}: {rate} MB/s, plus {seconds_per_file*1000:.2f} ms per file.'
+  yield 'Estimated time for each strategy:'
+  for strategy, level, options, seconds in predictions:
+    yield f'  {strategy}: {format_duration(seconds)} (verifies {level}; {options})'
+
+
+def format_duration(seconds):
+  if seconds is None:
+    return '?'
+  minutes, seconds = divmod(round(seconds), 60)
+  hours, minutes = divmod(minutes, 60)
+  return f'{hours}:{minutes:02d}:{seconds:02d}'
+
+
+def plan_strategy(args, path_filter):
+  """Run `estimate_comparison()` on the directories in the arguments, and predict the time for each
+  strategy. Returns the `ComparisonEstimate` and the predictions."""
+  local_tree = make_local_tree(args)
+  tree1, root1 = open_tree(args.path1, local_tree)
+  tree2, root2 = open_tree(args.path2, local_tree)
+  for tree, root in (tree1, root1), (tree2, root2):
+    check_tree_root(tree, root)
+  verify_cache = None
+  if args.verify_cache:
+    verify_cache = VerifyCache(args.verify_cache)
+  estimate = estimate_comparison(
+    root1, root2, tree1, tree2, follow_links=args.follow_links, path_filter=path_filter,
+    max_depth=args.max_depth, subtree=args.subtree, date_tolerance=args.date_tolerance,
+    verify_cache=verify_cache, seed=args.seed
+  )
+  sample_arg = args.verify_sample or parse_sample(DEFAULT_AUTO_SAMPLE)
+  return estimate, predict_strategies(estimate, sample_arg, verify_cache)
+
+
+def apply_strategy(args, predictions):
+  """Set the options in `args` for the fastest strategy which meets the --verification-level."""
+  choice = choose_strategy(predictions, args.verification_level)
+  if choice is None:
+    logging.warning('Warning: Couldn\'t estimate the time to hash files. Using the full strategy.')
+    choice = [prediction for prediction in predictions if prediction[0] == 'full'][0]
+  strategy, level, options, seconds = choice
+  logging.warning(f'Auto: Using the {strategy} strategy ({options}), estimated to take '
+                  f'{format_duration(seconds)}.')
+  if strategy == 'metadata':
+    args.crc = 'none'
+  elif strategy == 'sample':
+    args.verify_sample = args.verify_sample or parse_sample(DEFAULT_AUTO_SAMPLE)
+  elif strategy == 'cached':
+    args.time_budget = get_auto_time_budget(seconds)
+  elif strategy == 'checksum-if-date-diff':
+    args.crc = 'date'
+  if strategy != 'sample':
+    args.verify_sample = None
+  if strategy != 'cached':
+    # The cache only applies with --time-budget.
+    args.verify_cache = None
+
+
+########## Duplicates ##########
+
+class DuplicateIndex:
+  """An index of the files seen during a comparison, to find the ones with the same contents, within
+  and across the two trees. Files are bucketed by size, and at the end only the ones which share a
+  size with another file are hashed. Checksums the comparison already computed are reused, and a
+  file which was equal in both trees is only counted (and hashed) once. Files with the same CRC-32
+  are then confirmed to be the same by a BLAKE2b hash of their contents, where they're local."""
+
+  def __init__(self, root1, root2, tree1, tree2, names=None):
+    self.roots = (root1, root2)
+    self.trees = (tree1, tree2)
+    # How to refer to the roots in the output (e.g. as the arguments were given).
+    self.names = names or (str(root1), str(root2))
+    # {size: [(sides, path, crc), ...]}
+    # `sides` is '1', '2', or 'both', and `path` is the path in the first tree the file is in.
+    self._sizes = collections.defaultdict(list)
+    # Files whose size the comparison didn't measure (like missing ones): [(sides, path), ...]
+    self._unsized = []
+
+  def add(self, diff):
+    """Index the files in the `Diff` of a pair of paths from the comparison."""
+    if diff.diff_type == 'equal':
+      if diff.path_type == 'file':
+        self._add('both', diff.diff1.path, diff.diff1.size, diff.diff1.crc)
+      return
+    for sides, info in ('1', diff.diff1), ('2', diff.diff2):
+      # The `PathInfo`s of missing paths don't have their type, just the `Diff`.
+      if info.path is not None and (info.type or diff.path_type) == 'file':
+        self._add(sides, info.path, info.size, info.crc)
+
+  def _add(self, sides, path, size, crc):
+    path = os.fspath(path)
+    if size is None:
+      self._unsized.append((sides, path))
+    elif size > 0:
+      self._sizes[size].append((sides, path, crc))
+
+  def _get_tree(self, sides):
+    return self.trees[1] if sides == '2' else self.trees[0]
+
+  def find_groups(self, die_on_error=False):
+    """Find the groups of files with the same size and checksum. Returns a list of
+    `(size, crc, confirmed, [(sides, rel_path), ...])`, with the groups with the most bytes to reclaim
+    first. `confirmed` is whether the contents were confirmed to be the same (see `_confirm()`)."""
+    for sides, path in self._unsized:
+      try:
+        size = self._get_tree(sides).get_size(path)
+      except OSError as error:
+        if die_on_error:
+          raise
+        logging.error('Error: {}'.format(error))
+        continue
+      self._add(sides, path, size, None)
+    self._unsized = []
+    self._hash_shared_sizes(die_on_error)
+    groups = []
+    for size, entries in self._sizes.items():
+      if len(entries) < 2:
+        continue
+      files_by_crc = collections.defaultdict(list)
+      for sides, path, crc in entries:
+        if crc is not None:
+          files_by_crc[crc].append((sides, path))
+      for crc, files in files_by_crc.items():
+        if len(files) < 2:
+          continue
+        for confirmed, group_files in self._confirm(files, die_on_error):
+          rel_files = [(sides, remove_root(self.roots[1] if sides == '2' else self.roots[0], path))
+                       for sides, path in group_files]
+          rel_files.sort(key=lambda file: (file[1], file[0]))
+          groups.append((size, crc, confirmed, rel_files))
+    groups.sort(key=lambda group: (-get_reclaimable(group[0], group[3]), group[3][0][1]))
+    return groups
+
+  def _confirm(self, files, die_on_error=False):
+    """Split a group of files (`(sides, path)`s) with the same size and CRC-32 into the ones whose
+    contents really are the same, by their BLAKE2b hashes. Yields `(confirmed, files)` for each group
+    of more than one file. Files in a remote tree can't be read here, so a group with any of those is
+    yielded whole, unconfirmed."""
+    if not all(self._get_tree(sides).is_local for sides, path in files):
+      yield False, files
+      return
+    files_by_digest = collections.defaultdict(list)
+    for sides, path in files:
+      try:
+        digest = get_file_digest(path, policy=self._get_tree(sides).read_policy)
+      except OSError as error:
+        if die_on_error:
+          raise
+        logging.error('Error: {}'.format(error))
+        continue
+      files_by_digest[digest].append((sides, path))
+    for group_files in files_by_digest.values():
+      if len(group_files) > 1:
+        yield True, group_files
+
+  def _hash_shared_sizes(self, die_on_error=False):
+    """Fill in the checksums of the files which share a size with another and weren't hashed yet.
+    They're hashed in batches, so the trees can prefetch."""
+    pending = []
+    for entries in self._sizes.values():
+      if len(entries) > 1:
+        pending.extend((entries, i) for i, entry in enumerate(entries) if entry[2] is None)
+    tree1, tree2 = self.trees
+    for start in range(0, len(pending), PIPELINE_BATCH):
+      batch = pending[start:start+PIPELINE_BATCH]
+      paths1 = [entries[i][1] for entries, i in batch if entries[i][0] != '2']
+      paths2 = [entries[i][1] for entries, i in batch if entries[i][0] == '2']
+      if tree1 is tree2:
+        tree1.prefetch_crc32(paths1+paths2)
+      else:
+        tree1.prefetch_crc32(paths1)
+        tree2.prefetch_crc32(paths2)
+      for entries, i in batch:
+        sides, path, crc = entries[i]
+        try:
+          crc = self._get_tree(sides).get_crc32(path)
+        except OSError as error:
+          if die_on_error:
+            raise
+          logging.error('Error: {}'.format(error))
+          continue
+        entries[i] = (sides, path, crc)
+      forget_cached(tree1, tree2)
+
+  def write(self, path, die_on_error=False):
+    """Write the groups of duplicates to the file at `path`. The header lines give the roots and
+    totals, then each line is tab-delimited: the number of the group, the size and crc32 of its
+    files, whether the group was confirmed, which tree(s) the file is in, and its relative path.
+    Only confirmed groups count toward the reclaimable bytes. Unconfirmed ones are just candidates."""
+    groups = self.find_groups(die_on_error)
+    totals = {True:[0, 0], False:[0, 0]}
+    for size, crc, confirmed, files in groups:
+      totals[confirmed][0] += 1
+      totals[confirmed][1] += get_reclaimable(size, files)
+    (groups_num, reclaimable), (candidates_num, candidates_reclaimable) = totals[True], totals[False]
+    with open(path, 'w', errors='surrogateescape') as file:
+      for i, name in enumerate(self.names, 1):
+        print(f'##root{i}={name}', file=file)
+      print('##hash=crc32', file=file)
+      print('##confirm=blake2b', file=file)
+      print(f'##groups={groups_num}', file=file)
+      print(f'##reclaimable={reclaimable}', file=file)
+      print(f'##unconfirmed_groups={candidates_num}', file=file)
+      print(f'##unconfirmed_reclaimable={candidates_reclaimable}', file=file)
+      print('#'+'\t'.join(('group', 'size', 'crc32', 'confirmed', 'sides', 'path')), file=file)
+      for group_num, (size, crc, confirmed, files) in enumerate(groups, 1):
+        confirmed_str = 'yes' if confirmed else 'no'
+        for sides, rel_path in files:
+          print(group_num, size, crc, confirmed_str, sides, rel_path, sep='\t', file=file)
+    logging.info(f'Found {groups_num} groups of duplicate files, with {reclaimable} bytes '
+                 'reclaimable.')
+    if candidates_num:
+      logging.info(f'Found {candidates_num} more groups of files with the same size and crc32 which '
+                   f'couldn\'t be confirmed, with {candidates_reclaimable} bytes reclaimable.')
+
+
+def get_file_digest(path, policy=None):
+  """Get the BLAKE2b hash of the whole contents of a file."""
+  hasher = hashlib.blake2b()
+  for chunk in read_chunks(path, policy=policy):
+    hasher.update(chunk)
+  return hasher.digest()
+
+
+def get_reclaimable(size, files):
+  """How many bytes could be freed by keeping only one copy of a file in each tree.
+  `files` is a list of `(sides, rel_path)` for every copy."""
+  copies1 = sum(1 for sides, path in files if sides != '2')
+  copies2 = sum(1 for sides, path in files if sides != '1')
+  return size * (max(copies1-1, 0) + max(copies2-1, 0))
+
+
+########## Block maps ##########
+
+class BlockMapper:
+  """Find which byte ranges of two files differ, by hashing them block by block.
+  Blocks are hashed with BLAKE2b instead of CRC-32: a map can have millions of blocks, and a
+  collision means a range that silently doesn't get re-copied."""
+
+  def __init__(self, block_size=DEFAULT_BLOCK_SIZE, chunking='fixed', cache_dir=None,
+               read_policy=None):
+    self.block_size = block_size
+    self.chunking = chunking
+    self.read_policy = read_policy
+    self.cache_dir = cache_dir
+    if cache_dir is not None:
+      cache_dir.mkdir(parents=True, exist_ok=True)
+
+  def map(self, path1, path2):
+    """Return a list of (start, end) ranges of `path1` whose data isn't in `path2`.
+    For fixed blocks, that means it isn't at the same offset in `path2`. For content-defined chunks,
+    it means it isn't anywhere in `path2`."""
+    blocks1 = self.get_blocks(path1)
+    blocks2 = self.get_blocks(path2)
+    if self.chunking == 'fixed':
+      # Blocks only match at the same offset.
+      ranges = []
+      for i, (offset, length, digest) in enumerate(blocks1):
+        if i >= len(blocks2) or blocks2[i][2] != digest:
+          ranges.append((offset, offset+length))
+    else:
+      # Chunks match anywhere, as long as they're in the other file.
+      digests2 = {digest for offset, length, digest in blocks2}
+      ranges = [(offset, offset+length) for offset, length, digest in blocks1
+                if digest not in digests2]
+    return merge_ranges(ranges)
+
+  def get_blocks(self, path):
+    """Get the list of (offset, length, digest) blocks of a file, from the cache if possible."""
+    stats = os.stat(path)
+    key = '\t'.join(str(value) for value in (
+      os.path.realpath(path), stats.st_dev, stats.st_ino, stats.st_size, stats.st_mtime_ns,
+      self.chunking, self.block_size
+    ))
+    cache_path = None
+    if self.cache_dir is not None:
+      cache_path = self.cache_dir/hashlib.blake2b(os.fsencode(key), digest_size=16).hexdigest()
+      try:
+        with cache_path.open('rt') as cache_file:
+          cached = json.load(cache_file)
+        if cached['key'] == key:
+          return [(offset, length, bytes.fromhex(digest)) for offset, length, digest in cached['blocks']]
+      except (OSError, ValueError, KeyError):
+        pass
+    if self.chunking == 'fixed':
+      blocks = list(hash_fixed_blocks(path, self.block_size, policy=self.read_policy))
+    else:
+      blocks = list(hash_content_chunks(path, self.block_size, policy=self.read_policy))
+    if cache_path is not None:
+      tmp_path = cache_path.with_name(cache_path.name+'.tmp')
+      cached = {'key':key, 'blocks':[(offset, length, digest.hex()) for offset, length, digest in blocks]}
+      with tmp_path.open('wt') as cache_file:
+        json.dump(cached, cache_file)
+      os.replace(tmp_path, cache_path)
+    return blocks
+
+
+def hash_fixed_blocks(path, block_size, policy=None):
+  offset = 0
+  for block in read_chunks(path, block_size, policy):
+    yield offset, len(block), hashlib.blake2b(block, digest_size=BLOCK_DIGEST_SIZE).digest()
+    offset += len(block)
+
+
+CHUNK_WINDOW = 8
+
+def make_window_tables(window=CHUNK_WINDOW):
+  """Random (but fixed) byte substitution tables, one for each position in the rolling window.
+  Where XORing a byte's value from every table gives zero, the last table is tweaked, so that a long
+  run of one byte value (like a stretch of zeros) doesn't make every offset a candidate boundary."""
+  tables = [bytearray(hashlib.shake_256(bytes((position,))).digest(256)) for position in range(window)]
+  for byte in range(256):
+    combined = 0
+    for table in tables:
+      combined ^= table[byte]
+    if combined == 0:
+      tables[-1][byte] ^= 1
+  return [bytes(table) for table in tables]
+
+CHUNK_WINDOW_TABLES = make_window_tables()
+
+
+def get_window_hashes(data, tables=CHUNK_WINDOW_TABLES):
+  """Hash every `len(tables)`-byte window of `data` down to a single byte, without a per-byte loop
+  in Python. Each table maps the byte at one position of the window, and the mapped bytes are
+  XORed together, position by position, by XORing them as big ints.
+  Byte `i` of the result is the hash of the window ending at `data[i+len(tables)-1]`."""
+  window = len(tables)
+  combined = 0
+  for position, table in enumerate(tables):
+    # The byte `position` bytes before the end of each window.
+    combined ^= int.from_bytes(data[window-1-position:len(data)-position].translate(table), 'big')
+  return combined.to_bytes(len(data)-window+1, 'big')
+
+
+def hash_content_chunks(path, avg_size, read_size=DEFAULT_CHUNK_SIZE, policy=None):
+  """Divide a file into content-defined chunks and yield (offset, length, digest) for each.
+  A boundary goes after a byte when the CHUNK_WINDOW bytes ending there hash to zero, so boundaries
+  depend only on the content around them, not on its offset. A one-byte hash of every window is
+  computed in bulk by `get_window_hashes()`, and only the 1/256 of offsets where it's zero get the
+  (slower) check of the remaining bits, against a BLAKE2b hash of the window.
+  Chunks are kept between avg_size/4 and avg_size*4."""
+  min_size = max(avg_size // 4, 1)
+  max_size = avg_size * 4
+  check_bits = max(avg_size.bit_length() - 1 - 8, 0)
+  window = CHUNK_WINDOW
+  # The windows at the start of the file are padded with zeros.
+  history = bytes(window-1)
+  hasher = hashlib.blake2b(digest_size=BLOCK_DIGEST_SIZE)
+  # Where the current chunk starts, and where the current `data` starts, in the file.
+  offset = 0
+  position = 0
+  for data in read_chunks(path, read_size, policy):
+    buffer = history + data
+    hashes = get_window_hashes(buffer)
+    view = memoryview(buffer)[window-1:]
+    start = 0
+    # Indices in `data` of the earliest and the latest byte the current chunk can end on.
+    first = offset + min_size - 1 - position
+    while first < len(data):
+      last = offset + max_size - 1 - position
+      end = hashes.find(0, max(first, 0), last)
+      while end != -1 and check_bits:
+        digest = hashlib.blake2b(buffer[end:end+window], digest_size=8).digest()
+        if int.from_bytes(digest, 'big') >> (64-check_bits) == 0:
+          break
+        end = hashes.find(0, end+1, last)
+      if end == -1:
+        if last >= len(data):
+          break
+        end = last
+      hasher.update(view[start:end+1])
+      yield offset, position+end+1-offset, hasher.digest()
+      hasher = hashlib.blake2b(digest_size=BLOCK_DIGEST_SIZE)
+      start = end+1
+      offset = position + start
+      first = offset + min_size - 1 - position
+    hasher.update(view[start:])
+    view.release()
+    position += len(data)
+    history = buffer[len(buffer)-window+1:]
+  if position > offset:
+    yield offset, position-offset, hasher.digest()
+
+
+def merge_ranges(ranges):
+  """Combine overlapping and adjacent (start, end) ranges. The input must be sorted by start."""
+  merged = []
+  for start, end in ranges:
+    if merged and start <= merged[-1][1]:
+      merged[-1] = (merged[-1][0], max(end, merged[-1][1]))
+    else:
+      merged.append((start, end))
+  return merged
+
+
+def format_ranges(ranges):
+  if not ranges:
+    return TSV_NULL_STR
+  return ','.join(f'{start}-{end}' for start, end in ranges)
+
+
+########## Applying plans ##########
+
+PlanAction = collections.namedtuple('PlanAction', ('action', 'path')+PLAN_FIELDS)
+
+
+def apply_main(argv):
+  parser = make_apply_argparser()
+  args = parser.parse_args(argv)
+  logging.basicConfig(stream=args.log, level=args.volume, format='%(message)s')
+  if args.jobs < 1:
+    fail('Error: --jobs must be at least 1.')
+  if str(args.plan) == '-':
+    plan_meta, actions = read_plan(sys.stdin)
+  else:
+    with args.plan.open('rt', errors='surrogateescape') as plan_file:
+      plan_meta, actions = read_plan(plan_file)
+  src = args.src or pathlib.Path(plan_meta['src'])
+  dst = args.dst or pathlib.Path(plan_meta['dst'])
+  for root in src, dst:
+    if not root.is_dir():
+      fail(f'Error: Directory not found: {str(root)!r}')
+  if args.dry_run:
+    for action in actions:
+      print(action.action, action.path, sep='\t')
+    return 0
+  applier = PlanApplier(src, dst, jobs=args.jobs, verify=args.verify)
+  failures = applier.apply(actions)
+  if failures:
+    logging.critical(f'Error: {failures} action(s) failed.')
+    return 1
+  return 0
+
+
+def read_plan(plan_file):
+  plan_meta = {}
+  actions = []
+  for line_raw in plan_file:
+    if line_raw.startswith('#'):
+      if line_raw.startswith('##'):
+        key, value = line_raw[2:].rstrip('\r\n').split('=', 1)
+        plan_meta[key] = value
+      continue
+    fields = line_raw.rstrip('\r\n').split('\t')
+    if len(fields) != 2 + len(PLAN_FIELDS):
+      fail(f'Error: Invalid plan line: {line_raw!r}')
+    values = [None if value == TSV_NULL_STR else value for value in fields]
+    for i in 3, 4, 5:
+      if values[i] is not None:
+        values[i] = int(values[i])
+    actions.append(PlanAction(*values))
+  if plan_meta.get('plan') != PLAN_VERSION:
+    fail(f'Error: Not a version {PLAN_VERSION} plan (no "##plan={PLAN_VERSION}" header).')
+  if plan_meta.get('hash') not in (None, 'crc32'):
+    fail(f'Error: Unsupported hash {plan_meta["hash"]!r} in plan.')
+  return plan_meta, actions
+
+
+class PlanApplier:
+  """Execute plan actions, copying from `src` to `dst` with a pool of `jobs` worker threads.
+  Deletes are done first, then copies and symlinks, then touches, so that a path that changed type
+  is cleared out before it's replaced. Directory modified times are set last, since creating their
+  contents changes them."""
+
+  def __init__(self, src, dst, jobs=4, verify=True):
+    self.src = src
+    self.dst = dst
+    self.jobs = jobs
+    self.verify = verify
+    self.failures = 0
+    self._failures_lock = threading.Lock()
+    self._dirs = []
+
+  def apply(self, actions):
+    with concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs) as pool:
+      for phase in (('delete',), ('copy', 'symlink'), ('touch',)):
+        futures = []
+        for action in actions:
+          if action.action not in phase:
+            continue
+          if action.action == 'copy' and action.type == 'dir':
+            # Walk the directory here, creating the directories, and hand the files to the pool.
+            futures.extend(self.copy_tree(action.path, pool))
+          else:
+            futures.append(pool.submit(self.run, action.action, action.path, action.crc))
+        for future in futures:
+          future.result()
+    # Deepest first, so setting a directory's time isn't undone by setting its children's.
+    for rel_path in sorted(self._dirs, key=get_rel_depth, reverse=True):
+      self.run('touch', rel_path)
+    return self.failures
+
+  def copy_tree(self, rel_path, pool):
+    futures = []
+    src_root = self.src/rel_path
+    for dirpath, dirnames, filenames in os.walk(src_root, onerror=log_error):
+      rel_dir = posixpath.join(rel_path, pathlib.Path(dirpath).relative_to(src_root).as_posix())
+      rel_dir = posixpath.normpath(rel_dir)
+      try:
+        (self.dst/rel_dir).mkdir(exist_ok=True)
+      except OSError as error:
+        self.fail('mkdir', rel_dir, error)
+        dirnames.clear()
+        continue
+      self._dirs.append(rel_dir)
+      for name in dirnames + filenames:
+        child = posixpath.join(rel_dir, name)
+        path_type = get_path_type(self.src/child)
+        if path_type == 'link':
+          futures.append(pool.submit(self.run, 'symlink', child))
+        elif path_type == 'file':
+          futures.append(pool.submit(self.run, 'copy', child))
+        elif path_type != 'dir':
+          logging.warning(f'Warning: Skipping {path_type} {child!r}: can only copy files, '
+                          'directories, and links.')
+    return futures
+
+  def run(self, action, rel_path, crc=None):
+    src = self.src/rel_path
+    dst = self.dst/rel_path
+    try:
+      if action == 'delete':
+        if dst.is_dir() and not dst.is_symlink():
+          shutil.rmtree(dst)
+        else:
+          dst.unlink()
+      elif action == 'copy':
+        if src.is_dir():
+          dst.mkdir(exist_ok=True)
+          self._dirs.append(rel_path)
+        else:
+          copy_file(src, dst, crc=crc, verify=self.verify)
+      elif action == 'symlink':
+        tmp_dst = get_tmp_path(dst)
+        os.symlink(os.readlink(src), tmp_dst)
+        src_stats = os.lstat(src)
+        os.utime(tmp_dst, ns=(src_stats.st_atime_ns, src_stats.st_mtime_ns), follow_symlinks=False)
+        os.replace(tmp_dst, dst)
+      elif action == 'touch':
+        src_stats = os.stat(src)
+        os.utime(dst, ns=(src_stats.st_atime_ns, src_stats.st_mtime_ns))
+      else:
+        raise ValueError(f'Unknown action {action!r}')
+      logging.info(f'{action}\t{rel_path}')
+    except (OSError, VerificationError) as error:
+      self.fail(action, rel_path, error)
+
+  def fail(self, action, rel_path, error):
+    with self._failures_lock:
+      self.failures += 1
+    logging.error(f'Error: {action} {rel_path!r} failed: {error}')
+
+
+def copy_file(src, dst, crc=None, verify=True):
+  """Copy a file's contents, permissions, and times. The data is copied to a temporary file next to
+  `dst`, which replaces `dst` only once it's complete (and verified, if `verify`).
+  If `crc` isn't given, the source is hashed to verify against."""
+  tmp_dst = get_tmp_path(dst)
+  try:
+    with open(src, 'rb') as src_file, open(tmp_dst, 'wb') as dst_file:
+      src_stats = os.fstat(src_file.fileno())
+      copy_file_data(src_file.fileno(), dst_file.fileno(), src_stats.st_size)
+    os.chmod(tmp_dst, stat.S_IMODE(src_stats.st_mode))
+    os.utime(tmp_dst, ns=(src_stats.st_atime_ns, src_stats.st_mtime_ns))
+    if verify:
+      if crc is None:
+        crc = get_crc32(src)
+      copy_crc = get_crc32(tmp_dst)
+      if copy_crc != crc:
+        raise VerificationError(f'crc32 of copy ({copy_crc}) != crc32 of source ({crc})')
+    os.replace(tmp_dst, dst)
+  except BaseException:
+    try:
+      os.unlink(tmp_dst)
+    except FileNotFoundError:
+      pass
+    raise
+
+
+def copy_file_data(src_fd, dst_fd, size):
+  """Copy `size` bytes between file descriptors, in the kernel if possible.
+  Tries `os.copy_file_range()` first (which can share extents on filesystems that support it), then
+  `os.sendfile()`, then falls back to reading and writing. Any of them may be unavailable for a
+  given pair of files (different filesystems, old kernel, etc)."""
+  copied = 0
+  for method in 'copy_file_range', 'sendfile':
+    if not hasattr(os, method):
+      continue
+    try:
+      while copied < size:
+        count = min(size - copied, 1024**3)
+        if method == 'copy_file_range':
+          done = os.copy_file_range(src_fd, dst_fd, count, copied, copied)
+        else:
+          os.lseek(dst_fd, copied, os.SEEK_SET)
+          done = os.sendfile(dst_fd, src_fd, copied, count)
+        if done == 0:
+          # The file shrank while copying. Stop and let verification sort it out.
+          return copied
+        copied += done
+      return copied
+    except OSError as error:
+      if error.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP,
+                             errno.ENOTSUP, errno.EBADF):
+        raise
+  os.lseek(src_fd, copied, os.SEEK_SET)
+  os.lseek(dst_fd, copied, os.SEEK_SET)
+  while True:
+    chunk = memoryview(os.read(src_fd, DEFAULT_CHUNK_SIZE))
+    if not chunk:
+      return copied
+    while chunk:
+      written = os.write(dst_fd, chunk)
+      chunk = chunk[written:]
+      copied += written
+
+
+def get_tmp_path(path):
+  return path.with_name(f'.{path.name}.synctest-tmp')
+
+
+class VerificationError(Exception):
+  pass
+
+
+########## Serving ##########
+
+def serve_main(argv):
+  parser = make_serve_argparser()
+  args = parser.parse_args(argv)
+  logging.basicConfig(stream=args.log, level=args.volume, format='%(message)s')
+  if not args.root.is_dir():
+    fail(f'Error: Not a directory: {str(args.root)!r}')
+  read_policy, stat_limiter = make_limits(args)
+  with MetadataServer((args.host, args.port), args.root, read_policy, stat_limiter) as server:
+    logging.warning(f'Serving {str(args.root)!r} on {args.host}:{server.server_address[1]}')
+    try:
+      server.serve_forever()
+    except KeyboardInterrupt:
+      pass
+  return 0
+
+
+class MetadataServer(socketserver.ThreadingTCPServer):
+  """Answer `RemoteTree` requests about the paths under `root`.
+  The `read_policy` and `stat_limiter` are shared by all the clients' threads."""
+
+  allow_reuse_address = True
+  daemon_threads = True
+
+  def __init__(self, address, root, read_policy=None, stat_limiter=None):
+    self.root = root
+    self.real_root = os.path.realpath(root)
+    self.read_policy = read_policy
+    self.stat_limiter = stat_limiter
+    super().__init__(address, MetadataRequestHandler)
+
+  def resolve(self, path_str, follow=True):
+    """Convert a path from a request (relative to the served root) to a local path.
+    Symlinks are resolved to make sure the path doesn't lead outside the root. If `follow` is False,
+    the last component of the path can be a link to anywhere, since it won't be followed."""
+    parts = [part for part in path_str.split('/') if part and part != '.']
+    if '..' in parts:
+      raise PermissionError(errno.EPERM, 'Paths outside the served root are not allowed', path_str)
+    path = self.root.joinpath(*parts)
+    if follow or not parts:
+      real_path = os.path.realpath(path)
+    else:
+      real_path = os.path.realpath(path.parent)
+    if os.path.commonpath((self.real_root, real_path)) != self.real_root:
+      raise PermissionError(errno.EPERM, 'Paths outside the served root are not allowed', path_str)
+    return path
+
+  def answer(self, line):
+    """Execute one request line and return the response line."""
+    try:
+      request = json.loads(line)
+      op = request['op']
+      path = self.resolve(request['path'], follow=op not in ('stat', 'readlink'))
+      result = self.execute(op, path)
+      response = {'ok':result}
+    except OSError as error:
+      response = {'error':[error.errno, error.strerror]}
+    except (ValueError, KeyError, TypeError) as error:
+      response = {'error':[None, f'Invalid request: {error}']}
+    return json.dumps(response).encode()+b'\n'
+
+  def execute(self, op, path):
+    if op == 'list':
+      entries = []
+      self._limit_stats()
+      with os.scandir(path) as entry_iter:
+        for entry in entry_iter:
+          self._limit_stats()
+          try:
+            stats = entry.stat(follow_symlinks=False)
+            is_dir = entry.is_dir()
+          except OSError:
+            continue
+          path_type, size, modified, target = self._describe(entry.path, stats)
+          entries.append((entry.name, path_type, is_dir, size, modified, target))
+      return entries
+    elif op == 'stat':
+      self._limit_stats()
+      try:
+        stats = os.lstat(path)
+      except FileNotFoundError:
+        return ('nonexistent', None, None, None)
+      return self._describe(path, stats)
+    elif op == 'readlink':
+      return os.readlink(path)
+    elif op == 'hash':
+      return get_crc32(path, policy=self.read_policy)
+    else:
+      raise ValueError(f'Unknown op {op!r}')
+
+  def _limit_stats(self):
+    if self.stat_limiter:
+      self.stat_limiter.take()
+
+  @staticmethod
+  def _describe(path, stats):
+    path_type = get_mode_type(stats.st_mode)
+    target = None
+    if path_type == 'link':
+      target = os.readlink(path)
+    return path_type, stats.st_size, int(stats.st_mtime), target
+
+
+class MetadataRequestHandler(socketserver.BaseRequestHandler):
+
+  def handle(self):
+    # Read whatever has arrived, answer all the complete requests in it, then send all the responses
+    # at once. That way pipelined requests get batched responses.
+    buffer = b''
+    while True:
+      data = self.request.recv(65536)
+      if not data:
+        return
+      buffer += data
+      lines = buffer.split(b'\n')
+      buffer = lines.pop()
+      responses = [self.server.answer(line) for line in lines if line]
+      if responses:
+        self.request.sendall(b''.join(responses))
+
+
+########## Archives ##########
+
+def is_archive_path(path):
+  return isinstance(path, pathlib.Path) and path.name.lower().endswith(ARCHIVE_SUFFIXES)
+
+
+def compare_archive_to_tree(archive_path, root2, tree2, ignore1=False, ignore2=False, crc='last',
+                            date_tolerance=0, strip_components=0, follow_links=False,
+                            die_on_error=False, path_filter=None, max_depth=None, subtree=None):
+  """Compare the contents of a tar or zip archive to the live directory `root2` in `tree2`.
+  The archive is read once, in order, without extracting anything, and each member is compared to
+  its live path as it goes by. Then the live tree is walked (with only stats) to find what isn't in
+  the archive. The lookups of the live paths are in the archive's order, not the directory's, so
+  they're effectively random access. Merge-joining the archive with a sorted walk would mean holding
+  (or sorting on disk) the whole member list first, since archives aren't sorted. As in `compare_survey_to_tree()`, directories missing from the live tree are reported
+  with the number of files and bytes the archive has in them."""
+  prefix1 = get_dir_prefix(os.fspath(archive_path))
+  prefix2 = get_dir_prefix(os.fspath(root2))
+  # Every path in the archive, including directories it only lists the contents of.
+  in_archive = set()
+  missing2 = {}
+  present2 = {}
+  for member in read_archive(archive_path, checksums=crc != 'none', die_on_error=die_on_error):
+    rel_path = get_member_rel_path(member.name, strip_components)
+    if rel_path is None:
+      continue
+    path_str = rel_path
+    while path_str and path_str not in in_archive:
+      in_archive.add(path_str)
+      path_str = path_str.rpartition('/')[0]
+    if subtree and not (rel_path == subtree or rel_path.startswith(subtree+'/')):
+      continue
+    if max_depth is not None and get_rel_depth(rel_path) - get_rel_depth(subtree) > max_depth:
+      continue
+    if path_filter is not None and path_filter.excludes_tree(rel_path):
+      continue
+    path2 = prefix2+rel_path
+    try:
+      if tree2.get_type(path2) == 'nonexistent':
+        if not ignore2:
+          top = get_topmost_missing_live(rel_path, tree2, prefix2, subtree, present2)
+          add_missing(missing2, top, rel_path, member)
+        continue
+      # The member stands in for the whole first tree, for this one comparison.
+      diff = compare_paths(
+        prefix1+rel_path, path2, date_tolerance=max(date_tolerance, member.time_slack),
+        crc=crc, tree1=member, tree2=tree2
+      )
+    except IOError as error:
+      if die_on_error:
+        raise
+      logging.error('Error: {}'.format(error))
+      continue
+    if diff.diff_type != 'equal':
+      yield pathize(diff)
+  if not ignore1:
+    yield from find_missing_from_archive(in_archive, root2, tree2, follow_links=follow_links,
+                                         die_on_error=die_on_error, path_filter=path_filter,
+                                         max_depth=max_depth, subtree=subtree)
+  for top in sorted(missing2):
+    path_type, diff = missing_to_diff(top, missing2[top])
+    diff.path = archive_path/top
+    yield Diff('missing2', path_type, diff, PathInfo())
+
+
+def find_missing_from_archive(in_archive, root2, tree2, follow_links=False, die_on_error=False,
+                              path_filter=None, max_depth=None, subtree=None):
+  """Walk the live tree and yield a "missing1" `Diff` for each path not in the set `in_archive`.
+  Directories not in the archive aren't descended into."""
+  start2 = root2
+  if subtree:
+    start2 = root2/subtree
+    try:
+      path_type = tree2.get_type(start2)
+    except IOError as error:
+      if die_on_error:
+        raise
+      logging.error('Error: {}'.format(error))
+      return
+    # Only walk the subtree if it's a directory which is in the archive too.
+    if path_type == 'nonexistent':
+      return
+    if subtree not in in_archive:
+      yield Diff('missing1', path_type, PathInfo(), PathInfo(start2))
+      return
+    if path_type != 'dir':
+      return
+  for dirpath, dirnames, filenames in tree2.walk(start2, followlinks=follow_links,
+                                                 onerror=log_error):
+    rel_dir = get_rel_dir(root2, dirpath)
+    if path_filter is not None:
+      filter_walker_paths(path_filter, rel_dir, (dirpath, dirnames, filenames))
+    prefix2 = get_dir_prefix(dirpath)
+    present_dirnames = []
+    for is_dir, names in (True, dirnames), (False, filenames):
+      for name in names:
+        if join_rel(rel_dir, name) in in_archive:
+          if is_dir:
+            present_dirnames.append(name)
+          continue
+        path2 = prefix2+name
+        try:
+          path_type = tree2.get_type(path2)
+        except IOError as error:
+          if die_on_error:
+            raise
+          logging.error('Error: {}'.format(error))
+          continue
+        yield Diff('missing1', path_type, PathInfo(), PathInfo(pathlib.Path(path2)))
+    if max_depth is not None and get_rel_depth(rel_dir) - get_rel_depth(subtree) + 1 >= max_depth:
+      dirnames.clear()
+    else:
+      dirnames[:] = present_dirnames
+
+
+def get_topmost_missing_live(rel_path, tree, prefix, subtree, cache):
+  """Find the highest directory containing this path which doesn't exist in the live `tree` either
+  (the path itself, if its parent exists). Parents are only checked up to (and including) the
+  --subtree. `cache` should be a dict reused for each call, saving whether each directory exists."""
+  top = rel_path
+  parent = rel_path.rpartition('/')[0]
+  while parent and top != subtree:
+    try:
+      present = cache[parent]
+    except KeyError:
+      present = cache[parent] = tree.get_type(prefix+parent) != 'nonexistent'
+    if present:
+      break
+    top = parent
+    parent = parent.rpartition('/')[0]
+  return top
+
+
+def get_member_rel_path(name, strip_components=0):
+  """Clean up the name of an archive member into a '/'-delimited relative path, with the first
+  `strip_components` directories removed (like tar's --strip-components). Returns None for the root
+  itself, and anything that was stripped away."""
+  parts = [part for part in name.split('/') if part and part != '.']
+  parts = parts[strip_components:]
+  if not parts:
+    return None
+  return '/'.join(parts)
+
+
+def read_archive(archive_path, checksums=True, die_on_error=False):
+  """Read the members of a tar or zip archive in the order they're stored, yielding an
+  `ArchiveMember` for each. Tar archives are streamed (so they can be compressed), and the checksum
+  of each file is computed as its contents go by (if `checksums`). Zip archives already store the
+  checksums, so their contents aren't read at all. If the archive turns out to be truncated or
+  corrupt partway through, that's logged as an error and the members read so far are all that's
+  yielded (unless `die_on_error`)."""
+  is_zip = archive_path.name.lower().endswith('.zip')
+  try:
+    if is_zip:
+      archive = zipfile.ZipFile(archive_path)
+    else:
+      archive = tarfile.open(archive_path, mode='r|*')
+  except (OSError, EOFError, tarfile.TarError, zipfile.BadZipFile) as error:
+    fail(f'Error: Could not open archive {str(archive_path)!r}: {error}')
+  with archive:
+    try:
+      if is_zip:
+        yield from read_zip_members(archive)
+      else:
+        yield from read_tar_members(archive, checksums)
+    except (OSError, EOFError, zlib.error, tarfile.TarError, zipfile.BadZipFile) as error:
+      if die_on_error:
+        raise
+      logging.error(f'Error: Could not read the rest of archive {str(archive_path)!r}: {error}')
+
+
+def read_tar_members(tar_file, checksums=True):
+  # Hard links don't include the contents again, so the size and checksum of each file are saved.
+  files = {}
+  member = tar_file.next()
+  while member is not None:
+    # In stream mode, nothing earlier can be read again, so don't let the list of members grow.
+    del tar_file.members[:]
+    result = ArchiveMember(member.name, modified=int(member.mtime))
+    if member.isreg():
+      result.type = 'file'
+      result.size = member.size
+      if checksums:
+        result.crc = get_stream_crc32(tar_file.extractfile(member))
+      files[member.name] = (result.size, result.crc)
+    elif member.islnk():
+      result.type = 'file'
+      try:
+        result.size, result.crc = files[member.linkname]
+      except KeyError:
+        logging.error(f'Error: Hard link {member.name!r} in archive is to {member.linkname!r}, '
+                      'which isn\'t a file earlier in the archive.')
+        member = tar_file.next()
+        continue
+    elif member.isdir():
+      result.type = 'dir'
+    elif member.issym():
+      result.type = 'link'
+      result.target = member.linkname
+    elif member.isfifo():
+      result.type = 'fifo'
+    elif member.isblk():
+      result.type = 'block'
+    elif member.ischr():
+      result.type = 'char'
+    else:
+      result.type = 'special'
+    yield result
+    member = tar_file.next()
+
+
+def read_zip_members(zip_file):
+  for info in zip_file.infolist():
+    modified, time_slack = get_zip_modified(info)
+    result = ArchiveMember(info.filename, modified=modified, time_slack=time_slack)
+    # Zips made on Unix store the st_mode in the upper bits (others leave it 0).
+    mode = info.external_attr >> 16
+    if info.is_dir():
+      result.type = 'dir'
+    elif mode:
+      result.type = get_mode_type(mode)
+    else:
+      result.type = 'file'
+    if result.type == 'file':
+      result.size = info.file_size
+      result.crc = info.CRC
+    elif result.type == 'link':
+      result.target = os.fsdecode(zip_file.read(info))
+    yield result
+
+
+def get_zip_modified(info):
+  """Get the modified time of a zip member, and how far off it could be. Zip's own timestamps are in
+  local time, with 2 second resolution, but most Unix zippers also add an "extended timestamp" field
+  with the exact Unix time."""
+  extra = info.extra
+  while len(extra) >= 4:
+    field_id, size = struct.unpack('<HH', extra[:4])
+    if field_id == ZIP_EXTENDED_TIMESTAMP and size >= 5 and extra[4] & 1:
+      return struct.unpack('<i', extra[5:9])[0], 0
+    extra = extra[4+size:]
+  return int(time.mktime(info.date_time + (0, 0, -1))), 1
+
+
+def get_stream_crc32(file, chunk_size=DEFAULT_CHUNK_SIZE):
+  crc = 0
+  chunk = file.read(chunk_size)
+  while chunk:
+    crc = zlib.crc32(chunk, crc)
+    chunk = file.read(chunk_size)
+  return crc
+
+
+class ArchiveMember:
+  """The metadata of a member of an archive. This also acts as a tree containing just that one path,
+  so that it can be given to `compare_paths()` as `tree1`. `time_slack` is how far off the modified
+  time could be, due to the archive format's resolution."""
+  __slots__ = ('name', 'type', 'size', 'modified', 'crc', 'target', 'time_slack')
+
+  def __init__(self, name, type=None, size=None, modified=None, crc=None, target=None,
+               time_slack=0):
+    self.name = name
+    self.type = type
+    self.size = size
+    self.modified = modified
+    self.crc = crc
+    self.target = target
+    self.time_slack = time_slack
+
+  def get_type(self, path):
+    return self.type
+
+  def readlink(self, path):
+    return self.target
+
+  def get_size(self, path):
+    return self.size
+
+  def get_modified(self, path):
+    return self.modified
+
+  def get_crc32(self, path):
+    if self.crc is None:
+      raise IOError(f'Contents of archive member {self.name!r} were not read.')
+    return self.crc
+
+
+########## "Static analysis" ##########
+
+class Metadata:
+  """The metadata for one path in a survey."""
+  __slots__ = ('modified', 'size', 'crc', 'type', 'error')
+
+  def __init__(self, modified, size, crc, type, error):
+    self.modified = modified
+    self.size = size
+    self.crc = crc
+    self.type = type
+    self.error = error
+
+
+class SurveyRecords:
+  """The metadata for all the paths in a survey, mapped from the path strings like a dict.
+  Instead of a `Metadata` object (plus an int object per field) for every path, the fields are kept
+  in flat arrays, with only a row number per path. The `Metadata` objects are created on access."""
+  # Stands in for None in the int arrays.
+  NULL = -2**63
+
+  def __init__(self):
+    self._rows = {}
+    self._modified = array.array('q')
+    self._size = array.array('q')
+    self._crc = array.array('q')
+    self._types = bytearray()
+    self._type_names = []
+    self._type_codes = {}
+    # Errors are rare, so they're stored by row number.
+    self._errors = {}
+
+  def add(self, path_str, metadata):
+    null = self.NULL
+    row = self._rows.get(path_str)
+    if row is None:
+      row = self._rows[path_str] = len(self._types)
+      self._modified.append(null)
+      self._size.append(null)
+      self._crc.append(null)
+      self._types.append(0)
+    self._modified[row] = null if metadata.modified is None else metadata.modified
+    self._size[row] = null if metadata.size is None else metadata.size
+    self._crc[row] = null if metadata.crc is None else metadata.crc
+    try:
+      self._types[row] = self._type_codes[metadata.type]
+    except KeyError:
+      code = self._type_codes[metadata.type] = len(self._type_names)
+      self._type_names.append(metadata.type)
+      self._types[row] = code
+    if metadata.error is None:
+      self._errors.pop(row, None)
+    else:
+      self._errors[row] = metadata.error
+
+  def __getitem__(self, path_str):
+    row = self._rows[path_str]
+    null = self.NULL
+    modified = self._modified[row]
+    size = self._size[row]
+    crc = self._crc[row]
+    return Metadata(
+      None if modified == null else modified,
+      None if size == null else size,
+      None if crc == null else crc,
+      self._type_names[self._types[row]],
+      self._errors.get(row),
+    )
+
+  def __contains__(self, path_str):
+    return path_str in self._rows
+
+  def __len__(self):
+    return len(self._rows)
+
+  def __iter__(self):
+    return iter(self._rows)
+
+  def keys(self):
+    return self._rows.keys()
+
+
+def read_survey(survey_path, path_filter=None, max_depth=None, subtree=None):
+  survey_metadata = {}
+  survey = SurveyRecords()
+  try:
+    for line_raw in read_survey_lines(survey_path, subtree=subtree):
+      if line_raw.startswith('#'):
+        if line_raw.startswith('##'):
+          parse_survey_metaline(line_raw, survey_metadata)
+      else:
+        path_str, metadata = parse_survey_line(line_raw)
+        if not in_survey_scope(path_str, survey_metadata, path_filter, max_depth, subtree):
+          continue
+        survey.add(path_str, metadata)
+  except EOFError:
+    pass
+  return survey, survey_metadata
+
+
+def read_survey_lines(survey_path, subtree=None):
+  """Yield the raw lines of a survey: all the header lines, then the lines for each path.
+  If `subtree` is given, only yield the lines for that path and the paths under it. For uncompressed
+  surveys, this finds them using a sorted index of the survey, which is created the first time it's
+  needed. Compressed surveys and ones which aren't regular files (like pipes) can't be seeked in, so
+  those are just filtered line by line, as are ones whose index can't be written."""
+  with open_path(survey_path) as survey_file:
+    header = {}
+    line_raw = None
+    for line_raw in survey_file:
+      if not line_raw.startswith('#'):
+        break
+      if line_raw.startswith('##'):
+        parse_survey_metaline(line_raw, header)
+      yield line_raw
+    else:
+      return
+    if subtree is None:
+      yield line_raw
+      yield from survey_file
+      return
+    prefix = get_survey_subtree_prefix(header, subtree)
+    index_path = None
+    if not is_gzip_path(survey_path) and stat.S_ISREG(os.stat(survey_path).st_mode):
+      try:
+        index_path = get_survey_index(survey_path)
+      except OSError as error:
+        logging.warning(f'Warning: Could not index survey {str(survey_path)!r} ({error}). Reading '
+                        'all of it instead.')
+    if index_path is None:
+      for line_raw in itertools.chain((line_raw,), survey_file):
+        if line_raw.startswith(prefix) and line_raw[len(prefix)] in '/\t':
+          yield line_raw
+      return
+  offsets = sorted(search_survey_index(index_path, prefix))
+  with survey_path.open('rb') as survey_file:
+    for offset in offsets:
+      survey_file.seek(offset)
+      yield survey_file.readline().decode()
+
+
+def get_survey_subtree_prefix(survey_meta, subtree):
+  startpath = survey_meta.get('startpath', '')
+  if startpath and not startpath.endswith('/'):
+    startpath += '/'
+  return startpath+subtree
+
+
+def get_survey_starts(survey_meta, subtree=None):
+  """Get the paths (relative to the startpath) of the survey's roots, or the --subtree, wherever it
+  overlaps them. These are the parts of a live directory to compare to the survey. Any which are
+  inside another are left out."""
+  startpath = survey_meta.get('startpath', '')
+  prefix = get_survey_subtree_prefix(survey_meta, '')
+  starts = set()
+  for root in survey_meta.get('root', [startpath]):
+    if root == startpath or root+'/' == prefix:
+      rel_root = ''
+    elif root.startswith(prefix):
+      rel_root = root[len(prefix):].rstrip('/')
+    else:
+      logging.warning(f'Warning: Survey root {root!r} is not under its startpath. Ignoring.')
+      continue
+    if subtree is None:
+      starts.add(rel_root)
+    elif not rel_root or subtree == rel_root or subtree.startswith(rel_root+'/'):
+      starts.add(subtree)
+    elif rel_root.startswith(subtree+'/'):
+      starts.add(rel_root)
+  outer_starts = []
+  for start in sorted(starts, key=get_rel_depth):
+    if not any(not outer or start.startswith(outer+'/') for outer in outer_starts):
+      outer_starts.append(start)
+  return sorted(outer_starts)
+
+
+def get_survey_index(survey_path):
+  """Get the path to the index of this survey, creating it if it doesn't exist or is out of date.
+  The index is a text file with a header line recording the size and mtime of the survey, then
+  one line per path in the survey, sorted by path: the path, a tab, then the byte offset of its
+  line in the survey. The paths are sorted in memory, so building the index takes memory in
+  proportion to the size of the survey (but only once, after which lookups read only a few lines).
+  Raises an `OSError` if the index can't be written next to the survey."""
+  index_path = survey_path.with_name(survey_path.name+'.idx')
+  stats = survey_path.stat()
+  signature = f'##survey\t{stats.st_size}\t{stats.st_mtime_ns}\n'.encode()
+  try:
+    with index_path.open('rb') as index_file:
+      if index_file.readline() == signature:
+        return index_path
+  except FileNotFoundError:
+    pass
+  logging.info(f'Indexing survey {str(survey_path)!r}..')
+  entries = []
+  with survey_path.open('rb') as survey_file:
+    offset = 0
+    for line_raw in survey_file:
+      if not line_raw.startswith(b'#'):
+        entries.append((line_raw.split(b'\t', 1)[0], offset))
+      offset += len(line_raw)
+  entries.sort()
+  tmp_path = index_path.with_name(index_path.name+'.tmp')
+  with tmp_path.open('wb') as index_file:
+    index_file.write(signature)
+    for path_bytes, offset in entries:
+      index_file.write(path_bytes+b'\t'+str(offset).encode()+b'\n')
+  os.replace(tmp_path, index_path)
+  return index_path
+
+
+def search_survey_index(index_path, prefix):
+  """Yield the survey offsets of the path `prefix` and every path under it (`prefix/...`).
+  This binary searches the index on disk, so it doesn't have to be read into memory."""
+  prefix_bytes = prefix.encode()
+  with index_path.open('rb') as index_file:
+    index_file.readline()
+    start = index_file.tell()
+    # The exact path sorts before its children, with at most some siblings in between.
+    # So find the path itself, then the start of the range of its children.
+    for key, is_match in ((prefix_bytes+b'\t', bytes.startswith),
+                          (prefix_bytes+b'/', bytes.startswith)):
+      index_file.seek(bisect_lines(index_file, start, key))
+      for line in index_file:
+        if not is_match(line, key):
+          break
+        yield int(line.rstrip(b'\r\n').rsplit(b'\t', 1)[1])
+
+
+def bisect_lines(sorted_file, start, key):
+  """Find the offset of the first line in the sorted, seekable, binary `sorted_file` (from offset
+  `start` on) which is >= `key`. Like `bisect.bisect_left()`, but on the lines of a file."""
+  lo = start
+  hi = sorted_file.seek(0, os.SEEK_END)
+  # Invariant: the line starting at `lo` is the first candidate, and `hi` is past all lines < key.
+  while lo < hi:
+    mid = (lo + hi) // 2
+    sorted_file.seek(mid)
+    if mid > lo:
+      # Skip the rest of the line we landed in.
+      sorted_file.readline()
+    line_start = sorted_file.tell()
+    line = sorted_file.readline()
+    if not line or line_start >= hi:
+      hi = mid
+    elif line < key:
+      lo = sorted_file.tell()
+    else:
+      hi = mid
+  return lo
+
+
+def in_survey_scope(path_str, survey_meta, path_filter=None, max_depth=None, subtree=None):
+  """Check whether a survey path should be compared, given the --exclude, --max-depth, and
+  --subtree options. This doesn't check whether the path is inside the subtree, just measures the
+  depth from there."""
+  if path_filter is None and max_depth is None:
+    return True
+  startpath = survey_meta.get('startpath')
+  prefix = startpath.rstrip('/')+'/' if startpath else None
+  if startpath and path_str == startpath:
+    rel_path = ''
+  elif prefix and path_str.startswith(prefix):
+    rel_path = path_str[len(prefix):]
+  else:
+    rel_path = path_str
+  if not rel_path:
+    return True
+  if max_depth is not None and get_rel_depth(rel_path) - get_rel_depth(subtree) > max_depth:
+    return False
+  if path_filter is not None and path_filter.excludes_tree(rel_path):
+    return False
+  return True
+
+
+def parse_survey_metaline(line_raw, metadata):
+  fields = line_raw[2:].rstrip('\r\n').split('=')
   assert len(fields) >= 2, line_raw
   key = fields[0]
   value = '='.join(fields[1:])
@@ -644,59 +5163,285 @@ def parse_survey_metaline(line_raw, metadata):
     metadata[key] = value
 
 
-def compare_surveys(survey1, survey2_path, survey1_meta):
+def compare_surveys(survey1, survey2_lines, survey1_meta, path_filter=None, max_depth=None,
+                    subtree=None):
+  """Compare `survey1` (from `read_survey()`) to the raw lines of survey2, from
+  `read_survey_lines()`."""
   # Difference from compare_paths(): this can't check if link targets are equal, since that isn't
   # recorded by file-metadata.py.
-  #TODO: If a directory is missing, just list that difference and not all the individual files it
-  #      contains as well.
+  # If a directory is missing, only that difference is reported, with the number of files and bytes
+  # it contains, instead of every path inside it.
   in_header = True
   survey2_meta = {}
   unmatched = set(survey1.keys())
-  with open_path(survey2_path) as survey2_file:
-    for line_raw in survey2_file:
-      if line_raw.startswith('#'):
-        if not in_header:
-          fail('Error: Header line detected separated from rest of header:\n  {!r}'.format(line_raw))
-        if line_raw.startswith('##'):
-          parse_survey_metaline(line_raw, survey2_meta)
-        continue
-      elif in_header:
-        # Should just past the end of the headers now.
-        #TODO: Check that the versions of both surveys is > 2.1.
-        # Check that the startpaths of the two surveys are the same.
-        #TODO: Allow surveys with different startpaths.
-        #      Should be able to just remove the startpath from the beginning of each column 1
-        #      path (if it's present) and then I think you can compare the result between surveys.
-        if survey1_meta['startpath'] != survey2_meta['startpath']:
-          for path_str in survey1_meta['root'] + survey2_meta['root']:
-            if not os.path.isabs(path_str):
-              fail('Error: startpath of both surveys is not equal ({!r} != {!r}) and not all root '
-                   'paths are absolute.'.format(survey1_meta['startpath'], survey2_meta['startpath']))
-        in_header = False
-      path_str, metadata2 = parse_survey_line(line_raw)
-      diffs = []
-      if path_str in survey1:
-        metadata1 = survey1[path_str]
-        diff_type = 'equal'
-        for attr in 'type', 'size', 'modified', 'crc':
-          if getattr(metadata1, attr) != getattr(metadata2, attr):
-            if not (attr == 'modified' and metadata1.type == metadata2.type == 'dir'):
-              diff_type = attr
-              break
-        diff1 = metadata_to_diff(metadata1, path_str)
-        diff2 = metadata_to_diff(metadata2, path_str)
+  missing1 = {}
+  tops_cache1 = {}
+  in_survey1 = lambda path_str: path_str in survey1
+  for line_raw in survey2_lines:
+    if line_raw.startswith('#'):
+      if not in_header:
+        fail('Error: Header line detected separated from rest of header:\n  {!r}'.format(line_raw))
+      if line_raw.startswith('##'):
+        parse_survey_metaline(line_raw, survey2_meta)
+      continue
+    elif in_header:
+      # Should just past the end of the headers now.
+      #TODO: Check that the versions of both surveys is > 2.1.
+      # Check that the startpaths of the two surveys are the same.
+      #TODO: Allow surveys with different startpaths.
+      #      Should be able to just remove the startpath from the beginning of each column 1
+      #      path (if it's present) and then I think you can compare the result between surveys.
+      if survey1_meta['startpath'] != survey2_meta['startpath']:
+        for path_str in survey1_meta['root'] + survey2_meta['root']:
+          if not os.path.isabs(path_str):
+            fail('Error: startpath of both surveys is not equal ({!r} != {!r}) and not all root '
+                 'paths are absolute.'.format(survey1_meta['startpath'], survey2_meta['startpath']))
+      in_header = False
+    path_str, metadata2 = parse_survey_line(line_raw)
+    if not in_survey_scope(path_str, survey2_meta, path_filter, max_depth, subtree):
+      continue
+    diffs = []
+    if path_str in survey1:
+      metadata1 = survey1[path_str]
+      diff_type = 'equal'
+      for attr in 'type', 'size', 'modified', 'crc':
+        if getattr(metadata1, attr) != getattr(metadata2, attr):
+          if not (attr == 'modified' and metadata1.type == metadata2.type == 'dir'):
+            diff_type = attr
+            break
+      if diff_type != 'equal':
         if metadata1.type == metadata2.type:
           path_type = metadata1.type
         else:
           path_type = 'mixed'
-        if diff_type != 'equal':
-          yield diff_type, path_type, diff1, diff2
-        unmatched.remove(path_str)
+        diff1 = metadata_to_diff(metadata1, path_str)
+        diff2 = metadata_to_diff(metadata2, path_str)
+        yield Diff(diff_type, path_type, diff1, diff2)
+      unmatched.remove(path_str)
+    else:
+      top = get_topmost_missing(path_str, in_survey1, survey2_meta, subtree, tops_cache1)
+      add_missing(missing1, top, path_str, metadata2)
+  missing2 = {}
+  tops_cache2 = {}
+  not_in_survey2 = lambda path_str: path_str not in unmatched
+  for path_str in unmatched:
+    top = get_topmost_missing(path_str, not_in_survey2, survey1_meta, subtree, tops_cache2)
+    add_missing(missing2, top, path_str, survey1[path_str])
+  for top in sorted(missing1):
+    path_type, diff = missing_to_diff(top, missing1[top])
+    yield Diff('missing1', path_type, PathInfo(), diff)
+  for top in sorted(missing2):
+    path_type, diff = missing_to_diff(top, missing2[top])
+    yield Diff('missing2', path_type, diff, PathInfo())
+
+
+def compare_survey_to_tree(survey1, survey1_meta, root2, tree2, ignore1=False, ignore2=False,
+                           crc='last', date_tolerance=0, trust_before=None, follow_links=False,
+                           die_on_error=False, path_filter=None, max_depth=None, subtree=None):
+  """Compare `survey1` (from `read_survey()`) to the live directory it was made of, `root2` in
+  `tree2`. The live tree is walked with only stats, and checksums are only computed to verify that
+  files whose size and modified time match the survey still have the same contents. With a
+  `trust_before` time, only files modified at or after it are verified.
+  As in `compare_surveys()`, directories missing from the live tree are reported with the number of
+  files and bytes the survey has in them.
+  `root2` corresponds to the survey's startpath, but only the parts of it under the survey's roots
+  are walked."""
+  survey_prefix = get_survey_subtree_prefix(survey1_meta, '')
+  unmatched = set(survey1.keys())
+  starts = get_survey_starts(survey1_meta, subtree)
+  # The survey's entries for the starting paths themselves are only compared (below) when the live
+  # path isn't a directory.
+  for start in starts:
+    root_key = get_survey_subtree_prefix(survey1_meta, start)
+    unmatched.discard(root_key)
+    unmatched.discard(root_key.rstrip('/'))
+  missing2 = {}
+  walkers = []
+  for start in starts:
+    if not start:
+      walkers.append(tree2.walk(root2, followlinks=follow_links, onerror=log_error))
+      continue
+    start2 = root2/start
+    root_key = get_survey_subtree_prefix(survey1_meta, start)
+    try:
+      path_type2 = tree2.get_type(start2)
+    except IOError as error:
+      if die_on_error:
+        raise
+      logging.error('Error: {}'.format(error))
+      continue
+    if path_type2 == 'dir':
+      walkers.append(tree2.walk(start2, followlinks=follow_links, onerror=log_error))
+    elif path_type2 == 'nonexistent':
+      # Report the whole root as missing, not each of the paths under it.
+      if root_key in survey1:
+        add_missing(missing2, root_key, root_key, survey1[root_key])
+      prefix = root_key+'/'
+      for path_str in [path_str for path_str in unmatched if path_str.startswith(prefix)]:
+        unmatched.discard(path_str)
+        add_missing(missing2, root_key, path_str, survey1[path_str])
+    else:
+      prefix = root_key+'/'
+      contents = [path_str for path_str in unmatched if path_str.startswith(prefix)]
+      if contents and root_key not in survey1:
+        # The survey only has the root's contents, so it was a directory.
+        unmatched.difference_update(contents)
+        diff1 = PathInfo(root_key, type='dir')
+        yield Diff('type', 'mixed', diff1, PathInfo(start2, type=path_type2))
       else:
-        yield 'missing1', metadata2.type, {'path':None}, metadata_to_diff(metadata2, path_str)
+        # Compare it as the only entry of its parent directory.
+        walkers.append([(str(start2.parent), [], [start2.name])])
+  for dirpath, dirnames, filenames in itertools.chain.from_iterable(walkers):
+    rel_dir = get_rel_dir(root2, dirpath)
+    if path_filter is not None:
+      filter_walker_paths(path_filter, rel_dir, (dirpath, dirnames, filenames))
+    prefix2 = get_dir_prefix(dirpath)
+    to_verify = []
+    present_dirnames = []
+    for is_dir, names in (True, dirnames), (False, filenames):
+      for name in names:
+        path_str = survey_prefix+join_rel(rel_dir, name)
+        path2 = prefix2+name
+        try:
+          if path_str not in survey1:
+            if not ignore1:
+              yield Diff('missing1', tree2.get_type(path2), PathInfo(), PathInfo(pathlib.Path(path2)))
+            continue
+          if is_dir:
+            present_dirnames.append(name)
+          unmatched.discard(path_str)
+          diff, verify = compare_to_survey(survey1[path_str], path_str, path2, tree2, crc=crc,
+                                           date_tolerance=date_tolerance, trust_before=trust_before)
+        except IOError as error:
+          if die_on_error:
+            raise
+          logging.error('Error: {}'.format(error))
+          continue
+        if verify:
+          to_verify.append(diff)
+        elif diff.diff_type != 'equal':
+          diff.diff2.path = pathlib.Path(path2)
+          yield diff
+    # Only descend into directories the survey has, and not past the maximum depth.
+    if max_depth is not None and get_rel_depth(rel_dir) - get_rel_depth(subtree) + 1 >= max_depth:
+      dirnames.clear()
+    else:
+      dirnames[:] = present_dirnames
+    if tree2.batched:
+      tree2.prefetch_crc32([diff.diff2.path for diff in to_verify])
+    for diff in to_verify:
+      try:
+        diff.diff2.crc = tree2.get_crc32(diff.diff2.path)
+      except IOError as error:
+        if die_on_error:
+          raise
+        logging.error('Error: {}'.format(error))
+        continue
+      if diff.diff_type == 'equal' and diff.diff1.crc != diff.diff2.crc:
+        diff.diff_type = 'crc'
+      if diff.diff_type != 'equal':
+        diff.diff2.path = pathlib.Path(diff.diff2.path)
+        yield diff
+  if ignore2:
+    return
+  tops_cache2 = {}
+  is_live = lambda path_str: path_str not in unmatched
   for path_str in unmatched:
-    metadata1 = survey1[path_str]
-    yield 'missing2', metadata1.type, metadata_to_diff(metadata1, path_str), {'path':None}
+    top = get_topmost_missing(path_str, is_live, survey1_meta, subtree, tops_cache2)
+    add_missing(missing2, top, path_str, survey1[path_str])
+  for top in sorted(missing2):
+    path_type, diff = missing_to_diff(top, missing2[top])
+    yield Diff('missing2', path_type, diff, PathInfo())
+
+
+def compare_to_survey(metadata1, path_str, path2, tree2, crc='last', date_tolerance=0,
+                      trust_before=None):
+  """Like `compare_paths()`, but between the `Metadata` of a path in a survey and a live path.
+  This doesn't compute the checksum of the live file. Instead, it returns the `Diff` and whether the
+  checksum should be compared. If so, the `Diff` type is what it should be if the checksums match."""
+  diff1 = metadata_to_diff(metadata1, path_str)
+  diff2 = PathInfo(path2, type=tree2.get_type(path2))
+  if diff1.type != diff2.type:
+    return Diff('type', 'mixed', diff1, diff2), False
+  if diff2.type != 'file':
+    # As in `compare_surveys()`, link targets and the modified times of directories aren't compared.
+    return Diff('equal', diff2.type, diff1, diff2), False
+  diff2.size = tree2.get_size(path2)
+  diff2.modified = tree2.get_modified(path2)
+  if diff1.size != diff2.size:
+    return Diff('size', 'file', diff1, diff2), False
+  if diff1.modified is None or abs(diff1.modified - diff2.modified) > date_tolerance:
+    # With crc='date', the checksums are still compared, for the record (as `compare_paths()` does).
+    return Diff('modified', 'file', diff1, diff2), crc == 'date' and diff1.crc is not None
+  if crc == 'none' or diff1.crc is None:
+    return Diff('equal', 'file', diff1, diff2), False
+  # Files modified in the same second they were surveyed could have changed without their modified
+  # time changing, so those are verified even when trusting modified times.
+  verify = trust_before is None or diff2.modified >= trust_before
+  return Diff('equal', 'file', diff1, diff2), verify
+
+
+def get_topmost_missing(path_str, is_present, survey_meta, subtree, cache):
+  """Find the highest directory containing this missing path which is also missing.
+  `is_present` should tell whether a path exists on the other side. Parents are only considered up to
+  (not including) the survey roots, or the --subtree. `cache` should be a dict which is reused for
+  each call, saving the result for each directory."""
+  parent = path_str.rpartition('/')[0]
+  if not parent:
+    return path_str
+  try:
+    top = cache[parent]
+  except KeyError:
+    if is_present(parent) or not is_below_survey_tops(parent, survey_meta, subtree):
+      top = None
+    else:
+      top = get_topmost_missing(parent, is_present, survey_meta, subtree, cache)
+    cache[parent] = top
+  if top is None:
+    return path_str
+  return top
+
+
+def is_below_survey_tops(path_str, survey_meta, subtree):
+  if subtree is None:
+    tops = survey_meta.get('root', []) + [survey_meta.get('startpath', '')]
+  else:
+    tops = [get_survey_subtree_prefix(survey_meta, subtree)]
+  for top in tops:
+    if not top.endswith('/'):
+      top += '/'
+    if path_str.startswith(top) and len(path_str) > len(top):
+      return True
+  return False
+
+
+def add_missing(missings, top, path_str, metadata):
+  """Add a missing path to the totals for its topmost missing directory, in `missings`."""
+  try:
+    totals = missings[top]
+  except KeyError:
+    # [metadata of the top path, number of files under it, total bytes of the files]
+    totals = missings[top] = [None, 0, 0]
+  if path_str == top:
+    totals[0] = metadata
+  elif metadata.type == 'file':
+    totals[1] += 1
+    totals[2] += metadata.size or 0
+
+
+def missing_to_diff(top, totals):
+  metadata, num_files, num_bytes = totals
+  if metadata is None:
+    # The survey didn't include the directory itself, only its contents.
+    path_type = 'dir'
+    diff = PathInfo(top, type=path_type)
+  else:
+    path_type = metadata.type
+    diff = metadata_to_diff(metadata, top)
+  if path_type == 'dir':
+    diff.files = num_files
+    diff.bytes = num_bytes
+  return path_type, diff
 
 
 def parse_survey_line(line_raw):
@@ -717,22 +5462,137 @@ def parse_survey_line(line_raw):
 
 
 def metadata_to_diff(metadata, path):
-  return {
-    'path':pathlib.Path(path),
-    'type':metadata.type,
-    'size':metadata.size,
-    'modified':metadata.modified,
-    'crc':metadata.crc,
-  }
+  return SurveyPathInfo(path, metadata.type, metadata.size, metadata.modified, metadata.crc)
+
+
+def is_gzip_path(path):
+  return path.name.endswith('.gz')
 
 
 def open_path(path):
-  if path.name.endswith('.gz'):
+  if is_gzip_path(path):
+    if get_cpu_count() > 1:
+      return GzipLineReader(path)
     return gzip.open(path, mode='rt')
   else:
     return path.open('rt')
 
 
+def get_cpu_count():
+  """How many CPUs this process can run on. With only one, background threads just add overhead."""
+  if hasattr(os, 'sched_getaffinity'):
+    return len(os.sched_getaffinity(0))
+  return os.cpu_count() or 1
+
+
+class BackgroundIterator:
+  """Run an iterator in a background thread, passing its items to the consumer in batches through a
+  bounded queue. The thread stops once the consumer has finished iterating (or `close()` is called).
+  Exceptions raised by the iterator are re-raised in the consumer."""
+
+  def __init__(self, iterable, batch_size=1, max_batches=16, name=None):
+    self._queue = queue.Queue(max_batches)
+    self._stopped = threading.Event()
+    self._thread = threading.Thread(
+      target=self._run, args=(iterable, batch_size), name=name, daemon=True
+    )
+    self._thread.start()
+    self._items = self._consume()
+
+  def _run(self, iterable, batch_size):
+    iterator = iter(iterable)
+    try:
+      while not self._stopped.is_set():
+        batch = list(itertools.islice(iterator, batch_size))
+        self._put((None, batch))
+        if not batch:
+          return
+    except BaseException as error:
+      self._put((error, None))
+    finally:
+      if hasattr(iterator, 'close'):
+        iterator.close()
+
+  def _put(self, item):
+    while not self._stopped.is_set():
+      try:
+        self._queue.put(item, timeout=0.1)
+        return
+      except queue.Full:
+        pass
+
+  def _consume(self):
+    try:
+      while True:
+        error, batch = self._queue.get()
+        if error is not None:
+          raise error
+        if not batch:
+          return
+        yield from batch
+    finally:
+      self.close()
+
+  def __iter__(self):
+    return self._items
+
+  def __next__(self):
+    return next(self._items)
+
+  def close(self):
+    self._stopped.set()
+
+
+class GzipLineReader:
+  """Read the lines of a gzipped text file, with the decompression done in a background thread.
+  The thread hands over large blocks of decompressed data, so that it can decompress the next ones
+  (zlib releases the GIL) while the consumer decodes and parses these. Lines are split on "\n",
+  "\r\n", and "\r" (and translated to end in "\n"), like a file opened in text mode, not on the other
+  characters `str.splitlines()` splits on."""
+
+  def __init__(self, path, block_size=GZIP_BLOCK_SIZE):
+    self.path = path
+    self._blocks = BackgroundIterator(self._read_blocks(path, block_size), name='gunzip')
+    self._lines = self._split_lines()
+
+  @staticmethod
+  def _read_blocks(path, block_size):
+    with gzip.open(path, mode='rb') as file:
+      block = file.read(block_size)
+      while block:
+        yield block
+        block = file.read(block_size)
+
+  def _split_lines(self):
+    remainder = b''
+    for block in self._blocks:
+      # Split at a newline, so multi-byte characters aren't split between blocks.
+      end = block.rfind(b'\n') + 1
+      if end == 0:
+        remainder += block
+        continue
+      text = (remainder + block[:end]).decode()
+      remainder = block[end:]
+      yield from io.StringIO(text, newline=None)
+    if remainder:
+      yield from io.StringIO(remainder.decode(), newline=None)
+
+  def __iter__(self):
+    return self._lines
+
+  def __next__(self):
+    return next(self._lines)
+
+  def close(self):
+    self._blocks.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
+
+
 def fail(message=None):
   if message is not None:
     logging.critical(message)
@@ -0,0 +1,705 @@
+import errno
+import gzip
+import json
+import os
+import random
+import tarfile
+import threading
+import time
+import zipfile
+import zlib
+import pytest
+import synctest2
+
+
+def run(capsys, *args):
+  """Run the command with these arguments and return what it printed to stdout."""
+  synctest2.main(['synctest2.py']+[str(arg) for arg in args])
+  return capsys.readouterr().out
+
+
+def make_files(root, files):
+  """Create the files in `files` (a dict of relative paths to contents) under `root`."""
+  for rel_path, content in files.items():
+    path = root/rel_path
+    path.parent.mkdir(parents=True, exist_ok=True)
+    if isinstance(content, str):
+      content = content.encode()
+    path.write_bytes(content)
+
+
+def write_survey(survey_path, startpath, roots=None):
+  """Write a survey of the directories `roots` (default: just `startpath`) to `survey_path`."""
+  lines = ['##version=2.2', f'##startpath={startpath}']
+  roots = roots or [startpath]
+  lines.extend(f'##root={root}' for root in roots)
+  lines.append('#path\ttime\tmodified\tsize\tcrc\ttype\terror')
+  for root in roots:
+    for dirpath, dirnames, filenames in os.walk(root):
+      for name in sorted(dirnames + filenames):
+        path = os.path.join(dirpath, name)
+        stats = os.lstat(path)
+        size = crc = '.'
+        if name in dirnames:
+          path_type = 'dir'
+        else:
+          path_type = 'file'
+          size = stats.st_size
+          with open(path, 'rb') as file:
+            crc = format(zlib.crc32(file.read()), 'x')
+        modified = int(stats.st_mtime)
+        lines.append('\t'.join(map(str, (path, time.ctime(modified), modified, size, crc, path_type,
+                                           '.'))))
+  survey_path.write_text('\n'.join(lines)+'\n')
+
+
+def test_path_filter_globs():
+  path_filter = synctest2.PathFilter(excludes=('*.pyc', 'build/*'))
+  assert path_filter
+  assert path_filter.excludes('x.pyc')
+  assert path_filter.excludes('src/x.pyc')
+  assert path_filter.excludes('build/out')
+  assert not path_filter.excludes('src/build/out')
+  assert not path_filter.excludes('x.py')
+
+
+def test_path_filter_includes_override_excludes():
+  path_filter = synctest2.PathFilter(excludes=('*.log',), includes=('keep.log',))
+  assert path_filter.excludes('a.log')
+  assert not path_filter.excludes('keep.log')
+  assert not path_filter.excludes('dir/keep.log')
+
+
+def test_path_filter_regexes():
+  path_filter = synctest2.PathFilter(exclude_regexes=(r'(^|/)\.git(/|$)',))
+  assert path_filter.excludes('.git')
+  assert path_filter.excludes('sub/.git/config')
+  assert not path_filter.excludes('sub/.gitignore')
+
+
+def test_path_filter_excludes_tree():
+  path_filter = synctest2.PathFilter(excludes=('cache',))
+  assert not path_filter.excludes('cache/a/b')
+  assert path_filter.excludes_tree('cache/a/b')
+  assert path_filter.excludes_tree('x/cache/b')
+  assert not path_filter.excludes_tree('x/caches/b')
+
+
+def test_empty_path_filter_is_false():
+  assert not synctest2.PathFilter()
+  assert not synctest2.PathFilter(includes=('*.txt',))
+
+
+def test_subtree_missing_on_one_side(tmp_path, capsys):
+  make_files(tmp_path/'a', {'sub/f': 'x'})
+  (tmp_path/'b').mkdir()
+  output = run(capsys, '-t', '-s', 'sub', tmp_path/'a', tmp_path/'b')
+  lines = output.splitlines()
+  assert len(lines) == 1
+  assert lines[0].split('\t')[:2] == ['sub', 'missing2']
+
+
+def test_subtree_missing_on_both_sides(tmp_path, capsys):
+  (tmp_path/'a').mkdir()
+  (tmp_path/'b').mkdir()
+  with pytest.raises(Exception):
+    run(capsys, '-s', 'nope', tmp_path/'a', tmp_path/'b')
+  # Only the --subtree argument is an error. Re-comparing a path that's gone from both sides (like
+  # --watch does) just finds no differences.
+  assert list(synctest2.recursive_compare(tmp_path/'a', tmp_path/'b', (), (), subtree='nope')) == []
+
+
+def test_server_stays_inside_root(tmp_path):
+  make_files(tmp_path, {'root/f': 'x', 'outside/secret': 'y'})
+  (tmp_path/'root'/'out').symlink_to(tmp_path/'outside')
+  with synctest2.MetadataServer(('127.0.0.1', 0), tmp_path/'root') as server:
+    def request(op, path):
+      return json.loads(server.answer(json.dumps({'op':op, 'path':path}).encode()))
+    assert request('stat', 'f')['ok'][0] == 'file'
+    assert request('stat', 'out')['ok'][0] == 'link'
+    assert request('readlink', 'out')['ok'] == str(tmp_path/'outside')
+    assert request('list', 'out')['error'][0] == errno.EPERM
+    assert request('stat', 'out/secret')['error'][0] == errno.EPERM
+    assert request('hash', 'out/secret')['error'][0] == errno.EPERM
+    assert request('stat', '../outside')['error'][0] == errno.EPERM
+
+
+def test_plan_and_apply(tmp_path, capsys):
+  src = tmp_path/'src'
+  dst = tmp_path/'dst'
+  make_files(src, {'same': 'a', 'changed': 'new', 'new_dir/f': 'b', 'new_dir/sub/g': 'c',
+                   'type_change/h': 'd'})
+  (src/'link').symlink_to('same')
+  make_files(dst, {'same': 'a', 'changed': 'old', 'extra': 'e', 'extra_dir/f': 'f',
+                   'type_change': 'g'})
+  (dst/'link').symlink_to('changed')
+  plan = run(capsys, '--plan', src, dst)
+  plan_path = tmp_path/'plan.tsv'
+  plan_path.write_text(plan)
+  assert synctest2.main(['synctest2.py', 'apply', str(plan_path)]) == 0
+  assert run(capsys, '-t', src, dst) == ''
+  assert (dst/'new_dir'/'sub'/'g').read_text() == 'c'
+  assert not (dst/'extra').exists()
+  assert (dst/'link').readlink().name == 'same'
+
+
+@pytest.mark.parametrize('path2', ['file', 'tcp://localhost:1/dst', 'missing'])
+def test_plan_needs_local_destination_dir(tmp_path, caplog, path2):
+  make_files(tmp_path/'src', {'f': 'a'})
+  make_files(tmp_path, {'file': 'b'})
+  if not path2.startswith('tcp:'):
+    path2 = str(tmp_path/path2)
+  with pytest.raises(Exception):
+    synctest2.main(['synctest2.py', '--plan', str(tmp_path/'src'), path2])
+  assert '--plan only works' in caplog.text
+
+
+def test_checkpoint_round_trip(tmp_path):
+  path = tmp_path/'checkpoint'
+  checkpoint = synctest2.Checkpoint(path)
+  diff1 = synctest2.Diff('missing1', 'file', synctest2.PathInfo(), synctest2.PathInfo('b/x'))
+  diff2 = synctest2.Diff('size', 'file', synctest2.PathInfo('a/c/y'), synctest2.PathInfo('b/c/y'))
+  assert list(checkpoint.emit(diff1)) == [diff1]
+  checkpoint.record_done(('a',))
+  checkpoint.record_crc('a/c/z', 10, 1000, 1234)
+  assert list(checkpoint.emit(diff2)) == [diff2]
+  # Simulate being killed in the middle of writing a record.
+  with path.open('at') as journal:
+    journal.write('{"done": ["a", "c"], "di')
+  resumed = synctest2.Checkpoint(path, resume=True)
+  assert resumed.frontier == ('a',)
+  assert resumed.total_diffs == 2
+  assert resumed.is_done(('a',))
+  assert not resumed.is_done(('a', 'c'))
+  assert resumed.is_subtree_done(('',))
+  assert not resumed.is_subtree_done(('a',))
+  assert list(resumed.emit(diff2)) == []
+  assert resumed.get_crc('a/c/z', 10, 1000) == 1234
+  assert resumed.get_crc('a/c/z', 10, 1001) is None
+  resumed.finish()
+  assert not path.exists()
+
+
+def test_tsv_reports_missing_directory_totals(tmp_path, capsys):
+  make_files(tmp_path/'a', {'same': 'x', 'gone/f1': 'abc', 'gone/sub/f2': 'de'})
+  make_files(tmp_path/'b', {'same': 'x'})
+  write_survey(tmp_path/'a.tsv', tmp_path/'a')
+  output = run(capsys, '-t', tmp_path/'a.tsv', tmp_path/'b')
+  fields = output.rstrip('\n').split('\t')
+  assert len(fields) == 16
+  assert fields[:4] == ['gone', 'missing2', 'dir', '?']
+  assert fields[-4:] == ['2', '?', '5', '?']
+  tsv_path = tmp_path/'diffs.tsv'
+  tsv_path.write_text(output)
+  diff = synctest2.parse_tsv_line(output)
+  assert (diff.diff1.files, diff.diff1.bytes) == (2, 5)
+  assert 'contents: 2 files, 5 bytes' in run(capsys, '--convert-tsv', tsv_path)
+  # Lines for anything but a collapsed directory keep the original 12 columns.
+  make_files(tmp_path/'b', {'gone/f1': 'abc', 'gone/sub/f2': 'def'})
+  output = run(capsys, '-t', tmp_path/'a.tsv', tmp_path/'b')
+  fields = output.rstrip('\n').split('\t')
+  assert fields[:2] == ['gone/sub/f2', 'size'] and len(fields) == 12
+
+
+def test_tsv_unknown_survey_fields_print_none(tmp_path, capsys):
+  make_files(tmp_path/'a', {'f': 'abc', 'g': 'de'})
+  write_survey(tmp_path/'a.tsv', tmp_path/'a')
+  write_survey(tmp_path/'b.tsv', tmp_path/'a')
+  lines = (tmp_path/'a.tsv').read_text().splitlines()
+  # Blank out the crc of "f" in the first survey, and remove "g" from the second.
+  path, human_time, modified, size, crc, path_type, error = lines[-2].split('\t')
+  lines[-2] = '\t'.join((path, human_time, modified, size, '.', path_type, error))
+  (tmp_path/'a.tsv').write_text('\n'.join(lines)+'\n')
+  lines = (tmp_path/'b.tsv').read_text().splitlines()
+  (tmp_path/'b.tsv').write_text('\n'.join(lines[:-1])+'\n')
+  output = run(capsys, '-t', tmp_path/'a.tsv', tmp_path/'b.tsv')
+  lines = sorted(line.split('\t') for line in output.splitlines())
+  # A field the survey recorded as unknown is "None", and one that wasn't looked at is "?".
+  assert lines[0][:2] == ['f', 'crc']
+  assert lines[0][8:12] == ['None', str(zlib.crc32(b'abc')), '?', '?']
+  assert lines[1][:2] == ['g', 'missing2'] and lines[1][2:4] == ['file', '?']
+
+
+@pytest.mark.parametrize('options', [(), ('-j', '2'), ('-O', 'inode')])
+def test_block_map_with_batched_hashing(tmp_path, capsys, options):
+  data = bytes(range(256))*64
+  make_files(tmp_path/'a', {'f': data})
+  make_files(tmp_path/'b', {'f': data[:5000]+b'xx'+data[5002:]})
+  map_path = tmp_path/'map.tsv'
+  run(capsys, *options, '-B', map_path, '--block-map-min', '1', '--block-size', '4k',
+      tmp_path/'a', tmp_path/'b')
+  assert map_path.read_text() == 'f\tfixed\t4096\t16384\t16384\t4096-8192\n'
+
+
+def test_content_block_map_survives_insertion(tmp_path, capsys):
+  rand = random.Random(1)
+  data = rand.randbytes(256*1024)
+  make_files(tmp_path/'a', {'f': data[:100000]+b'inserted'+data[100000:]})
+  make_files(tmp_path/'b', {'f': data})
+  chunks = list(synctest2.hash_content_chunks(tmp_path/'b'/'f', 4096))
+  assert list(synctest2.hash_content_chunks(tmp_path/'b'/'f', 4096, read_size=5000)) == chunks
+  map_path = tmp_path/'map.tsv'
+  run(capsys, '-B', map_path, '--block-map-min', '1', '--block-size', '4k', '--chunking', 'content',
+      tmp_path/'a', tmp_path/'b')
+  rel_path, chunking, block_size, size1, size2, ranges = map_path.read_text().rstrip('\n').split('\t')
+  assert (rel_path, chunking, size1, size2) == ('f', 'content', str(len(data)+8), str(len(data)))
+  # Only the chunk(s) around the insertion differ, not everything after it.
+  ((start, end),) = [map(int, range_str.split('-')) for range_str in ranges.split(',')]
+  assert start <= 100000 and 100008 <= end and end-start <= 4*4096*2
+
+
+def test_gzip_line_reader_matches_text_mode(tmp_path):
+  path = tmp_path/'lines.gz'
+  data = b'a\nb\r\nc\rd\x0be\xe2\x80\xa8f\r\n\r\ng\rh'
+  with gzip.open(path, 'wb') as file:
+    file.write(data)
+  with gzip.open(path, 'rt') as file:
+    expected = list(file)
+  for block_size in 1, 3, 1024:
+    reader = synctest2.GzipLineReader(path, block_size=block_size)
+    assert list(reader) == expected
+    reader.close()
+
+
+@pytest.mark.parametrize('length', [0, 1, 2, 3, 7, 4096, 65537, 1000003])
+def test_crc32_zeros(length):
+  assert synctest2.crc32_zeros(length) == zlib.crc32(bytes(length))
+  assert synctest2.crc32_zeros(length, 0x12345678) == zlib.crc32(bytes(length), 0x12345678)
+
+
+MiB = 1024*1024
+SPARSE_LAYOUTS = {
+  'leading_hole': [(MiB, b'a'*5000)],
+  'trailing_hole': [(0, b'b'*5000), (3*MiB, b'')],
+  'middle_hole': [(0, b'c'*5000), (MiB+MiB//2, b'd'*7000)],
+  'all_hole': [(3*MiB, b'')],
+}
+
+
+def make_sparse_file(path, layout):
+  """Write each (offset, data) in `layout` to a new file, leaving holes in between (empty data just
+  extends the file). Returns the contents with the holes filled in with zeros."""
+  dense = bytearray()
+  with path.open('wb') as file:
+    for offset, data in layout:
+      file.seek(offset)
+      file.write(data)
+      dense.extend(bytes(offset-len(dense)))
+      dense.extend(data)
+    file.truncate(len(dense))
+  return bytes(dense)
+
+
+@pytest.mark.parametrize('direct', [False, True])
+@pytest.mark.parametrize('layout', SPARSE_LAYOUTS.keys())
+def test_sparse_crc32(tmp_path, layout, direct):
+  path = tmp_path/layout
+  dense = make_sparse_file(path, SPARSE_LAYOUTS[layout])
+  policy = synctest2.ReadPolicy(direct=direct)
+  assert synctest2.get_crc32(path, chunk_size=65536, policy=policy) == zlib.crc32(dense)
+
+
+@pytest.mark.parametrize('layout', SPARSE_LAYOUTS.keys())
+def test_sparse_crc32_without_seek_data(tmp_path, monkeypatch, layout):
+  path = tmp_path/layout
+  dense = make_sparse_file(path, SPARSE_LAYOUTS[layout])
+  expected = zlib.crc32(dense)
+  monkeypatch.delattr(synctest2.os, 'SEEK_DATA', raising=False)
+  assert synctest2.get_crc32(path, chunk_size=65536) == expected
+
+
+@pytest.mark.parametrize('layout', SPARSE_LAYOUTS.keys())
+def test_sparse_crc32_seek_data_unsupported(tmp_path, monkeypatch, layout):
+  path = tmp_path/layout
+  dense = make_sparse_file(path, SPARSE_LAYOUTS[layout])
+  lseek = os.lseek
+  def unsupported_lseek(fd, position, whence):
+    if whence in (getattr(os, 'SEEK_DATA', None), getattr(os, 'SEEK_HOLE', None)):
+      raise OSError(errno.EINVAL, os.strerror(errno.EINVAL))
+    return lseek(fd, position, whence)
+  monkeypatch.setattr(synctest2.os, 'lseek', unsupported_lseek)
+  assert synctest2.get_crc32(path, chunk_size=65536) == zlib.crc32(dense)
+
+
+def test_candidate_files(tmp_path):
+  candidates = synctest2.CandidateFiles(tmp_path/'a', tmp_path/'b')
+  for rel_path, size in ('top', 1), ('d1/x', 20), ('d1/y', 300), ('d2/e/z', 4000):
+    diff1 = synctest2.PathInfo(f'{tmp_path}/a/{rel_path}', type='file', size=size, modified=100)
+    diff2 = synctest2.PathInfo(f'{tmp_path}/b/{rel_path}', type='file', size=size, modified=101)
+    candidates.append(synctest2.Diff('equal', 'file', diff1, diff2))
+  assert len(candidates) == 4
+  assert [candidates.get_rel_path(index) for index in range(4)] == ['top', 'd1/x', 'd1/y', 'd2/e/z']
+  diff = candidates[3]
+  assert (diff.diff1.path, diff.diff2.path) == (f'{tmp_path}/a/d2/e/z', f'{tmp_path}/b/d2/e/z')
+  assert (diff.diff1.size, diff.diff1.modified, diff.diff2.modified) == (4000, 100, 101)
+  sample = synctest2.choose_sample(candidates, 2, 'seed')
+  assert len(sample) == 2
+  assert sample == synctest2.choose_sample(candidates, 2, 'seed')
+  assert synctest2.choose_sample(candidates, 10, 'seed') == [0, 1, 2, 3]
+
+
+def test_hash_candidates_forgets_each_batch(tmp_path):
+  files = {f'f{i}': f'{i:04d}' for i in range(10)}
+  make_files(tmp_path/'a', files)
+  files['f3'] = 'xxxx'
+  make_files(tmp_path/'b', files)
+  candidates = synctest2.CandidateFiles(str(tmp_path/'a'), str(tmp_path/'b'))
+  for rel_path in sorted(files):
+    diff1 = synctest2.PathInfo(f'{tmp_path}/a/{rel_path}', type='file', size=4, modified=100)
+    diff2 = synctest2.PathInfo(f'{tmp_path}/b/{rel_path}', type='file', size=4, modified=100)
+    candidates.append(synctest2.Diff('equal', 'file', diff1, diff2))
+  (tmp_path/'b'/'f5').unlink()
+  tree = synctest2.LocalTree(io_order='inode')
+  assert tree.batched
+  hasher = synctest2.hash_candidates(candidates, tree, tree, batch_size=3)
+  diffs = []
+  while True:
+    try:
+      diffs.append(next(hasher))
+      # Nothing is kept from the batches before.
+      assert len(tree._stats) <= 2*3
+    except StopIteration as stop:
+      compared, differing = stop.value
+      break
+  assert [str(diff.diff1.path) for diff in diffs] == [f'{tmp_path}/a/f3']
+  # The pair that couldn't be read isn't counted as compared.
+  assert (compared, differing) == (9, 1)
+  assert not tree._stats
+
+
+@pytest.mark.parametrize('failures,trials,expected', [
+  # 0 of n has the closed form 1-alpha**(1/n), and n-1 of n has (1-alpha)**(1/n).
+  (0, 100, 1 - 0.05**(1/100)),
+  (9, 10, 0.95**(1/10)),
+  # From tables of the one-sided Clopper-Pearson bound.
+  (1, 10, 0.3942),
+  (2, 20, 0.2826),
+  (10, 10, 1.0),
+])
+def test_binomial_upper_bound(failures, trials, expected):
+  assert synctest2.get_binomial_upper_bound(failures, trials) == pytest.approx(expected, abs=1e-4)
+
+
+def test_estimate_counts_what_each_strategy_hashes(tmp_path, capsys):
+  files = {'same': b'a'*1000, 'cached': b'b'*2000, 'stale': b'c'*500, 'touched': b'd'*300,
+           'grown': b'e'*10, 'sub/f': b'f'*100}
+  make_files(tmp_path/'a', files)
+  files['grown'] = b'e'*20
+  make_files(tmp_path/'b', files)
+  for root in tmp_path/'a', tmp_path/'b':
+    for rel_path in files:
+      os.utime(root/rel_path, (1700000000, 1700000000))
+  os.utime(tmp_path/'b'/'touched', (1700000100, 1700000100))
+  cache_path = tmp_path/'cache.tsv'
+  # Only the entry for "cached" is still valid: "stale" was verified with other modified times.
+  cache_path.write_text('cached\t2000\t1700000000\t1700000000\t0\t1\n'
+                        'stale\t500\t1600000000\t1600000000\t0\t1\n')
+  verify_cache = synctest2.VerifyCache(cache_path)
+  tree = synctest2.LocalTree()
+  estimate = synctest2.estimate_comparison(tmp_path/'a', tmp_path/'b', tree, tree,
+                                           verify_cache=verify_cache, seed=1)
+  # With one subdirectory per level, every probe takes the same path, so the counts are exact.
+  assert estimate.dirs_sampled == 2
+  assert (estimate.entries, estimate.pairs) == (14, 7)
+  assert (estimate.files, estimate.bytes) == (4, 3600)
+  assert (estimate.date_diff_files, estimate.date_diff_bytes) == (1, 300)
+  assert estimate.cached_bytes == 2000
+  # With a date tolerance, "touched" counts as equal.
+  estimate2 = synctest2.estimate_comparison(tmp_path/'a', tmp_path/'b', tree, tree, seed=1,
+                                            date_tolerance=100)
+  assert (estimate2.files, estimate2.bytes, estimate2.date_diff_files) == (5, 3900, 0)
+  assert estimate2.cached_bytes == 0
+  # Check the predictions with known costs: no metadata cost, and a microsecond per byte.
+  estimate.list_seconds = estimate.compare_seconds = 0
+  estimate.read_costs = [(0, 1e-6), (0, 1e-6)]
+  predictions = synctest2.predict_strategies(estimate, ('percent', 10), verify_cache)
+  seconds = {strategy: seconds for strategy, level, options, seconds in predictions}
+  assert seconds['metadata'] == 0
+  assert seconds['full'] == pytest.approx(2*3600e-6)
+  assert seconds['sample'] == pytest.approx(0.1*2*3600e-6)
+  assert seconds['checksum-if-date-diff'] == pytest.approx(2*3900e-6)
+  assert seconds['cached'] == pytest.approx((1 - 2000/3600)*2*3600e-6)
+  assert synctest2.choose_strategy(predictions, 'full')[0] == 'full'
+  assert synctest2.choose_strategy(predictions, 'incremental')[0] == 'cached'
+  output = run(capsys, '--estimate', '--verify-cache', cache_path, tmp_path/'a', tmp_path/'b')
+  assert 'Files to hash: ~4 (3600 bytes each side)' in output
+  assert 'hashed with --checksum-if-date-diff): ~1 (300 bytes each side)' in output
+
+
+def read_metrics(path):
+  """Read a Prometheus textfile into a dict mapping (name, extra labels) to the value."""
+  metrics = {}
+  for line in path.read_text().splitlines():
+    if line.startswith('#'):
+      continue
+    name_labels, value = line.rsplit(' ', 1)
+    name, labels = name_labels[:-1].split('{', 1)
+    labels = tuple(label for label in labels.split(',') if not label.startswith(('path1=', 'path2=')))
+    metrics[name.replace('synctest_', '', 1), labels] = float(value)
+  return metrics
+
+
+@pytest.mark.parametrize('options', [(), ('--time-budget', '1h')])
+def test_metrics_file_counts(tmp_path, capsys, monkeypatch, options):
+  make_differing_dirs(tmp_path)
+  get_crc32 = synctest2.get_crc32
+  def failing_get_crc32(path, *args, **kwargs):
+    if os.path.basename(path) == 'crc':
+      raise OSError(errno.EIO, os.strerror(errno.EIO), path)
+    return get_crc32(path, *args, **kwargs)
+  monkeypatch.setattr(synctest2, 'get_crc32', failing_get_crc32)
+  metrics_path = tmp_path/'metrics.prom'
+  run(capsys, '-t', '-q', *options, '--metrics-file', metrics_path, tmp_path/'a', tmp_path/'b')
+  metrics = read_metrics(metrics_path)
+  assert metrics['diffs_total', ('type="missing1"',)] == 2
+  assert metrics['diffs_total', ('type="missing2"',)] == 2
+  assert metrics['diffs_total', ('type="size"',)] == 1
+  # The "crc" pair couldn't be read, so it's an error instead of a difference.
+  assert metrics['diffs_total', ('type="crc"',)] == 0
+  assert metrics['errors_total', ()] == 1
+  # Pairs of files compared: same, dir/same, dir/sub/same, size, and crc, unless reading it failed
+  # during the comparison itself instead of in the deferred hashing.
+  if options:
+    assert (metrics['files_scanned_total', ()], metrics['bytes_scanned_total', ()]) == (5, 9)
+  else:
+    assert (metrics['files_scanned_total', ()], metrics['bytes_scanned_total', ()]) == (4, 6)
+  # Both sides of each of the 3 same files, through the MeteredTree.
+  assert (metrics['files_hashed_total', ()], metrics['bytes_hashed_total', ()]) == (6, 6)
+  assert metrics['run_finished', ()] == 1
+  assert metrics['run_stopped_early', ()] == 0
+  phases = {labels for name, labels in metrics if name == 'phase_duration_seconds'}
+  if options:
+    assert phases == {('phase="compare"',), ('phase="hash"',)}
+  else:
+    assert phases == {('phase="compare"',)}
+
+
+def test_metrics_label_escaping():
+  # The undecodable byte in the name is written as an escape of that byte.
+  assert synctest2.escape_label_value('a"b\\c\nd\udcff') == 'a\\"b\\\\c\\nd\\\\xff'
+
+
+@pytest.mark.parametrize('options', [('--time-budget', '1h'), ('--verify-sample', '100%')])
+def test_deferred_hashing_finds_content_differences(tmp_path, capsys, options):
+  files = {f'd{i%3}/f{i}': f'{i:04d}' for i in range(30)}
+  make_files(tmp_path/'a', files)
+  files['d1/f4'] = 'xxxx'
+  make_files(tmp_path/'b', files)
+  for rel_path in files:
+    for side in 'a', 'b':
+      os.utime(tmp_path/side/rel_path, (1700000000, 1700000000))
+  output = run(capsys, '-t', *options, tmp_path/'a', tmp_path/'b')
+  assert [line.split('\t')[:2] for line in output.splitlines()] == [['d1/f4', 'crc']]
+
+
+def make_differing_dirs(tmp_path):
+  """Make two directories, "a" and "b", with one of each kind of difference."""
+  files = {'same': 'x', 'dir/same': 'y', 'dir/sub/same': 'z', 'size': 'abc', 'crc': 'abc',
+           'only_a': 'a', 'only_a_dir/f': 'a', 'only_a_dir/sub/g': 'aa'}
+  make_files(tmp_path/'a', files)
+  del files['only_a']
+  del files['only_a_dir/f']
+  del files['only_a_dir/sub/g']
+  files.update({'size': 'abcd', 'crc': 'abd', 'only_b': 'b', 'dir/only_b_dir/f': 'b'})
+  make_files(tmp_path/'b', files)
+  for root in tmp_path/'a', tmp_path/'b':
+    for dirpath, dirnames, filenames in os.walk(root):
+      for name in filenames:
+        os.utime(os.path.join(dirpath, name), (1700000000, 1700000000))
+
+
+def get_diff_types(tsv_output):
+  return sorted(tuple(line.split('\t')[:2]) for line in tsv_output.splitlines())
+
+
+def test_spilled_names_merge_in_order():
+  rand = random.Random(1)
+  names = [f'name{rand.randrange(10**9)}' for i in range(20000)]
+  names += ['caf\u00e9', 'b\udcff', 'A', '']
+  rand.shuffle(names)
+  spilled = synctest2.SpilledNames(names, run_size=3000)
+  assert len(spilled._runs) == len(names) // 3000
+  # Runs are read back in blocks, so plenty of names straddle a block boundary.
+  assert list(spilled) == sorted(names)
+  # Iterations are independent, even when they're interleaved.
+  assert [a == b for a, b in zip(spilled, spilled)] == [True]*len(names)
+  spilled.add_filter(lambda name: name.startswith('name1'))
+  assert list(spilled) == sorted(name for name in names if name.startswith('name1'))
+  spilled.close()
+
+
+def test_spill_threshold_gives_the_same_output(tmp_path, capsys):
+  make_differing_dirs(tmp_path)
+  make_files(tmp_path/'a', {f'dir/f{i}': str(i) for i in range(50)})
+  make_files(tmp_path/'b', {f'dir/f{i}': str(i) for i in range(50) if i % 7})
+  for options in (), ('-O', 'inode'):
+    expected = run(capsys, '-t', *options, tmp_path/'a', tmp_path/'b')
+    assert len(expected.splitlines()) == 6+8
+    assert run(capsys, '-t', *options, '--spill-threshold', '1', tmp_path/'a', tmp_path/'b') == expected
+    assert run(capsys, '-t', *options, '--spill-threshold', '7', tmp_path/'a', tmp_path/'b') == expected
+
+
+def test_watch_updates_diffs(tmp_path):
+  make_differing_dirs(tmp_path)
+  root1 = tmp_path/'a'
+  root2 = tmp_path/'b'
+  tree = synctest2.LocalTree()
+  watcher = synctest2.watch_compare(root1, root2, (), (), tree1=tree, tree2=tree)
+  def get_next_diffs(count):
+    diffs = [next(watcher) for i in range(count)]
+    return sorted((synctest2.get_diff_rel_path(root1, root2, diff), diff.diff_type) for diff in diffs)
+  try:
+    assert get_next_diffs(6) == [
+      ('crc', 'crc'), ('dir/only_b_dir', 'missing1'), ('only_a', 'missing2'),
+      ('only_a_dir', 'missing2'), ('only_b', 'missing1'), ('size', 'size')
+    ]
+    # Modify one file, create another, and delete one that was missing from the other side.
+    (root2/'dir'/'same').write_text('yy')
+    (root1/'dir'/'sub'/'new').write_text('n')
+    (root2/'only_b').unlink()
+    assert get_next_diffs(3) == [
+      ('dir/same', 'size'), ('dir/sub/new', 'missing2'), ('only_b', 'equal')
+    ]
+    # Undo the modification, and the difference goes away.
+    (root2/'dir'/'same').write_text('y')
+    os.utime(root2/'dir'/'same', (1700000000, 1700000000))
+    assert get_next_diffs(1) == [('dir/same', 'equal')]
+  finally:
+    watcher.close()
+
+
+def test_survey_to_tree_matches_directories(tmp_path, capsys):
+  make_differing_dirs(tmp_path)
+  write_survey(tmp_path/'a.tsv', tmp_path/'a')
+  expected = [('crc', 'crc'), ('dir/only_b_dir', 'missing1'), ('only_a', 'missing2'),
+              ('only_a_dir', 'missing2'), ('only_b', 'missing1'), ('size', 'size')]
+  assert get_diff_types(run(capsys, '-t', tmp_path/'a', tmp_path/'b')) == expected
+  assert get_diff_types(run(capsys, '-t', tmp_path/'a.tsv', tmp_path/'b')) == expected
+  for subtree in 'dir', 'only_a_dir', 'only_b', 'crc':
+    expected = get_diff_types(run(capsys, '-t', '-s', subtree, tmp_path/'a', tmp_path/'b'))
+    assert get_diff_types(run(capsys, '-t', '-s', subtree, tmp_path/'a.tsv', tmp_path/'b')) == expected
+
+
+def test_survey_root_below_startpath(tmp_path, capsys):
+  make_differing_dirs(tmp_path)
+  # A survey of just a/dir, but with a as the startpath.
+  write_survey(tmp_path/'a.tsv', tmp_path/'a', roots=[tmp_path/'a'/'dir'])
+  output = run(capsys, '-t', tmp_path/'a.tsv', tmp_path/'b')
+  assert get_diff_types(output) == [('dir/only_b_dir', 'missing1')]
+  make_files(tmp_path/'b', {'dir/sub/new': 'n'})
+  (tmp_path/'b'/'dir'/'same').unlink()
+  output = run(capsys, '-t', '-s', 'dir/sub', tmp_path/'a.tsv', tmp_path/'b')
+  assert get_diff_types(output) == [('dir/sub/new', 'missing1')]
+  output = run(capsys, '-t', '-s', 'dir/same', tmp_path/'a.tsv', tmp_path/'b')
+  assert get_diff_types(output) == [('dir/same', 'missing2')]
+  for path in (tmp_path/'b'/'dir').rglob('*'):
+    if path.is_file():
+      path.unlink()
+  for path in sorted((tmp_path/'b'/'dir').rglob('*'), reverse=True):
+    path.rmdir()
+  (tmp_path/'b'/'dir').rmdir()
+  output = run(capsys, '-t', tmp_path/'a.tsv', tmp_path/'b')
+  fields = output.rstrip('\n').split('\t')
+  assert fields[:3] == ['dir', 'missing2', 'dir']
+  assert fields[-4:] == ['2', '?', '2', '?']
+
+
+@pytest.mark.parametrize('suffix', ['.tar', '.tgz', '.zip'])
+def test_archive_to_tree_matches_directories(tmp_path, capsys, suffix):
+  make_differing_dirs(tmp_path)
+  archive_path = tmp_path/('a'+suffix)
+  if suffix == '.zip':
+    with zipfile.ZipFile(archive_path, 'w') as archive:
+      for path in sorted((tmp_path/'a').rglob('*')):
+        archive.write(path, path.relative_to(tmp_path/'a').as_posix())
+  else:
+    with tarfile.open(archive_path, 'w:gz' if suffix == '.tgz' else 'w') as archive:
+      for path in sorted((tmp_path/'a').iterdir()):
+        archive.add(path, path.name)
+  subtrees = (None, 'dir', 'dir/same', 'dir/only_b_dir', 'only_a_dir', 'only_a_dir/sub', 'only_b',
+              'crc')
+  for subtree in subtrees:
+    options = ('-s', subtree) if subtree else ()
+    expected = get_diff_types(run(capsys, '-t', *options, tmp_path/'a', tmp_path/'b'))
+    assert get_diff_types(run(capsys, '-t', *options, archive_path, tmp_path/'b')) == expected
+
+
+def read_duplicates(path):
+  header = {}
+  lines = []
+  for line in path.read_text().splitlines():
+    if line.startswith('##'):
+      key, value = line[2:].split('=', 1)
+      header[key] = value
+    elif not line.startswith('#'):
+      lines.append(line.split('\t'))
+  return header, lines
+
+
+def test_duplicates_are_confirmed(tmp_path, capsys, monkeypatch):
+  make_files(tmp_path/'a', {'x': 'abc', 'y': 'abc', 'z': 'abd', 'big': 'long'})
+  make_files(tmp_path/'b', {'x': 'abc', 'w': 'long'})
+  # Make every file of the same size look the same by its CRC-32.
+  monkeypatch.setattr(synctest2, 'get_crc32', lambda *args, **kwargs: 1)
+  dup_path = tmp_path/'dups.tsv'
+  run(capsys, '--duplicates', dup_path, tmp_path/'a', tmp_path/'b')
+  header, lines = read_duplicates(dup_path)
+  assert (header['groups'], header['reclaimable']) == ('2', '3')
+  assert (header['unconfirmed_groups'], header['unconfirmed_reclaimable']) == ('0', '0')
+  assert lines == [['1', '3', '1', 'yes', 'both', 'x'], ['1', '3', '1', 'yes', '1', 'y'],
+                   ['2', '4', '1', 'yes', '1', 'big'], ['2', '4', '1', 'yes', '2', 'w']]
+
+
+def test_remote_duplicates_are_unconfirmed(tmp_path, capsys, monkeypatch):
+  make_files(tmp_path/'a', {'x': 'abc', 'y': 'abd'})
+  make_files(tmp_path/'b', {'z': 'abe'})
+  monkeypatch.setattr(synctest2, 'get_crc32', lambda *args, **kwargs: 1)
+  dup_path = tmp_path/'dups.tsv'
+  with synctest2.MetadataServer(('127.0.0.1', 0), tmp_path) as server:
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+      url = f'tcp://127.0.0.1:{server.server_address[1]}/b'
+      run(capsys, '--duplicates', dup_path, tmp_path/'a', url)
+    finally:
+      server.shutdown()
+  header, lines = read_duplicates(dup_path)
+  assert (header['groups'], header['reclaimable']) == ('0', '0')
+  assert (header['unconfirmed_groups'], header['unconfirmed_reclaimable']) == ('1', '3')
+  assert [line[3:] for line in lines] == [['no', '1', 'x'], ['no', '1', 'y'], ['no', '2', 'z']]
+
+
+def test_survey_scope_needs_a_separator_after_startpath():
+  meta = {'startpath': '/data/a'}
+  path_filter = synctest2.PathFilter(excludes=('b',))
+  assert not synctest2.in_survey_scope('/data/a/b/f', meta, path_filter)
+  # "/data/ab" isn't inside "/data/a", so it isn't "b/f" relative to it.
+  assert synctest2.in_survey_scope('/data/ab/f', meta, path_filter)
+  assert synctest2.in_survey_scope('/data/a', meta, path_filter)
+  assert not synctest2.in_survey_scope('/b/f', {'startpath': '/'}, path_filter)
+  assert synctest2.in_survey_scope('/data/a/x/y', meta, max_depth=2)
+  assert not synctest2.in_survey_scope('/data/a/x/y/z', meta, max_depth=2)
+
+
+def test_survey_subtree_without_index(tmp_path, capsys, monkeypatch):
+  make_files(tmp_path/'a', {'sub/f': 'x', 'sub/g': 'y', 'other': 'z'})
+  make_files(tmp_path/'b', {'sub/f': 'x', 'other': 'z'})
+  write_survey(tmp_path/'a.tsv', tmp_path/'a')
+  expected = get_diff_types(run(capsys, '-t', '-s', 'sub', tmp_path/'a.tsv', tmp_path/'b'))
+  assert expected == [('sub/g', 'missing2')]
+  # The survey is in a directory where the index can't be written.
+  (tmp_path/'a.tsv.idx').unlink()
+  def get_survey_index(survey_path):
+    raise PermissionError(errno.EACCES, 'Permission denied', str(survey_path)+'.idx.tmp')
+  monkeypatch.setattr(synctest2, 'get_survey_index', get_survey_index)
+  assert get_diff_types(run(capsys, '-t', '-s', 'sub', tmp_path/'a.tsv', tmp_path/'b')) == expected
+  # The survey is given as a pipe.
+  fifo_path = tmp_path/'fifo.tsv'
+  os.mkfifo(fifo_path)
+  def write_fifo():
+    with fifo_path.open('w') as fifo:
+      fifo.write((tmp_path/'a.tsv').read_text())
+  thread = threading.Thread(target=write_fifo)
+  thread.start()
+  assert get_diff_types(run(capsys, '-t', '-s', 'sub', fifo_path, tmp_path/'b')) == expected
+  thread.join()